@@ -1,79 +1,165 @@
-import pandas as pd
+import argparse
+import io
 import logging
-from conexao_db import Conexao
+
+import pandas as pd
+from psycopg2.extras import execute_values
+
+from banco.conexao_db import Conexao
 
 # Configuração do logger
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def povoar_banco_de_dados():
+# Linhas do CSV lidas por vez
+TAMANHO_BLOCO = 100_000
+
+# Pesquisadores enviados ao banco por comando
+TAMANHO_PAGINA = 1_000
+
+# Insere os pesquisadores de um bloco e devolve o pes_id de cada um, tanto dos
+# recém-inseridos quanto dos que já existiam. O CTE 'inseridos' não é visível
+# para o SELECT da segunda parte, que por isso só encontra os já existentes.
+SQL_UPSERT_PESQUISADORES = """
+    WITH dados (pes_nome, pes_resumo, pes_lattes_id) AS (VALUES %s),
+    inseridos AS (
+        INSERT INTO pesquisador (pes_nome, pes_resumo, pes_lattes_id)
+        SELECT pes_nome, pes_resumo, pes_lattes_id FROM dados
+        ON CONFLICT (pes_lattes_id) DO NOTHING
+        RETURNING pes_lattes_id, pes_id
+    )
+    SELECT pes_lattes_id, pes_id FROM inseridos
+    UNION ALL
+    SELECT p.pes_lattes_id, p.pes_id FROM pesquisador p JOIN dados d ON d.pes_lattes_id = p.pes_lattes_id;
+"""
+
+SQL_COPY_ARTIGOS = "COPY artigo (art_pes_id, art_titulo, art_ano, art_doi) FROM STDIN WITH (FORMAT csv)"
+
+
+def _sem_nulos(df):
+    """
+    Converte os valores ausentes (NaN) do DataFrame em None, que o psycopg2 envia como NULL.
+    """
+    return df.astype(object).where(df.notna(), None)
+
+
+def _resolver_pesquisadores(cursor, bloco, ids_pesquisadores, tamanho_pagina):
+    """
+    Insere os pesquisadores do bloco ainda não vistos nesta carga e acrescenta o
+    pes_id de cada um ao dicionário ids_pesquisadores (pes_lattes_id -> pes_id).
+    Retorna quantos pesquisadores foram processados.
+    """
+    df_pesquisadores = (bloco[['pes_nome', 'pes_resumo', 'pes_lattes_id']]
+                        .dropna(subset=['pes_lattes_id'])
+                        .drop_duplicates(subset=['pes_lattes_id']))
+    df_pesquisadores = df_pesquisadores[~df_pesquisadores['pes_lattes_id'].isin(ids_pesquisadores.keys())]
+    if df_pesquisadores.empty:
+        return 0
+
+    resultados = execute_values(
+        cursor,
+        SQL_UPSERT_PESQUISADORES,
+        list(_sem_nulos(df_pesquisadores).itertuples(index=False, name=None)),
+        page_size=tamanho_pagina,
+        fetch=True
+    )
+    ids_pesquisadores.update(resultados)
+    return len(df_pesquisadores)
+
+
+def _copiar_artigos(cursor, bloco, ids_pesquisadores):
+    """
+    Carrega os artigos do bloco com um único COPY, ligando cada um ao pes_id do seu pesquisador.
+    Artigos sem título ou sem pesquisador correspondente são ignorados.
+    Retorna quantos artigos foram inseridos.
+    """
+    df_artigos = bloco[bloco['tipo'] == 'artigo'].dropna(subset=['titulo'])
+    df_artigos = pd.DataFrame({
+        'art_pes_id': df_artigos['pes_lattes_id'].map(ids_pesquisadores).astype('Int64'),
+        'art_titulo': df_artigos['titulo'],
+        'art_ano': pd.to_numeric(df_artigos['ano'], errors='coerce').astype('Int64'),
+        'art_doi': df_artigos['doi'],
+    }).dropna(subset=['art_pes_id'])
+    if df_artigos.empty:
+        return 0
+
+    # No formato CSV do COPY, campos vazios sem aspas são NULL
+    buffer = io.StringIO()
+    df_artigos.to_csv(buffer, header=False, index=False)
+    buffer.seek(0)
+    cursor.copy_expert(SQL_COPY_ARTIGOS, buffer)
+    return len(df_artigos)
+
+
+def povoar_banco_de_dados(caminho_csv='lattes_data.csv', tamanho_bloco=TAMANHO_BLOCO,
+                          tamanho_pagina=TAMANHO_PAGINA, conexao=None):
     """
     Popula as tabelas 'pesquisador' e 'artigo' a partir de um arquivo CSV.
-    Assume que o CSV 'lattes_data.csv' existe no mesmo diretório.
+
+    O CSV é lido em blocos de tamanho_bloco linhas. Para cada bloco, os pesquisadores
+    são inseridos e têm seus pes_id resolvidos por um único comando a cada
+    tamanho_pagina pesquisadores, e os artigos são carregados com COPY. Toda a carga
+    ocorre em uma única transação: em caso de erro, nada é gravado.
+
+    Args:
+        caminho_csv: Caminho do CSV gerado pelo notebook de pré-processamento.
+        tamanho_bloco: Número de linhas do CSV lidas por vez.
+        tamanho_pagina: Número de pesquisadores enviados ao banco por comando.
+        conexao: Conexão psycopg2 a usar. Se omitida, uma conexão é obtida do pool de Conexao.
+
+    Returns:
+        Uma tupla (pesquisadores, artigos) com o número de registros processados,
+        ou None se a carga falhar.
     """
     try:
-        # Carrega os dados do CSV para um DataFrame do pandas
-        df = pd.read_csv('lattes_data.csv')
-        logger.info("Arquivo CSV 'lattes_data.csv' carregado com sucesso.")
+        # Os identificadores Lattes são lidos como texto para não perderem dígitos
+        blocos = pd.read_csv(caminho_csv, chunksize=tamanho_bloco, dtype={'pes_lattes_id': str})
     except FileNotFoundError:
-        logger.error("Erro: O arquivo 'lattes_data.csv' não foi encontrado.")
+        logger.error(f"Erro: O arquivo '{caminho_csv}' não foi encontrado.")
         logger.error("Por favor, execute o notebook de pré-processamento para gerá-lo primeiro.")
-        return
+        return None
     except Exception as e:
         logger.error(f"Erro ao ler o arquivo CSV: {e}")
-        return
-
-    conexao = Conexao()
-    with conexao.conectar() as conn:
-        with conn.cursor() as cursor:
-            try:
-                # --- Povoar a tabela 'pesquisador' ---
-                logger.info("Povoando a tabela 'pesquisador'...")
-                # Seleciona dados únicos de pesquisadores e remove duplicatas
-                df_pesquisadores = df[['pes_nome', 'pes_resumo', 'pes_lattes_id']].drop_duplicates().dropna(subset=['pes_lattes_id'])
-
-                for _, row in df_pesquisadores.iterrows():
-                    # Insere o pesquisador e ignora se o lattes_id já existir
-                    cursor.execute(
-                        """
-                        INSERT INTO pesquisador (pes_nome, pes_resumo, pes_lattes_id)
-                        VALUES (%s, %s, %s)
-                        ON CONFLICT (pes_lattes_id) DO NOTHING;
-                        """,
-                        (row['pes_nome'], row['pes_resumo'], str(row['pes_lattes_id']))
-                    )
-                logger.info(f"{len(df_pesquisadores)} registros de pesquisadores processados.")
-
-                # --- Povoar a tabela 'artigo' ---
-                logger.info("Povoando a tabela 'artigo'...")
-                # Filtra as linhas que correspondem a artigos e têm título
-                df_artigos = df[df['tipo'] == 'artigo'].dropna(subset=['titulo'])
-
-                for _, row in df_artigos.iterrows():
-                    # Primeiro, busca o ID do pesquisador correspondente
-                    cursor.execute("SELECT pes_id FROM pesquisador WHERE pes_lattes_id = %s;", (str(row['pes_lattes_id']),))
-                    resultado = cursor.fetchone()
-                    
-                    if resultado:
-                        pes_id = resultado[0]
-                        # Insere o artigo com a chave estrangeira correta
-                        cursor.execute(
-                            """
-                            INSERT INTO artigo (art_pes_id, art_titulo, art_ano, art_doi)
-                            VALUES (%s, %s, %s, %s);
-                            """,
-                            (pes_id, row['titulo'], int(row['ano']), row['doi'])
-                        )
-                logger.info(f"{len(df_artigos)} registros de artigos processados.")
-
-                # Confirma todas as transações
-                conn.commit()
-                logger.info("Povoamento do banco de dados concluído com sucesso!")
-
-            except Exception as e:
-                logger.error(f"Erro durante o povoamento do banco de dados: {e}")
-                # Desfaz as alterações em caso de erro
-                conn.rollback()
+        return None
+
+    conexao_do_pool = conexao is None
+    if conexao_do_pool:
+        conexao = Conexao.obter_conexao()
+
+    # pes_lattes_id -> pes_id dos pesquisadores já resolvidos nesta carga
+    ids_pesquisadores = {}
+    total_pesquisadores = 0
+    total_artigos = 0
+    try:
+        with blocos, conexao.cursor() as cursor:
+            for numero, bloco in enumerate(blocos, start=1):
+                total_pesquisadores += _resolver_pesquisadores(cursor, bloco, ids_pesquisadores, tamanho_pagina)
+                total_artigos += _copiar_artigos(cursor, bloco, ids_pesquisadores)
+                logger.info(f"Bloco {numero}: {total_pesquisadores} pesquisadores e "
+                            f"{total_artigos} artigos processados até agora.")
+
+        # Confirma todas as transações
+        conexao.commit()
+        logger.info(f"{total_pesquisadores} registros de pesquisadores processados.")
+        logger.info(f"{total_artigos} registros de artigos processados.")
+        logger.info("Povoamento do banco de dados concluído com sucesso!")
+        return total_pesquisadores, total_artigos
+
+    except Exception as e:
+        logger.error(f"Erro durante o povoamento do banco de dados: {e}")
+        # Desfaz as alterações em caso de erro
+        conexao.rollback()
+        return None
+
+    finally:
+        if conexao_do_pool:
+            Conexao.devolver_conexao(conexao)
+
 
 if __name__ == "__main__":
-    povoar_banco_de_dados()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Popula o banco de dados a partir do CSV do Lattes.")
+    parser.add_argument("caminho_csv", nargs="?", default="lattes_data.csv")
+    parser.add_argument("--tamanho-bloco", type=int, default=TAMANHO_BLOCO)
+    parser.add_argument("--tamanho-pagina", type=int, default=TAMANHO_PAGINA)
+    args = parser.parse_args()
+    povoar_banco_de_dados(args.caminho_csv, args.tamanho_bloco, args.tamanho_pagina)
@@ -0,0 +1,135 @@
+# Testes da carga do CSV no PostgreSQL (banco/povoar_db.py), contra uma
+# instância descartável. São ignorados se nem DATABASE_URL nem as variáveis
+# da libpq (PGHOST, PGDATABASE ou PGSERVICE, com PGPORT, PGUSER, ...)
+# estiverem definidas. Execute a partir deste diretório (backend):
+#
+#     DATABASE_URL=postgresql://postgres@localhost:5445/postgres python -m unittest discover tests
+#
+# As tabelas são criadas em um schema temporário, apagado ao final.
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+URL_BANCO = os.environ.get('DATABASE_URL')
+BANCO_CONFIGURADO = bool(URL_BANCO) or any(nome in os.environ for nome in ('PGHOST', 'PGDATABASE', 'PGSERVICE'))
+
+# config.py exige as configurações da API ao ser importado, embora a carga
+# use a conexão passada pelo teste
+for nome in ('DB_HOST', 'DB_NAME', 'DB_USER', 'DB_PASS', 'OPENAI_API_KEY'):
+    os.environ.setdefault(nome, 'teste')
+
+SQL_TABELAS = """
+CREATE TABLE pesquisador (
+    pes_id SERIAL PRIMARY KEY,
+    pes_nome VARCHAR(255) NOT NULL,
+    pes_resumo TEXT,
+    pes_lattes_id VARCHAR(50) UNIQUE NOT NULL
+);
+CREATE TABLE artigo (
+    art_id SERIAL PRIMARY KEY,
+    art_pes_id INT NOT NULL REFERENCES pesquisador (pes_id),
+    art_titulo TEXT NOT NULL,
+    art_ano INT,
+    art_doi VARCHAR(100)
+);
+"""
+
+COLUNAS = ['pes_nome', 'pes_resumo', 'pes_lattes_id', 'tipo', 'titulo', 'ano', 'doi']
+
+# Linhas do CSV de teste. Os identificadores com zeros à esquerda devem ser
+# preservados, e a mesma pesquisadora aparece em blocos diferentes.
+LINHAS = [
+    ['Ana Souza', 'Resumo da Ana', '0777733127275321', 'artigo', 'Redes neurais', '2020', '10.1/a'],
+    ['Ana Souza', 'Resumo da Ana', '0777733127275321', 'livro', 'Um livro', '2021', ''],
+    ['Rui Lima', '', '1608472474770322', 'artigo', 'Grafos de coautoria', '', ''],
+    ['Rui Lima', '', '1608472474770322', 'artigo', '', '2019', ''],
+    ['Ana Souza', 'Resumo da Ana', '0777733127275321', 'artigo', 'Busca semântica', '2022', ''],
+    ['Sem Lattes', '', '', 'artigo', 'Artigo sem pesquisador', '2020', ''],
+]
+
+
+@unittest.skipUnless(psycopg2 is not None and BANCO_CONFIGURADO,
+                     "psycopg2 e DATABASE_URL ou PGHOST/PGDATABASE/PGSERVICE são necessários")
+class PovoarBancoTest(unittest.TestCase):
+    def setUp(self):
+        from banco.povoar_db import povoar_banco_de_dados
+        self.povoar = povoar_banco_de_dados
+
+        self.diretorio = tempfile.mkdtemp(prefix='lattes-test-')
+        self.caminho_csv = os.path.join(self.diretorio, 'lattes_data.csv')
+        with open(self.caminho_csv, 'w', newline='', encoding='utf-8') as arquivo:
+            escritor = csv.writer(arquivo)
+            escritor.writerow(COLUNAS)
+            escritor.writerows(LINHAS)
+
+        self.conexao = psycopg2.connect(URL_BANCO or '')
+        self.schema = f'teste_povoar_{uuid.uuid4().hex[:12]}'
+        with self.conexao.cursor() as cursor:
+            cursor.execute(f'CREATE SCHEMA {self.schema}')
+            cursor.execute(f'SET search_path TO {self.schema}')
+            cursor.execute(SQL_TABELAS)
+        self.conexao.commit()
+
+    def tearDown(self):
+        self.conexao.rollback()
+        with self.conexao.cursor() as cursor:
+            cursor.execute(f'DROP SCHEMA {self.schema} CASCADE')
+        self.conexao.commit()
+        self.conexao.close()
+        shutil.rmtree(self.diretorio, ignore_errors=True)
+
+    def consultar(self, sql):
+        with self.conexao.cursor() as cursor:
+            cursor.execute(sql)
+            return cursor.fetchall()
+
+    def ids_pesquisadores(self):
+        return dict(self.consultar("SELECT pes_lattes_id, pes_id FROM pesquisador"))
+
+    def artigos(self):
+        return sorted(self.consultar("""
+            SELECT p.pes_lattes_id, a.art_titulo, a.art_ano, a.art_doi
+            FROM artigo a JOIN pesquisador p ON p.pes_id = a.art_pes_id
+        """))
+
+    def test_carga_repetida(self):
+        # Blocos de duas linhas, para que pesquisadores se repitam entre blocos
+        self.assertEqual(self.povoar(self.caminho_csv, tamanho_bloco=2, tamanho_pagina=1, conexao=self.conexao),
+                         (2, 3))
+        ids = self.ids_pesquisadores()
+        self.assertEqual(set(ids), {'0777733127275321', '1608472474770322'})
+        self.assertEqual(self.consultar("SELECT pes_nome, pes_resumo FROM pesquisador ORDER BY pes_nome"),
+                         [('Ana Souza', 'Resumo da Ana'), ('Rui Lima', None)])
+        artigos = [
+            ('0777733127275321', 'Busca semântica', 2022, None),
+            ('0777733127275321', 'Redes neurais', 2020, '10.1/a'),
+            ('1608472474770322', 'Grafos de coautoria', None, None),
+        ]
+        self.assertEqual(self.artigos(), artigos)
+
+        # A segunda carga encontra os pesquisadores já gravados: nenhum é
+        # duplicado e os pes_id não mudam. Os artigos são acrescentados de
+        # novo, ligados aos mesmos pes_id, como a carga sempre fez.
+        self.assertEqual(self.povoar(self.caminho_csv, tamanho_bloco=4, conexao=self.conexao), (2, 3))
+        self.assertEqual(self.ids_pesquisadores(), ids)
+        self.assertEqual(self.artigos(), sorted(artigos * 2))
+
+    def test_falha_nao_grava_nada(self):
+        with open(self.caminho_csv, 'a', newline='', encoding='utf-8') as arquivo:
+            # O DOI passa dos 100 caracteres da coluna: o COPY do último bloco falha
+            csv.writer(arquivo).writerow(['Eva Dias', '', '1966167015825708', 'artigo', 'Título', '2020', 'x' * 101])
+        self.assertIsNone(self.povoar(self.caminho_csv, tamanho_bloco=2, conexao=self.conexao))
+        self.assertEqual(self.consultar("SELECT COUNT(*) FROM pesquisador"), [(0,)])
+        self.assertEqual(self.consultar("SELECT COUNT(*) FROM artigo"), [(0,)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,469 @@
+import bisect
+import heapq
+import logging
+import os
+import re
+import sys
+import threading
+
+from database import get_deletion_mark, get_generation, reader_connection, record_deletion_mark
+from text_utils import normalize_text
+
+logger = logging.getLogger(__name__)
+
+# Prefix suggestions of researcher names and title terms, kept in memory.
+#
+# Each vocabulary is a sorted array of normalized keys with their frequency
+# (publications of the researcher, or publications with the term in their
+# title). The keys starting with a prefix are a contiguous range found by
+# binary search; the most frequent of the range are picked by a scan, or,
+# for short prefixes whose range is large, precomputed when the arrays are
+# built. Lookups never touch the database.
+#
+# A background thread builds the vocabularies once and then, after every
+# ingest, counts in the publications added since (above a high-water mark)
+# and subtracts those deleted, read with their titles from the deletion log.
+# Only the keys whose counts changed are merged into the arrays, and only
+# the precomputed prefixes of these keys ranked again. The counts are kept
+# whole, beside the arrays, so the researchers and terms left out by the
+# memory budget keep counting across merges; the arrays are built again
+# from them when a change would bring one in. The vocabularies are rebuilt
+# from the database when the log no longer has the deletions since the
+# last refresh.
+
+# Memory budget of the suggestion arrays; the least frequent researchers and
+# terms are left out beyond it, researchers having priority over terms
+AUTOCOMPLETE_MAX_BYTES = int(os.environ.get('AUTOCOMPLETE_MAX_BYTES', 32 * 1024 * 1024))
+
+# Seconds between two checks for new or deleted publications
+AUTOCOMPLETE_INTERVAL = float(os.environ.get('AUTOCOMPLETE_INTERVAL', 5))
+
+# Maximum suggestions of each kind per lookup
+AUTOCOMPLETE_MAX_LIMIT = 20
+
+# Prefixes matching more keys than this get their most frequent keys
+# precomputed, so no lookup scans more than this many
+_SCAN_LIMIT = 256
+
+# Keys ranked per lookup, more than returned as a researcher can match
+# through several of its keys
+_RANKED = 2 * AUTOCOMPLETE_MAX_LIMIT
+
+# A researcher is found by the start of its name or of any later word of it
+# ("conceicao" finds "Joao da Conceicao"): its keys are the name from each
+# of these words, then this separator and the whole name, to keep them unique
+_SEPARATOR = '\x00'
+
+# Sorts after any character, ending the range of a prefix
+_AFTER = '\U0010ffff'
+
+# Rough bytes per entry besides its strings: list slots and count
+_ENTRY_OVERHEAD = 40
+
+_WORD = re.compile(r'\w+')
+_LAST_WORD = re.compile(r'\w+$')
+
+# Title words too common to be worth suggesting (words of 1 and 2 letters
+# are never suggested)
+_STOPWORDS = frozenset((
+    'para', 'com', 'uma', 'por', 'pela', 'pelo', 'pelas', 'pelos', 'dos', 'das', 'nos', 'nas', 'num', 'numa',
+    'sobre', 'entre', 'como', 'que', 'sua', 'seu', 'suas', 'seus', 'sem', 'sob', 'apos', 'ate', 'este', 'esta',
+    'esse', 'essa', 'del', 'los', 'las', 'con', 'una', 'the', 'and', 'for', 'with', 'from', 'into', 'its',
+))
+
+
+def _is_term(word):
+    return len(word) > 2 and not word.isdigit() and word not in _STOPWORDS
+
+
+# Sorted keys with the display text and frequency of each
+class _Vocabulary:
+    def __init__(self, entries):
+        entries = sorted(entries)
+        self.keys = [key for key, _, _ in entries]
+        self.displays = [display for _, display, _ in entries]
+        self.counts = [count for _, _, count in entries]
+        self._top = {}
+        if self.keys:
+            self._precompute('', 0, len(self.keys))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        i = bisect.bisect_left(self.keys, key)
+        return i < len(self.keys) and self.keys[i] == key
+
+    # Copy with changes, a dict of keys to their (display, count), merged
+    # in, a count of 0 removing the key. Only the precomputed prefixes of
+    # the changed keys are ranked again.
+    def merged(self, changes):
+        changed = sorted(changes)
+        merged = _Vocabulary(())
+        keys, displays, counts = merged.keys, merged.displays, merged.counts
+        # The unchanged keys are copied in runs: the old index each run
+        # starts at and how far it moved
+        starts = []
+        shifts = []
+        positions = {}
+        start = 0
+        for key in changed + [None]:
+            end = bisect.bisect_left(self.keys, key, start) if key is not None else len(self.keys)
+            starts.append(start)
+            shifts.append(len(keys) - start)
+            keys.extend(self.keys[start:end])
+            displays.extend(self.displays[start:end])
+            counts.extend(self.counts[start:end])
+            if key is None:
+                break
+            start = end + 1 if end < len(self.keys) and self.keys[end] == key else end
+            display, count = changes[key]
+            if count:
+                positions[key] = len(keys)
+                keys.append(key)
+                displays.append(display)
+                counts.append(count)
+
+        def moved(i):
+            position = positions.get(self.keys[i])
+            if position is None:
+                position = i + shifts[bisect.bisect_right(starts, i) - 1]
+            return position
+
+        affected = {key[:length] for key in changed for length in range(len(key) + 1)} & self._top.keys()
+        merged._top = {prefix: [moved(i) for i in top] for prefix, top in self._top.items() if prefix not in affected}
+        if not keys:
+            return merged
+        for key in changed:
+            for length in range(len(key) + 1):
+                prefix = key[:length]
+                if prefix in merged._top:
+                    continue
+                low = bisect.bisect_left(keys, prefix)
+                high = bisect.bisect_left(keys, prefix + _AFTER, low)
+                if prefix and high - low <= _SCAN_LIMIT:
+                    break
+                top = self._top.get(prefix)
+                if top is None:
+                    merged._precompute(prefix, low, high)
+                elif any(self.keys[i] in changes and changes[self.keys[i]][1] < self.counts[i] for i in top):
+                    # A key of the best lost publications: rank the range
+                    merged._top[prefix] = merged._best(low, high)
+                else:
+                    # Only the changed keys can have joined the best
+                    first = bisect.bisect_left(changed, prefix)
+                    last = bisect.bisect_left(changed, prefix + _AFTER, first)
+                    candidates = {moved(i) for i in top}
+                    candidates.update(positions[other] for other in changed[first:last] if other in positions)
+                    merged._top[prefix] = heapq.nlargest(_RANKED, sorted(candidates), key=counts.__getitem__)
+        return merged
+
+    def _best(self, low, high):
+        return heapq.nlargest(_RANKED, range(low, high), key=self.counts.__getitem__)
+
+    # Precompute the best keys of a prefix matching more than _SCAN_LIMIT
+    # keys, and of its one character longer prefixes that do too
+    def _precompute(self, prefix, low, high):
+        self._top[prefix] = self._best(low, high)
+        length = len(prefix) + 1
+        start = low
+        while start < high:
+            key = self.keys[start]
+            if len(key) < length:
+                start += 1
+                continue
+            child = key[:length]
+            end = bisect.bisect_left(self.keys, child + _AFTER, start, high)
+            if end - start > _SCAN_LIMIT:
+                self._precompute(child, start, end)
+            start = end
+
+    # Indexes of the most frequent keys starting with the prefix, most
+    # frequent first (ties in key order)
+    def lookup(self, prefix):
+        top = self._top.get(prefix)
+        if top is not None:
+            return top
+        low = bisect.bisect_left(self.keys, prefix)
+        return self._best(low, bisect.bisect_left(self.keys, prefix + _AFTER, low))
+
+
+# Keys of a researcher's normalized name
+def _name_keys(name):
+    words = name.split(' ')
+    return [' '.join(words[i:]) + _SEPARATOR + name for i, word in enumerate(words) if i == 0 or len(word) > 2]
+
+
+def _name_size(name, display, keys):
+    return sys.getsizeof(display) + sum(sys.getsizeof(key) + _ENTRY_OVERHEAD for key in keys)
+
+
+def _term_size(term, display, keys):
+    return sys.getsizeof(term) + _ENTRY_OVERHEAD + (sys.getsizeof(display) if display != term else 0)
+
+
+# Immutable snapshot of the suggestions, swapped whole on every refresh so
+# lookups need no lock. names maps normalized researcher names to their
+# (full name, publications), terms normalized title words to their
+# (word, publications). names_left_out and terms_left_out are the most
+# publications of a researcher or term left out by the memory budget, 0
+# when none is.
+class AutocompleteIndex:
+    def __init__(self, names, terms, max_bytes=AUTOCOMPLETE_MAX_BYTES):
+        name_entries, size, self.names_left_out = self._entries(names, max_bytes, _name_keys, _name_size)
+        term_entries, term_size, self.terms_left_out = self._entries(terms, max_bytes - size, lambda term: [term],
+                                                                     _term_size)
+        self.names = _Vocabulary(name_entries)
+        self.terms = _Vocabulary(term_entries)
+        self.size = size + term_size
+
+    @staticmethod
+    def _entries(counts, max_bytes, keys_of, size_of):
+        entries = []
+        size = 0
+        for key, (display, count) in sorted(counts.items(), key=lambda item: -item[1][1]):
+            keys = keys_of(key)
+            key_size = size_of(key, display, keys)
+            if size + key_size > max_bytes:
+                return entries, size, count
+            size += key_size
+            entries.extend((key, display, count) for key in keys)
+        return entries, size, 0
+
+    # Copy with changes of counts merged in, given the (display, count)
+    # before and after of each changed researcher and term (None when not
+    # counted), or None if the memory budget calls for building it again:
+    # when a change would bring in a researcher or term while others are
+    # left out, leave one kept less frequent than one left out, or overflow
+    # the budget
+    def merged(self, name_changes, term_changes, max_bytes):
+        merged = AutocompleteIndex({}, {}, max_bytes)
+        merged.size = self.size
+        merged.names_left_out = self.names_left_out
+        merged.terms_left_out = self.terms_left_out
+        name_entries = merged._changed_entries(self.names, self.names_left_out, name_changes,
+                                               _name_keys, _name_size)
+        term_entries = merged._changed_entries(self.terms, self.terms_left_out, term_changes,
+                                               lambda term: [term], _term_size)
+        if name_entries is None or term_entries is None or merged.size > max_bytes:
+            return None
+        merged.names = self.names.merged(name_entries) if name_entries else self.names
+        merged.terms = self.terms.merged(term_entries) if term_entries else self.terms
+        return merged
+
+    # Entries of a vocabulary changed by changes, accounting for their size,
+    # or None if the budget calls for building it again
+    def _changed_entries(self, vocabulary, left_out, changes, keys_of, size_of):
+        entries = {}
+        for key, (old, new) in changes.items():
+            keys = keys_of(key)
+            if keys[0] in vocabulary:
+                if new is None:
+                    self.size -= size_of(key, old[0], keys)
+                elif new[1] < left_out:
+                    return None
+                entries.update((key, (old[0], new[1] if new else 0)) for key in keys)
+            elif new is None or 0 < left_out and new[1] <= left_out:
+                continue
+            elif old is None and not left_out:
+                self.size += size_of(key, new[0], keys)
+                entries.update((key, new) for key in keys)
+            else:
+                return None
+        return entries
+
+    # Researchers whose name, or a word of it, starts with the query, and
+    # completions of the last word of the query with title terms, most
+    # frequent first
+    def suggest(self, query, limit):
+        researchers = []
+        prefix = normalize_text(query)
+        if prefix:
+            seen = set()
+            for i in self.names.lookup(prefix):
+                display = self.names.displays[i]
+                if display not in seen:
+                    seen.add(display)
+                    researchers.append({"name": display, "publications": self.names.counts[i]})
+                    if len(researchers) == limit:
+                        break
+
+        terms = []
+        last_word = _LAST_WORD.search(query)
+        prefix = normalize_text(last_word.group()) if last_word else ''
+        if prefix:
+            head = query[:last_word.start()]
+            for i in self.terms.lookup(prefix)[:limit]:
+                display = self.terms.displays[i]
+                terms.append({"term": display, "text": head + display, "publications": self.terms.counts[i]})
+
+        return {"researchers": researchers, "terms": terms}
+
+
+# Add the publications of rows of (title, researcher full name, id) to
+# counts of names and terms, as kept by AutocompleteIndex, or subtract them
+# with a sign of -1
+def count_rows(rows, names, terms, sign=1):
+    # Names and words repeat, so each is normalized once
+    normalized_names = {}
+    word_terms = {}
+    for title, full_name, _ in rows:
+        name = normalized_names.get(full_name)
+        if name is None:
+            name = normalized_names[full_name] = normalize_text(full_name)
+        display, count = names.get(name, (full_name, 0))
+        names[name] = (display, count + sign)
+
+        seen = set()
+        for word in _WORD.findall(title.casefold()):
+            if word not in word_terms:
+                term = normalize_text(word)
+                word_terms[word] = term if _is_term(term) else None
+            term = word_terms[word]
+            if term is None or term in seen:
+                continue
+            seen.add(term)
+            display, count = terms.get(term, (word, 0))
+            terms[term] = (display, count + sign)
+
+
+# Apply differences of counts, as counted by count_rows, to counts. Returns
+# the (display, count) before and after of each key changed, None when not
+# counted.
+def apply_counts(counts, differences):
+    changes = {}
+    for key, (display, difference) in differences.items():
+        if not difference:
+            continue
+        old = counts.get(key)
+        count = (old[1] if old else 0) + difference
+        if count > 0:
+            new = counts[key] = (old[0] if old else display, count)
+        else:
+            new = None
+            counts.pop(key, None)
+        changes[key] = (old, new)
+    return changes
+
+
+# Background thread keeping the suggestions of this process current. Until
+# they are first built, lookups return no suggestions.
+class Autocompleter:
+    def __init__(self, interval=AUTOCOMPLETE_INTERVAL, max_bytes=AUTOCOMPLETE_MAX_BYTES):
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.index = AutocompleteIndex({}, {}, max_bytes)
+        # Counts of every researcher and term, including those left out of
+        # the index by the memory budget
+        self.names = {}
+        self.terms = {}
+        self.state = {}
+        self._refresh_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='autocompleter', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # Check for changes now instead of at the next interval
+    def wake(self):
+        self._wake.set()
+
+    def suggest(self, query, limit):
+        return self.index.suggest(query, limit)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Autocomplete update failed")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    # Bring the suggestions up to date with the database. Returns True if
+    # anything changed.
+    def refresh(self):
+        with self._refresh_lock, reader_connection() as conn:
+            cursor = conn.cursor()
+            if self.state.get('generation') == get_generation(cursor):
+                return False
+
+            state = dict(self.state)
+            cursor.execute("BEGIN")
+            try:
+                state['generation'] = get_generation(cursor)
+                deletion_mark = get_deletion_mark(cursor)
+                deleted = deletion_mark - state.get('deletion_mark', deletion_mark)
+                state['deletion_mark'] = deletion_mark
+                rebuild = not self.state
+                removed = []
+                if deleted and not rebuild:
+                    cursor.execute("""
+                    SELECT d.title, r.full_name, d.publication_id
+                    FROM publication_deletions d
+                    LEFT JOIN researchers r ON d.researcher_id = r.id
+                    WHERE d.seq > ?
+                    """, (self.state['deletion_mark'],))
+                    logged = cursor.fetchall()
+                    # Deletions pruned from the log, or logged without their
+                    # title, cannot be subtracted
+                    rebuild = len(logged) < deleted or \
+                        any(title is None or full_name is None for title, full_name, _ in logged)
+                    # Publications deleted before they were counted in are
+                    # not subtracted
+                    removed = [row for row in logged if row[2] <= state['high_water_mark']]
+                # Differences of counts, or the counts on a rebuild
+                names, terms = {}, {}
+                if rebuild:
+                    removed = []
+                    state['high_water_mark'] = 0
+                else:
+                    count_rows(removed, names, terms, -1)
+
+                cursor.execute("""
+                SELECT p.title, r.full_name, p.id
+                FROM publications p
+                JOIN researchers r ON p.researcher_id = r.id
+                WHERE p.id > ?
+                ORDER BY p.id
+                """, (state['high_water_mark'],))
+                added = 0
+                while True:
+                    rows = cursor.fetchmany(10000)
+                    if not rows:
+                        break
+                    count_rows(rows, names, terms)
+                    added += len(rows)
+                    state['high_water_mark'] = rows[-1][2]
+            finally:
+                conn.rollback()
+
+            if rebuild:
+                self.index = AutocompleteIndex(names, terms, self.max_bytes)
+                self.names, self.terms = names, terms
+            else:
+                name_changes = apply_counts(self.names, names)
+                term_changes = apply_counts(self.terms, terms)
+                if name_changes or term_changes:
+                    index = self.index.merged(name_changes, term_changes, self.max_bytes)
+                    self.index = index or AutocompleteIndex(self.names, self.terms, self.max_bytes)
+            # Keep the deletions not read yet in the log. The backend
+            # processes share the mark, so one refreshing late may find its
+            # deletions pruned, and rebuild.
+            if self.state.get('deletion_mark') != deletion_mark:
+                record_deletion_mark('autocomplete', deletion_mark)
+            self.state = state
+        logger.info("Autocomplete %s: %d publications added, %d removed, %d researcher keys and %d terms in %d bytes",
+                    "rebuilt" if rebuild else "updated", added, len(removed), len(self.index.names),
+                    len(self.index.terms), self.index.size)
+        return True
@@ -0,0 +1,290 @@
+# Synthetic corpus generator and performance benchmarks. Run from the
+# backend directory:
+#
+#     python -m benchmarks corpus DIR --publications N [--seed 0]
+#                                 [--min-publications 5] [--max-publications 2000]
+#     python -m benchmarks run [--scales 10000,1000000,10000000] [--ingest-publications 100000]
+#                              [--queries 100] [--seed 0] [--output results.json]
+#
+# `run` prints one JSON document with parse throughput, ingest throughput,
+# search latency percentiles at every scale and peak memory, plus the commit
+# it ran on, so results can be compared across commits.
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import database
+from benchmarks.corpus import generate_cv, generate_cv_data, corpus_plan, write_corpus, TITLE_WORDS, LAST_NAMES
+from lattes_parser import parse_lattes_xml, Publication
+from text_utils import normalize_text
+
+# Publications per CV of the parse benchmark size classes, from a few KB to
+# tens of MB of XML
+_PARSE_SIZES = {'small': 10, 'medium': 300, 'large': 5000, 'huge': 20000}
+
+# Bytes of XML parsed per size class
+_PARSE_BYTES = 32 * 1024 * 1024
+
+# Rows of the first page of a search, as shown by the frontend
+_PAGE_SIZE = 20
+
+# Publication kinds of the generated CV data, as stored
+_KINDS = (('articles', 'article'), ('books', 'book'), ('chapters', 'chapter'), ('events', 'conference'))
+
+
+def _peak_memory():
+    if resource is None:
+        return {}
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 2 ** 20, 1),
+        'peak_rss_children_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 2 ** 20, 1),
+    }
+
+
+def _percentiles(times):
+    times = sorted(t * 1000 for t in times)
+
+    def percentile(p):
+        return round(times[min(len(times) - 1, int(p / 100 * len(times)))], 3)
+
+    return {
+        'count': len(times),
+        'p50_ms': percentile(50),
+        'p90_ms': percentile(90),
+        'p99_ms': percentile(99),
+        'max_ms': round(times[-1], 3),
+        'mean_ms': round(sum(times) / len(times), 3),
+    }
+
+
+def _environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+# Single-process parse throughput of every CV size class, and the peak
+# memory allocated while parsing the largest CV
+def bench_parse(seed):
+    results = {}
+    for size, publications in _PARSE_SIZES.items():
+        content = generate_cv(seed, publications, publications)
+        repeat = max(1, _PARSE_BYTES // len(content))
+        started = time.perf_counter()
+        for _ in range(repeat):
+            parse_lattes_xml(content)
+        elapsed = time.perf_counter() - started
+        results[size] = {
+            'publications_per_cv': publications,
+            'cv_bytes': len(content),
+            'cvs': repeat,
+            'mb_per_second': round(len(content) * repeat / elapsed / 2 ** 20, 2),
+            'publications_per_second': round(publications * repeat / elapsed),
+        }
+
+    tracemalloc.start()
+    parse_lattes_xml(content)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results['huge']['peak_alloc_mb'] = round(peak / 2 ** 20, 2)
+    return results
+
+
+# Point the backend at a fresh database file
+def _use_database(path):
+    database.close_connections()
+    database.DB_PATH = path
+    os.environ['LATTES_DB'] = path
+
+
+# Bulk-load a corpus written to disk, then load it again, when every file
+# is skipped as unchanged
+def bench_ingest(workdir, total_publications, seed):
+    from bulk_load import bulk_load
+
+    corpus_dir = os.path.join(workdir, 'corpus')
+    files, publications = write_corpus(corpus_dir, total_publications, seed)
+    corpus_bytes = sum(entry.stat().st_size for entry in os.scandir(corpus_dir))
+    _use_database(os.path.join(workdir, 'ingest.db'))
+
+    started = time.perf_counter()
+    writer = bulk_load([corpus_dir])
+    elapsed = time.perf_counter() - started
+
+    started = time.perf_counter()
+    bulk_load([corpus_dir])
+    reload_elapsed = time.perf_counter() - started
+
+    shutil.rmtree(corpus_dir)
+    return {
+        'files': files,
+        'publications': publications,
+        'corpus_mb': round(corpus_bytes / 2 ** 20, 1),
+        'rows_inserted': writer.publications_added,
+        'seconds': round(elapsed, 3),
+        'files_per_second': round(files / elapsed, 1),
+        'rows_per_second': round(writer.publications_added / elapsed),
+        'mb_per_second': round(corpus_bytes / elapsed / 2 ** 20, 2),
+        'unchanged_reload_seconds': round(reload_elapsed, 3),
+        'unchanged_files_per_second': round(files / reload_elapsed, 1),
+        **_peak_memory(),
+    }
+
+
+# Fill the current database with a corpus of the given size, written
+# directly by the BatchWriter (without rendering and parsing XML, which
+# bench_ingest measures)
+def _populate(total_publications, seed):
+    from ingest import BatchWriter
+
+    database.init_db()
+    writer = BatchWriter()
+    started = time.perf_counter()
+    try:
+        for index, count in corpus_plan(total_publications, seed):
+            data = generate_cv_data(seed, index, count)
+            publications = [Publication(p['title'], kind, p['year'], p['doi'] or None, p['venue'])
+                            for key, kind in _KINDS for p in data[key]]
+            writer.write(data['name'], publications)
+        writer.commit()
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - started
+    return {
+        'researchers': writer.researchers_added,
+        'rows_inserted': writer.publications_added,
+        'build_seconds': round(elapsed, 3),
+        'build_rows_per_second': round(writer.publications_added / elapsed),
+    }
+
+
+# Deterministic search workload: (kind, endpoint, query) triples
+def _queries(count, seed):
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        word = rng.choice(TITLE_WORDS)
+        queries.append(('fts_word', 'search', rng.choice([word, normalize_text(word)])))
+        queries.append(('fts_two_words', 'search', f"{word} {rng.choice(TITLE_WORDS)}"))
+        queries.append(('fts_prefix', 'search', word[:4]))
+        queries.append(('author', 'author', rng.choice(LAST_NAMES)[:5]))
+    # Substring search scans every title, so it gets fewer queries
+    for _ in range(max(1, count // 5)):
+        queries.append(('substring', 'substring', rng.choice(TITLE_WORDS)))
+    return queries
+
+
+# Latency of the first page of every search kind, bypassing the result cache
+def bench_search(query_count, seed):
+    from main import _title_search_sql, _author_search_sql, _search_page
+
+    times = {}
+    with database.reader_connection() as conn:
+        cursor = conn.cursor()
+        for kind, endpoint, query in _queries(query_count, seed):
+            if endpoint == 'author':
+                sql, params = _author_search_sql(query)
+            else:
+                sql, params = _title_search_sql(query, 'substring' if endpoint == 'substring' else 'fts')
+            started = time.perf_counter()
+            _search_page(cursor, sql, params, _PAGE_SIZE)
+            times.setdefault(kind, []).append(time.perf_counter() - started)
+    return {kind: _percentiles(kind_times) for kind, kind_times in times.items()}
+
+
+def run(args):
+    results = {'environment': _environment(), 'parse': bench_parse(args.seed)}
+
+    workdir = tempfile.mkdtemp(prefix='lattes-bench-', dir=args.workdir)
+    try:
+        print("Benchmarking ingestion", file=sys.stderr)
+        results['ingest'] = bench_ingest(workdir, args.ingest_publications, args.seed)
+
+        results['search'] = []
+        for scale in args.scales:
+            print(f"Benchmarking search at {scale} publications", file=sys.stderr)
+            path = os.path.join(workdir, f'search-{scale}.db')
+            _use_database(path)
+            scale_results = {'publications': scale, **_populate(scale, args.seed)}
+            scale_results['database_mb'] = round(os.path.getsize(path) / 2 ** 20, 1)
+            scale_results['latency'] = bench_search(args.queries, args.seed)
+            scale_results.update(_peak_memory())
+            results['search'].append(scale_results)
+            database.close_connections()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+    finally:
+        database.close_connections()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results['memory'] = _peak_memory()
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+def corpus(args):
+    files, publications = write_corpus(args.directory, args.publications, args.seed,
+                                       args.min_publications, args.max_publications)
+    print(f"Wrote {files} CVs with {publications} publications to {args.directory}")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    corpus_parser = commands.add_parser('corpus', help="write a synthetic Lattes XML corpus")
+    corpus_parser.add_argument('directory')
+    corpus_parser.add_argument('--publications', type=int, required=True, help="total publications")
+    corpus_parser.add_argument('--seed', type=int, default=0)
+    corpus_parser.add_argument('--min-publications', type=int, default=5, help="publications of the smallest CVs")
+    corpus_parser.add_argument('--max-publications', type=int, default=2000, help="publications of the largest CVs")
+    corpus_parser.set_defaults(func=corpus)
+
+    run_parser = commands.add_parser('run', help="run the benchmark suite")
+    run_parser.add_argument('--scales', default='10000,1000000',
+                            type=lambda value: [int(scale) for scale in value.split(',')],
+                            help="comma-separated publication counts for the search benchmark")
+    run_parser.add_argument('--ingest-publications', type=int, default=100000,
+                            help="publications of the corpus for the ingest benchmark")
+    run_parser.add_argument('--queries', type=int, default=100, help="queries per search kind")
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--workdir', default=None, help="directory for temporary corpora and databases")
+    run_parser.add_argument('--output', default=None, help="also write the results to this file")
+    run_parser.set_defaults(func=run)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
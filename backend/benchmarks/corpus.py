@@ -0,0 +1,249 @@
+import math
+import os
+import random
+from xml.sax.saxutils import quoteattr
+
+# Deterministic generator of synthetic Lattes CVs. Every CV is generated from
+# its own random stream, seeded by the corpus seed and the CV's index, so a
+# CV is the same whatever the size of the corpus or the order of generation.
+
+TITLE_WORDS = (
+    "análise avaliação estudo modelagem simulação otimização desenvolvimento aplicação "
+    "sistemas redes neurais aprendizado máquina dados inteligência artificial computação "
+    "educação ensino aprendizagem escola pública formação professores currículo prática "
+    "saúde pública atenção básica epidemiologia doenças crônicas vigilância nutrição "
+    "população idosos crianças adolescentes mulheres gestantes família comunidade "
+    "políticas sociais gestão administração economia mercado trabalho renda pobreza "
+    "desigualdade região nordeste amazônia cerrado semiárido bacia hidrográfica água "
+    "solo clima mudanças climáticas biodiversidade conservação espécies vegetação "
+    "florestal agricultura produção sustentável energia renovável solar eólica "
+    "biomassa materiais compósitos propriedades mecânicas térmicas síntese caracterização "
+    "nanopartículas catalisadores química orgânica física quântica matemática aplicada "
+    "equações diferenciais métodos numéricos algoritmos grafos otimização combinatória "
+    "linguagem literatura brasileira história cultura identidade memória patrimônio "
+    "arquitetura urbanismo cidade habitação mobilidade urbana transporte segurança "
+    "direito constituição justiça cidadania democracia participação movimentos "
+    "comunicação mídia jornalismo tecnologias digitais informação redes sociais "
+    "psicologia comportamento cognição emoção linguagem desenvolvimento infantil "
+    "genética molecular expressão gênica proteínas células tratamento terapia clínica "
+    "diagnóstico câncer diabetes hipertensão infecção vírus bactérias resistência "
+    "fármacos plantas medicinais extratos atividade antioxidante antimicrobiana"
+).split()
+
+_TITLE_LINKS = ("de", "da", "do", "das", "dos", "em", "e", "para", "com", "na", "no", "sobre")
+
+FIRST_NAMES = (
+    "João José Antônio Francisco Carlos Paulo Pedro Lucas Luiz Marcos Luís Gabriel Rafael "
+    "Daniel Marcelo Bruno Eduardo Felipe Raimundo Rodrigo Maria Ana Francisca Antônia "
+    "Adriana Juliana Márcia Fernanda Patrícia Aline Sandra Camila Amanda Bruna Jéssica "
+    "Letícia Júlia Luciana Vanessa Mariana Gabriela Vitória Beatriz Cecília Conceição Inês"
+).split()
+
+LAST_NAMES = (
+    "Silva Santos Oliveira Souza Rodrigues Ferreira Alves Pereira Lima Gomes Costa "
+    "Ribeiro Martins Carvalho Almeida Lopes Soares Fernandes Vieira Barbosa Rocha Dias "
+    "Nascimento Andrade Moreira Nunes Marques Machado Mendes Freitas Cardoso Ramos "
+    "Gonçalves Santana Teixeira Araújo Magalhães Brandão Conceição Assunção Falcão "
+    "Guimarães Mourão Simões Gusmão Damásio Leão"
+).split()
+
+_JOURNALS = (
+    "Revista Brasileira de Educação", "Cadernos de Saúde Pública", "Ciência & Saúde Coletiva",
+    "Revista de Saúde Pública", "Acta Amazônica", "Química Nova", "Pesquisa Agropecuária Brasileira",
+    "Revista Brasileira de Ciências Sociais", "Educação & Sociedade", "Estudos Avançados",
+    "Revista Árvore", "Ciência Rural", "Psicologia: Reflexão e Crítica", "Revista de Administração Pública",
+)
+
+_EVENTS = (
+    "Congresso Brasileiro de Educação", "Simpósio Brasileiro de Redes de Computadores",
+    "Reunião Anual da SBPC", "Congresso Brasileiro de Saúde Coletiva", "Encontro Nacional de Química",
+    "Simpósio Brasileiro de Banco de Dados", "Congresso Brasileiro de Ciência do Solo",
+    "Encontro da ANPAD", "Congresso Brasileiro de Sociologia", "Jornada de Iniciação Científica",
+)
+
+_PUBLISHERS = ("Editora UFMG", "Editora Fiocruz", "EDUSP", "Editora Unesp", "Cortez", "Vozes", "Atlas")
+
+_CITIES = ("São Paulo", "Rio de Janeiro", "Belo Horizonte", "Brasília", "Recife", "Belém", "Porto Alegre",
+           "Florianópolis", "Goiânia", "Manaus", "Fortaleza", "Salvador", "Curitiba", "Natal")
+
+# Share of the publications of a CV in every kind
+_KIND_SHARES = (
+    ('articles', 0.40),
+    ('events', 0.45),
+    ('books', 0.05),
+    ('chapters', 0.10),
+)
+
+
+def _rng(seed, index):
+    return random.Random(seed * 1000003 + index)
+
+
+def _name(rng):
+    return f"{rng.choice(FIRST_NAMES)} {rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {rng.choice(LAST_NAMES)}"
+
+
+def _title(rng):
+    words = []
+    for _ in range(rng.randint(4, 12)):
+        if words and rng.random() < 0.3:
+            words.append(rng.choice(_TITLE_LINKS))
+        words.append(rng.choice(TITLE_WORDS))
+    return ' '.join(words).capitalize()
+
+
+# Number of publications of a CV, log-uniform between the bounds, so most
+# CVs are small and a few are very large
+def publication_count(seed, index, min_publications=5, max_publications=2000):
+    rng = _rng(seed, -1 - index)
+    low, high = math.log(min_publications), math.log(max_publications)
+    return int(round(math.exp(rng.uniform(low, high))))
+
+
+# Content of one CV: its Lattes id, update date, researcher name and
+# publications by kind. Every publication is a dict with its title, year,
+# DOI (possibly empty), venue and authors. `publications` is the total number
+# of publications, split across kinds.
+def generate_cv_data(seed, index, publications):
+    rng = _rng(seed, index)
+    name = _name(rng)
+    data = {
+        'lattes_id': f"{1000000000000000 + index:016d}",
+        'updated_at': f"{rng.randint(1, 28):02d}{rng.randint(1, 12):02d}{rng.randint(2015, 2024)}",
+        'name': name,
+        'summary': ' '.join(rng.choice(TITLE_WORDS) for _ in range(rng.randint(50, 300))),
+    }
+
+    remaining = publications
+    for position, (kind, share) in enumerate(_KIND_SHARES):
+        count = remaining if position == len(_KIND_SHARES) - 1 else int(round(publications * share))
+        count = min(count, remaining)
+        remaining -= count
+
+        items = []
+        for _ in range(count):
+            year = rng.randint(1990, 2024)
+            authors = [name] + [_name(rng) for _ in range(rng.randint(0, 6))]
+            rng.shuffle(authors)
+            if kind == 'articles':
+                venue = rng.choice(_JOURNALS)
+            elif kind == 'events':
+                venue = rng.choice(_EVENTS)
+            else:
+                venue = rng.choice(_PUBLISHERS)
+            doi = f"10.{rng.randint(1000, 9999)}/{rng.getrandbits(40):x}" if rng.random() < 0.5 else ""
+            items.append({
+                'title': _title(rng),
+                'year': year,
+                'doi': doi,
+                'venue': venue,
+                'city': rng.choice(_CITIES),
+                'authors': authors,
+                'keywords': [rng.choice(TITLE_WORDS) for _ in range(rng.randint(0, 6))],
+            })
+        data[kind] = items
+    return data
+
+
+def _attrs(**attributes):
+    return ' '.join(f'{key.replace("_", "-")}={quoteattr(str(value))}' for key, value in attributes.items())
+
+
+def _authors(publication):
+    return ''.join(
+        f'<AUTORES {_attrs(NOME_COMPLETO_DO_AUTOR=author, NOME_PARA_CITACAO=author.split()[-1].upper(), ORDEM_DE_AUTORIA=order)}/>'
+        for order, author in enumerate(publication['authors'], 1)
+    )
+
+
+def _keywords(publication):
+    keywords = {f'PALAVRA_CHAVE_{i}': word for i, word in enumerate(publication['keywords'], 1)}
+    return f'<PALAVRAS-CHAVE {_attrs(**keywords)}/>' if keywords else ''
+
+
+# Render a CV as Lattes XML, ISO-8859-1 encoded like the platform's exports
+def render_cv(data):
+    parts = [
+        '<?xml version="1.0" encoding="ISO-8859-1" standalone="no" ?>',
+        f'<CURRICULO-VITAE {_attrs(SISTEMA_ORIGEM_XML="LATTES_OFFLINE", NUMERO_IDENTIFICADOR=data["lattes_id"], DATA_ATUALIZACAO=data["updated_at"])}>',
+        f'<DADOS-GERAIS {_attrs(NOME_COMPLETO=data["name"], NOME_EM_CITACOES_BIBLIOGRAFICAS=data["name"].split()[-1].upper(), NACIONALIDADE="B")}>',
+        f'<RESUMO-CV {_attrs(TEXTO_RESUMO_CV_RH=data["summary"])}/>',
+        '<ENDERECO><ENDERECO-PROFISSIONAL NOME-INSTITUICAO-EMPRESA="Universidade Federal"/></ENDERECO>',
+        '</DADOS-GERAIS>',
+        '<PRODUCAO-BIBLIOGRAFICA>',
+    ]
+
+    parts.append('<TRABALHOS-EM-EVENTOS>')
+    for sequence, p in enumerate(data['events'], 1):
+        parts.append(
+            f'<TRABALHO-EM-EVENTOS SEQUENCIA-PRODUCAO="{sequence}">'
+            f'<DADOS-BASICOS-DO-TRABALHO {_attrs(NATUREZA="COMPLETO", TITULO_DO_TRABALHO=p["title"], ANO_DO_TRABALHO=p["year"], PAIS_DO_EVENTO="Brasil", IDIOMA="Português", DOI=p["doi"])}/>'
+            f'<DETALHAMENTO-DO-TRABALHO {_attrs(CLASSIFICACAO_DO_EVENTO="NACIONAL", NOME_DO_EVENTO=p["venue"], CIDADE_DO_EVENTO=p["city"], ANO_DE_REALIZACAO=p["year"])}/>'
+            f'{_authors(p)}{_keywords(p)}</TRABALHO-EM-EVENTOS>'
+        )
+    parts.append('</TRABALHOS-EM-EVENTOS>')
+
+    parts.append('<ARTIGOS-PUBLICADOS>')
+    for sequence, p in enumerate(data['articles'], 1):
+        parts.append(
+            f'<ARTIGO-PUBLICADO SEQUENCIA-PRODUCAO="{sequence}">'
+            f'<DADOS-BASICOS-DO-ARTIGO {_attrs(NATUREZA="COMPLETO", TITULO_DO_ARTIGO=p["title"], ANO_DO_ARTIGO=p["year"], PAIS_DE_PUBLICACAO="Brasil", IDIOMA="Português", DOI=p["doi"])}/>'
+            f'<DETALHAMENTO-DO-ARTIGO {_attrs(TITULO_DO_PERIODICO_OU_REVISTA=p["venue"], VOLUME=p["year"] % 50, PAGINA_INICIAL=1, PAGINA_FINAL=20)}/>'
+            f'{_authors(p)}{_keywords(p)}</ARTIGO-PUBLICADO>'
+        )
+    parts.append('</ARTIGOS-PUBLICADOS>')
+
+    parts.append('<LIVROS-E-CAPITULOS><LIVROS-PUBLICADOS-OU-ORGANIZADOS>')
+    for sequence, p in enumerate(data['books'], 1):
+        parts.append(
+            f'<LIVRO-PUBLICADO-OU-ORGANIZADO SEQUENCIA-PRODUCAO="{sequence}">'
+            f'<DADOS-BASICOS-DO-LIVRO {_attrs(TIPO="LIVRO_PUBLICADO", NATUREZA="TEXTO_INTEGRAL", TITULO_DO_LIVRO=p["title"], ANO=p["year"], DOI=p["doi"])}/>'
+            f'<DETALHAMENTO-DO-LIVRO {_attrs(NUMERO_DE_PAGINAS=200, NOME_DA_EDITORA=p["venue"], CIDADE_DA_EDITORA=p["city"])}/>'
+            f'{_authors(p)}{_keywords(p)}</LIVRO-PUBLICADO-OU-ORGANIZADO>'
+        )
+    parts.append('</LIVROS-PUBLICADOS-OU-ORGANIZADOS><CAPITULOS-DE-LIVROS-PUBLICADOS>')
+    for sequence, p in enumerate(data['chapters'], 1):
+        parts.append(
+            f'<CAPITULO-DE-LIVRO-PUBLICADO SEQUENCIA-PRODUCAO="{sequence}">'
+            f'<DADOS-BASICOS-DO-CAPITULO {_attrs(TIPO="CAPITULO_DE_LIVRO_PUBLICADO", TITULO_DO_CAPITULO_DO_LIVRO=p["title"], ANO=p["year"], DOI=p["doi"])}/>'
+            f'<DETALHAMENTO-DO-CAPITULO {_attrs(TITULO_DO_LIVRO=TITLE_WORDS[p["year"] % len(TITLE_WORDS)].capitalize(), NOME_DA_EDITORA=p["venue"])}/>'
+            f'{_authors(p)}{_keywords(p)}</CAPITULO-DE-LIVRO-PUBLICADO>'
+        )
+    parts.append('</CAPITULOS-DE-LIVROS-PUBLICADOS></LIVROS-E-CAPITULOS>')
+
+    parts.append('</PRODUCAO-BIBLIOGRAFICA>')
+    parts.append('<PRODUCAO-TECNICA><SOFTWARE><DADOS-BASICOS-DO-SOFTWARE TITULO-DO-SOFTWARE="Ferramenta"/></SOFTWARE></PRODUCAO-TECNICA>')
+    parts.append('</CURRICULO-VITAE>')
+    return '\n'.join(parts).encode('iso-8859-1')
+
+
+# Generate one CV as XML bytes
+def generate_cv(seed, index, publications):
+    return render_cv(generate_cv_data(seed, index, publications))
+
+
+# Yield (index, publication count) of the CVs of a corpus holding (at least)
+# the given total number of publications
+def corpus_plan(total_publications, seed=0, min_publications=5, max_publications=2000):
+    index = 0
+    generated = 0
+    while generated < total_publications:
+        count = min(publication_count(seed, index, min_publications, max_publications),
+                    total_publications - generated)
+        yield index, count
+        generated += count
+        index += 1
+
+
+# Write a corpus to a directory, one file per CV. Returns the number of
+# files and publications written.
+def write_corpus(directory, total_publications, seed=0, min_publications=5, max_publications=2000):
+    os.makedirs(directory, exist_ok=True)
+    files = 0
+    publications = 0
+    for index, count in corpus_plan(total_publications, seed, min_publications, max_publications):
+        with open(os.path.join(directory, f'cv-{index:07d}.xml'), 'wb') as f:
+            f.write(generate_cv(seed, index, count))
+        files += 1
+        publications += count
+    return files, publications
@@ -0,0 +1,291 @@
+# Offline bulk loader for Lattes XML files. Run from the backend directory:
+#
+#     python bulk_load.py PATH [PATH ...] [--chunk-size 64] [--commit-files 20000]
+#                         [--checkpoint FILE] [--no-resume]
+#
+# Every PATH may be an XML file (optionally gzip-compressed, .xml.gz), a
+# directory (searched recursively), a glob pattern or a .zip, .tar.gz or
+# .tgz archive. ZIP files found in directories
+# and archives, such as the per-CV ZIPs of Lattes exports, are read too.
+#
+# Files are fingerprinted and parsed across the parsing process pool, read
+# as POST /process-xmls reads uploads (compressed files are decompressed as
+# they are read, never as a whole), and written in order through the same
+# BatchWriter, with the same ingest ledger checks, so both paths produce the
+# same rows. Progress is committed every --commit-files sources and recorded
+# in a checkpoint file; running the same command again resumes after the
+# last commit.
+import argparse
+import collections
+import glob
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+
+from database import init_db, close_connections
+from ingest import (BatchWriter, find_ingested, fingerprint_file, get_parse_pool, shutdown_parse_pool, open_source,
+                    is_ingested, mark_ingested, zip_members, FILE_ERRORS, INGEST_MAX_PENDING)
+from jobs import INGEST_SPOOL_DIR
+from lattes_parser import parse_lattes_xml
+
+# Seconds between two progress reports
+_REPORT_INTERVAL = 5
+
+_XML_SUFFIXES = ('.xml', '.xml.gz')
+
+_ARCHIVE_SUFFIXES = ('.zip', '.tar.gz', '.tgz')
+
+# Archive members read as sources
+_MEMBER_SUFFIXES = _XML_SUFFIXES + ('.zip',)
+
+
+# The sources of one input path, in a deterministic order. A source is the
+# (label, path) of a file read with ingest.open_source:
+#
+#   an XML file on disk, plain or gzip-compressed
+#   a member of a ZIP archive on disk ("archive.zip!member.xml")
+#   a member of a tar archive, copied to the spool directory, as tar
+#   archives can only be read sequentially
+#
+# Sources ending in .zip hold XML files themselves, which are listed by the
+# parsing process. File name suffixes are matched in any case.
+def iter_sources(path, spool):
+    lowered = path.lower()
+    if any(char in path for char in '*?['):
+        for match in sorted(glob.glob(path, recursive=True)):
+            yield from iter_sources(match, spool)
+    elif os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(_XML_SUFFIXES + _ARCHIVE_SUFFIXES):
+                    yield from iter_sources(os.path.join(root, name), spool)
+    elif lowered.endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            members = sorted(info.filename for info in archive.infolist() if not info.is_dir())
+        for member in members:
+            if member.lower().endswith(('.xml', '.zip')):
+                yield (f'{path}!{member}', f'{path}!{member}')
+    elif lowered.endswith(('.tar.gz', '.tgz')):
+        with tarfile.open(path, 'r|*') as archive:
+            for member in archive:
+                suffix = next((suffix for suffix in _MEMBER_SUFFIXES if member.name.lower().endswith(suffix)), None)
+                if member.isfile() and suffix is not None:
+                    fd, spooled = tempfile.mkstemp(suffix=suffix, dir=spool)
+                    with os.fdopen(fd, 'wb') as out:
+                        shutil.copyfileobj(archive.extractfile(member), out)
+                    yield (f'{path}!{member.name}', spooled)
+    elif lowered.endswith(_XML_SUFFIXES):
+        yield (path, path)
+
+
+# Remove the spooled copy of a tar archive member once its source is done
+def _remove_spooled(path, spool):
+    if os.path.dirname(path) == spool:
+        os.remove(path)
+
+
+# Fingerprint the XML files of a chunk of sources in a parsing process.
+# Returns, for every source, a list of (label, path, fingerprint, error).
+def fingerprint_chunk(sources):
+    fingerprinted = []
+    for label, path in sources:
+        files = []
+        for name, file_path in zip_members(label, path) if path.lower().endswith('.zip') else [(label, path)]:
+            try:
+                files.append((name, file_path, fingerprint_file(file_path), None))
+            except FILE_ERRORS as e:
+                files.append((name, file_path, None, str(e)))
+        fingerprinted.append(files)
+    return fingerprinted
+
+
+# Parse XML files in a parsing process. Returns the (parsed, error) of each.
+def parse_chunk(paths):
+    results = []
+    for path in paths:
+        try:
+            with open_source(path) as f:
+                results.append((parse_lattes_xml(f), None))
+        except FILE_ERRORS as e:
+            results.append((None, str(e)))
+    return results
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _load_checkpoint(path, inputs):
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return 0
+    if checkpoint.get('inputs') != inputs:
+        sys.exit(f"Checkpoint {path} belongs to another set of inputs; remove it or pass --no-resume")
+    return checkpoint['sources_done']
+
+
+def _save_checkpoint(path, inputs, sources_done):
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'inputs': inputs, 'sources_done': sources_done}, f)
+    os.replace(path + '.tmp', path)
+
+
+class _Stats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.last_report = self.started
+        self.files = 0
+        self.skipped = 0
+        self.errors = 0
+        self.publications = 0
+
+    def report(self, writer, final=False):
+        now = time.perf_counter()
+        if not final and now - self.last_report < _REPORT_INTERVAL:
+            return
+        self.last_report = now
+        elapsed = max(now - self.started, 1e-9)
+        print(f"{self.files} files ({self.skipped} unchanged, {self.errors} failed), "
+              f"{writer.researchers_added} researchers and {writer.publications_added} publications added, "
+              f"{writer.publications_removed} removed, {writer.publications_updated} updated; "
+              f"{self.files / elapsed:.1f} files/s, {self.publications / elapsed:.0f} publications/s",
+              file=sys.stderr)
+
+
+def bulk_load(inputs, chunk_size=64, commit_files=20000, checkpoint=None, resume=True):
+    init_db()
+    sources_done = _load_checkpoint(checkpoint, inputs) if checkpoint and resume else 0
+    if sources_done:
+        print(f"Resuming after {sources_done} sources", file=sys.stderr)
+
+    # Tar archive members are copied here until their source is written
+    spool = tempfile.mkdtemp(prefix='lattes-bulk-', dir=INGEST_SPOOL_DIR)
+    sources = (source for path in inputs for source in iter_sources(path, spool))
+
+    pool = get_parse_pool()
+    writer = BatchWriter()
+    stats = _Stats()
+    # Chunks of sources being fingerprinted, then being parsed
+    fingerprinting = collections.deque()
+    pending = collections.deque()
+
+    # Files already seen in this run, which the ledger does not show until
+    # committed
+    seen_hashes = set()
+    seen_dates = {}
+    uncommitted = 0
+
+    # Look the files of the oldest fingerprinted chunk up in the ingest
+    # ledger, as ingest.ingest_files does, and parse those not ingested
+    def parse_next():
+        chunk, future = fingerprinting.popleft()
+        fingerprinted = future.result()
+        known_hashes, latest_dates = find_ingested([
+            fingerprint for files in fingerprinted for _, _, fingerprint, _ in files if fingerprint is not None
+        ])
+        paths = []
+        for files in fingerprinted:
+            for i, (label, path, fingerprint, error) in enumerate(files):
+                parse = error is None and not is_ingested(fingerprint, known_hashes, latest_dates) and \
+                    not is_ingested(fingerprint, seen_hashes, seen_dates)
+                if parse:
+                    mark_ingested(fingerprint, seen_hashes, seen_dates)
+                    paths.append(path)
+                files[i] = (label, fingerprint, error, parse)
+        pending.append((chunk, fingerprinted, pool.submit(parse_chunk, paths)))
+
+    def write_next():
+        nonlocal sources_done, uncommitted
+        chunk, fingerprinted, future = pending.popleft()
+        parsed_files = iter(future.result())
+        for (_, path), files in zip(chunk, fingerprinted):
+            for label, fingerprint, error, parse in files:
+                stats.files += 1
+                if parse:
+                    parsed, error = next(parsed_files)
+                if error is not None:
+                    stats.errors += 1
+                    print(f"{label}: {error}", file=sys.stderr)
+                    continue
+                if not parse:
+                    stats.skipped += 1
+                    continue
+
+                full_name, publications = parsed
+                writer.write(full_name, publications, fingerprint)
+                stats.publications += len(publications)
+
+            _remove_spooled(path, spool)
+            sources_done += 1
+            uncommitted += 1
+            if uncommitted >= commit_files:
+                writer.commit()
+                uncommitted = 0
+                if checkpoint:
+                    _save_checkpoint(checkpoint, inputs, sources_done)
+        stats.report(writer)
+
+    try:
+        for _ in range(sources_done):
+            source = next(sources, None)
+            if source is not None:
+                _remove_spooled(source[1], spool)
+        for chunk in _chunks(sources, chunk_size):
+            fingerprinting.append((chunk, pool.submit(fingerprint_chunk, chunk)))
+            if len(fingerprinting) >= INGEST_MAX_PENDING:
+                parse_next()
+            if len(pending) >= INGEST_MAX_PENDING:
+                write_next()
+        while fingerprinting:
+            parse_next()
+        while pending:
+            write_next()
+        writer.commit()
+    finally:
+        for _, future in fingerprinting:
+            future.cancel()
+        for _, _, future in pending:
+            future.cancel()
+        writer.close()
+        shutdown_parse_pool()
+        close_connections()
+        shutil.rmtree(spool, ignore_errors=True)
+
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    stats.report(writer, final=True)
+    return writer
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bulk_load.py', description="Load Lattes XML files into the database")
+    parser.add_argument('inputs', nargs='+', metavar='PATH',
+                        help="XML file, directory, glob pattern, or .zip/.tar.gz archive")
+    parser.add_argument('--chunk-size', type=int, default=64, help="sources read per parsing task")
+    parser.add_argument('--commit-files', type=int, default=20000, help="sources written per transaction")
+    parser.add_argument('--checkpoint', default='bulk_load.checkpoint.json',
+                        help="file recording the progress of the run")
+    parser.add_argument('--no-resume', dest='resume', action='store_false',
+                        help="start over instead of resuming from the checkpoint")
+    args = parser.parse_args()
+
+    bulk_load(args.inputs, args.chunk_size, args.commit_files, args.checkpoint, args.resume)
+
+
+if __name__ == '__main__':
+    main()
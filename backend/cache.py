@@ -0,0 +1,112 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Memory budget of the search result cache, in bytes
+SEARCH_CACHE_MAX_BYTES = int(os.environ.get('SEARCH_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+# Seconds a cached result stays valid
+SEARCH_CACHE_TTL = float(os.environ.get('SEARCH_CACHE_TTL', 300))
+
+# Rough per-row overhead of a result dict, on top of its values
+_ROW_OVERHEAD_BYTES = 200
+
+# Rough overhead of a list item: its slot and the header of its object
+_ITEM_OVERHEAD_BYTES = 60
+
+
+# Approximate memory taken by a cached value: result rows, with their nested
+# lists (the researchers of a work), search facets, or tuples of these.
+# Only strings and containers are counted; numbers are in the overheads.
+def estimate_size(value):
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict):
+        return _ROW_OVERHEAD_BYTES + sum(estimate_size(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_ITEM_OVERHEAD_BYTES + estimate_size(item) for item in value)
+    return 0
+
+
+# Bounded in-process cache of search results.
+#
+# Entries are evicted in least-recently-used order once the estimated size
+# of all entries exceeds max_bytes, and expire after ttl seconds. Every entry
+# remembers the data generation it was computed at; looking it up with a
+# different generation invalidates it, so results are never served from
+# before an ingest.
+class ResultCache:
+    def __init__(self, max_bytes=SEARCH_CACHE_MAX_BYTES, ttl=SEARCH_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key, generation):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            entry_generation, expires_at, size, value = entry
+            if entry_generation != generation or expires_at <= time.monotonic():
+                if entry_generation != generation:
+                    self.invalidations += 1
+                else:
+                    self.expirations += 1
+                self._remove(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    # Cache a value; its size is estimated when not given
+    def put(self, key, generation, value, size=None):
+        if size is None:
+            size = estimate_size(value)
+        # A single result larger than a quarter of the budget would flush
+        # most of the cache for little benefit
+        if size > self.max_bytes // 4:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (generation, time.monotonic() + self.ttl, size, value)
+            self.size_bytes += size
+
+            while self.size_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def _remove(self, key):
+        self.size_bytes -= self._entries.pop(key)[2]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self.size_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
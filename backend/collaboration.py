@@ -0,0 +1,378 @@
+import logging
+import os
+import threading
+
+import numpy as np
+
+from database import get_deletion_mark, get_generation, reader_connection, record_deletion_mark
+
+logger = logging.getLogger(__name__)
+
+# Graph of the researchers who share works (see works.py), kept in memory.
+#
+# The graph is stored in compressed sparse row (CSR) form, indexed by
+# researcher id: the collaborators of researcher i are
+# indices[indptr[i]:indptr[i + 1]], with the number of works they share in
+# the same range of weights, most shared first. Finding the top
+# collaborators of a researcher is a slice, and paths between researchers
+# are found by a breadth-first search run from both ends over the arrays.
+#
+# A background thread builds the graph once and then, after every ingest,
+# merges the pairs of researchers of the works that got publications since
+# a high-water mark. The researchers of deleted publications, read from the
+# deletion log, get their rows counted again from the database, and the
+# edges pointing to them replaced. The whole graph is rebuilt instead once
+# deletions exceed COLLABORATION_REBUILD_RATIO of the publications counted,
+# when the log no longer has the deletions since the last refresh, and once
+# the publications stored before works existed have been assigned one.
+
+# Seconds between two checks for new or deleted publications
+COLLABORATION_INTERVAL = float(os.environ.get('COLLABORATION_INTERVAL', 5))
+
+# Rebuild once deleted publications exceed this fraction of those counted
+COLLABORATION_REBUILD_RATIO = float(os.environ.get('COLLABORATION_REBUILD_RATIO', 0.1))
+
+# Maximum collaborators per lookup
+COLLABORATION_MAX_LIMIT = 1000
+
+# (work, researcher) rows read from the database at a time
+_FETCH_ROWS = 100000
+
+# Maximum number of researchers looked up per SELECT ... IN (...) statement
+_LOOKUP_CHUNK = 500
+
+
+# Sum the weights of equal edge keys. Keys are source << 32 | target.
+def _sum_edges(keys, weights):
+    if not len(keys):
+        return keys, weights
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts], np.add.reduceat(weights[order], starts)
+
+
+# Edge keys of the pairs of researchers of the same work, in both
+# directions, given (work_id, researcher_id, new) arrays sorted by work. A
+# researcher is in a work at most once. Only pairs with a new publication
+# are kept, so that works already counted can be read again.
+def _work_pairs(works, researchers, new):
+    starts = np.flatnonzero(np.concatenate(([True], works[1:] != works[:-1])))
+    sizes = np.diff(np.append(starts, len(works)))
+    # Every row is paired with every row of its work, itself included
+    row_sizes = np.repeat(sizes, sizes)
+    offsets = np.cumsum(row_sizes) - row_sizes
+    sources = np.repeat(np.arange(len(works)), row_sizes)
+    targets = np.repeat(np.repeat(starts, sizes) - offsets, row_sizes) + np.arange(int(row_sizes.sum()))
+    keep = (sources != targets) & (new[sources] | new[targets])
+    sources = researchers[sources[keep]]
+    targets = researchers[targets[keep]]
+    return _sum_edges((sources << 32) | targets, np.ones(len(sources), dtype=np.int64))
+
+
+# Immutable snapshot of the graph, swapped whole on every refresh so
+# lookups need no lock. size is the number of researcher ids (the largest
+# plus one).
+class CollaborationGraph:
+    def __init__(self, indices, weights, indptr):
+        self.indices = indices
+        self.weights = weights
+        self.indptr = indptr
+
+    # Graph of summed edge keys and weights
+    @classmethod
+    def from_edges(cls, keys, weights, size):
+        sources = (keys >> 32).astype(np.int64)
+        targets = (keys & 0xffffffff).astype(np.int32)
+        order = np.lexsort((targets, -weights, sources))
+        indptr = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=size), out=indptr[1:])
+        return cls(targets[order], weights[order].astype(np.int32), indptr)
+
+    @property
+    def size(self):
+        return len(self.indptr) - 1
+
+    @property
+    def edges(self):
+        return len(self.indices)
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.weights.nbytes + self.indptr.nbytes
+
+    # Graph with summed edge keys and weights added; negative weights remove
+    # collaborations, and edges left with no shared work are dropped. Only
+    # the rows of the researchers with changed edges are sorted again; the
+    # others are moved.
+    def merged(self, keys, weights, size):
+        affected = np.unique(keys >> 32)
+        old = affected[affected < self.size]
+        counts = self.indptr[old + 1] - self.indptr[old]
+        positions = np.repeat(self.indptr[old] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        old_keys = (np.repeat(old, counts) << 32) | self.indices[positions]
+        changed_keys, changed_weights = _sum_edges(np.concatenate((old_keys, keys)),
+                                                   np.concatenate((self.weights[positions], weights)))
+        shared = changed_weights > 0
+        changed = CollaborationGraph.from_edges(changed_keys[shared], changed_weights[shared], size)
+
+        counts = np.zeros(size, dtype=np.int64)
+        counts[:self.size] = np.diff(self.indptr)
+        counts[affected] = np.diff(changed.indptr)[affected]
+        indptr = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        indices = np.empty(indptr[-1], dtype=np.int32)
+        weights = np.empty(indptr[-1], dtype=np.int32)
+
+        # Unchanged rows keep their order, shifted by the rows grown before them
+        kept = np.ones(self.size, dtype=bool)
+        kept[old] = False
+        kept = np.flatnonzero(np.repeat(kept, np.diff(self.indptr)))
+        moved = kept + np.repeat(indptr[:self.size] - self.indptr[:-1], np.diff(self.indptr))[kept]
+        indices[moved] = self.indices[kept]
+        weights[moved] = self.weights[kept]
+
+        counts = np.diff(changed.indptr)[affected]
+        positions = np.repeat(indptr[affected] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        indices[positions] = changed.indices
+        weights[positions] = changed.weights
+        return CollaborationGraph(indices, weights, indptr)
+
+    # Edge keys and weights of the rows of researchers
+    def rows(self, researchers):
+        researchers = researchers[researchers < self.size]
+        counts = self.indptr[researchers + 1] - self.indptr[researchers]
+        positions = np.repeat(self.indptr[researchers] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        return (np.repeat(researchers, counts) << 32) | self.indices[positions], self.weights[positions].astype(np.int64)
+
+    # (researcher id, shared works) of the researcher's top collaborators
+    def collaborators(self, researcher_id, limit):
+        if not 0 <= researcher_id < self.size:
+            return []
+        start = self.indptr[researcher_id]
+        end = min(self.indptr[researcher_id + 1], start + limit)
+        return list(zip(self.indices[start:end].tolist(), self.weights[start:end].tolist()))
+
+    # Neighbors of the frontier, each with the frontier node it was reached from
+    def _expand(self, frontier):
+        starts = self.indptr[frontier]
+        counts = self.indptr[frontier + 1] - starts
+        offsets = np.cumsum(counts) - counts
+        positions = np.repeat(starts - offsets, counts) + np.arange(counts.sum())
+        return self.indices[positions], np.repeat(frontier, counts)
+
+    def _degree(self, frontier):
+        return int((self.indptr[frontier + 1] - self.indptr[frontier]).sum())
+
+    # A shortest path of collaborations between two researchers, as the list
+    # of their ids from source to target, or None if they are not connected.
+    # Each step expands a whole level of the side with the fewest edges to
+    # follow; the first level reaching nodes seen from the other side gives
+    # a shortest path through any of them.
+    def path(self, source, target):
+        if not (0 <= source < self.size and 0 <= target < self.size):
+            return None
+        if source == target:
+            return [source]
+        parents = (np.full(self.size, -1, dtype=np.int32), np.full(self.size, -1, dtype=np.int32))
+        parents[0][source] = source
+        parents[1][target] = target
+        frontiers = [np.array([source], dtype=np.int64), np.array([target], dtype=np.int64)]
+        while len(frontiers[0]) and len(frontiers[1]):
+            side = 0 if self._degree(frontiers[0]) <= self._degree(frontiers[1]) else 1
+            parent = parents[side]
+            neighbors, origins = self._expand(frontiers[side])
+            fresh = parent[neighbors] == -1
+            neighbors, first = np.unique(neighbors[fresh], return_index=True)
+            parent[neighbors] = origins[fresh][first]
+            met = neighbors[parents[1 - side][neighbors] != -1]
+            if len(met):
+                node = int(met[0])
+                return self._walk(parents[0], node)[::-1] + self._walk(parents[1], node)[1:]
+            frontiers[side] = neighbors.astype(np.int64)
+        return None
+
+    # Node ids from a node back to the root of its search
+    @staticmethod
+    def _walk(parent, node):
+        nodes = [node]
+        while parent[node] != node:
+            node = int(parent[node])
+            nodes.append(node)
+        return nodes
+
+
+# Background thread keeping the collaboration graph of this process
+# current. Until it is first built, graph is None.
+class Collaborations:
+    def __init__(self, interval=COLLABORATION_INTERVAL, rebuild_ratio=COLLABORATION_REBUILD_RATIO):
+        self.interval = interval
+        self.rebuild_ratio = rebuild_ratio
+        self.graph = None
+        self.state = {}
+        self._refresh_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='collaborations', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # Check for changes now instead of at the next interval
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Collaboration graph update failed")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    # Bring the graph up to date with the database. Returns True if
+    # anything changed.
+    def refresh(self):
+        with self._refresh_lock, reader_connection() as conn:
+            cursor = conn.cursor()
+            if self.state.get('generation') == get_generation(cursor):
+                return False
+
+            state = dict(self.state)
+            cursor.execute("BEGIN")
+            try:
+                state['generation'] = get_generation(cursor)
+                deletion_mark = get_deletion_mark(cursor)
+                deleted = deletion_mark - state.get('deletion_mark', deletion_mark)
+                state['deletion_mark'] = deletion_mark
+                cursor.execute("SELECT EXISTS (SELECT 1 FROM publications WHERE work_id IS NULL)")
+                state['unassigned'] = bool(cursor.fetchone()[0])
+                rebuild = not self.state or self.state['unassigned'] or \
+                    state['deleted'] + deleted > self.rebuild_ratio * state['publications']
+                removed = set()
+                if deleted and not rebuild:
+                    cursor.execute("SELECT researcher_id FROM publication_deletions WHERE seq > ?",
+                                   (self.state['deletion_mark'],))
+                    logged = cursor.fetchall()
+                    removed = {researcher_id for researcher_id, in logged}
+                    # Deletions pruned from the log, or logged without their
+                    # researcher, cannot be applied
+                    rebuild = len(logged) < deleted or None in removed
+                if rebuild:
+                    state.update(high_water_mark=0, publications=0, deleted=0)
+                else:
+                    state['deleted'] += deleted
+
+                cursor.execute("SELECT COALESCE(MAX(id), 0) FROM researchers")
+                size = cursor.fetchone()[0] + 1
+                cursor.execute("SELECT COALESCE(MAX(id), 0) FROM publications")
+                high_water_mark = cursor.fetchone()[0]
+
+                # The researchers of the works with publications added since
+                # the high-water mark (all works on a rebuild), work by work
+                if rebuild:
+                    cursor.execute("""
+                    SELECT work_id, researcher_id, 1 FROM publications
+                    WHERE work_id IS NOT NULL ORDER BY work_id
+                    """)
+                else:
+                    cursor.execute("""
+                    SELECT work_id, researcher_id, id > ? FROM publications
+                    WHERE work_id IN (SELECT work_id FROM publications WHERE id > ?) ORDER BY work_id
+                    """, (state['high_water_mark'], state['high_water_mark']))
+                added, keys, weights = self._read_pairs(cursor)
+                if removed and not rebuild:
+                    keys, weights = self._recount(cursor, removed, keys, weights)
+            finally:
+                conn.rollback()
+
+            state['high_water_mark'] = high_water_mark
+            state['publications'] += added
+            if rebuild or len(keys):
+                if rebuild:
+                    self.graph = CollaborationGraph.from_edges(keys, weights, size)
+                else:
+                    self.graph = self.graph.merged(keys, weights, size)
+            # Keep the deletions not read yet in the log. The backend
+            # processes share the mark, so one refreshing late may find its
+            # deletions pruned, and rebuild.
+            if self.state.get('deletion_mark') != deletion_mark:
+                record_deletion_mark('collaboration', deletion_mark)
+            self.state = state
+        logger.info("Collaboration graph %s: %d publications added, %d edges between %d researchers in %d bytes",
+                    "rebuilt" if rebuild else "updated", added, self.graph.edges, self.graph.size, self.graph.nbytes)
+        return True
+
+    # Edge changes replacing the rows of researchers with deleted
+    # publications by their collaborations counted from the database, and
+    # the edges pointing to them likewise, given the new edges to merge. The
+    # new edges of these researchers are dropped, being counted again.
+    def _recount(self, cursor, researchers, keys, weights):
+        researchers = np.array(sorted(researchers), dtype=np.int64)
+        kept = ~(np.isin(keys >> 32, researchers) | np.isin(keys & 0xffffffff, researchers))
+
+        rows = []
+        for start in range(0, len(researchers), _LOOKUP_CHUNK):
+            chunk = researchers[start:start + _LOOKUP_CHUNK].tolist()
+            cursor.execute(f"""
+            SELECT p.researcher_id, o.researcher_id, COUNT(*) FROM publications p
+            JOIN publications o ON o.work_id = p.work_id AND o.researcher_id != p.researcher_id
+            WHERE p.researcher_id IN ({','.join('?' * len(chunk))})
+            GROUP BY p.researcher_id, o.researcher_id
+            """, chunk)
+            rows.extend(cursor.fetchall())
+        counted = np.array(rows, dtype=np.int64).reshape(-1, 3)
+        old_keys, old_weights = self.graph.rows(researchers)
+
+        row_keys = np.concatenate(((counted[:, 0] << 32) | counted[:, 1], old_keys))
+        row_weights = np.concatenate((counted[:, 2], -old_weights))
+        # The rows of the other researchers change by the same edges reversed
+        sources = row_keys >> 32
+        targets = row_keys & 0xffffffff
+        reverse = ~np.isin(targets, researchers)
+        reverse_keys = (targets[reverse] << 32) | sources[reverse]
+        return _sum_edges(np.concatenate((keys[kept], row_keys, reverse_keys)),
+                          np.concatenate((weights[kept], row_weights, row_weights[reverse])))
+
+    # Read (work_id, researcher_id, new) rows ordered by work into summed
+    # edge keys and weights. Returns the number of new publications with them.
+    @staticmethod
+    def _read_pairs(cursor):
+        added = 0
+        parts = []
+        rows = []
+        while True:
+            fetched = cursor.fetchmany(_FETCH_ROWS)
+            rows.extend(fetched)
+            if not rows:
+                break
+            # A work may continue in the next rows, so the last one read is
+            # left for the next round
+            end = len(rows)
+            if fetched:
+                last_work = rows[-1][0]
+                while end and rows[end - 1][0] == last_work:
+                    end -= 1
+                if not end:
+                    continue
+            block = np.array(rows[:end], dtype=np.int64)
+            rows = rows[end:]
+            new = block[:, 2].astype(bool)
+            added += int(new.sum())
+            parts.append(_work_pairs(block[:, 0], block[:, 1], new))
+            if not fetched:
+                break
+        if not parts:
+            return added, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        keys, weights = _sum_edges(np.concatenate([keys for keys, _ in parts]),
+                                   np.concatenate([weights for _, weights in parts]))
+        return added, keys, weights
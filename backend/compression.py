@@ -0,0 +1,81 @@
+import zlib
+
+# Decompression of request bodies sent with Content-Encoding: gzip.
+#
+# Clients on slow links can compress a whole upload (for example the
+# multipart body of POST /process-xmls) instead of every file in it. The
+# body is decompressed as it is received, a bounded chunk at a time, so it
+# is never held in memory whole, compressed or not.
+
+# Maximum bytes of decompressed body passed on at a time
+_CHUNK = 1024 * 1024
+
+
+class _BadBody(Exception):
+    pass
+
+
+# ASGI middleware decompressing gzip-encoded request bodies. Starlette's
+# GZipMiddleware only compresses responses.
+class GzipRequestMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not any(
+                name == b'content-encoding' and value.strip().lower() == b'gzip' for name, value in scope['headers']):
+            await self.app(scope, receive, send)
+            return
+
+        # The body the application sees is no longer encoded, and of unknown
+        # length
+        scope = dict(scope, headers=[(name, value) for name, value in scope['headers']
+                                     if name not in (b'content-encoding', b'content-length')])
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        compressed = b''
+        more_body = True
+
+        async def receive_decompressed():
+            nonlocal decompressor, compressed, more_body
+            while True:
+                if compressed:
+                    if decompressor.eof:
+                        # Data after the end of a gzip member is the next
+                        # member, as in concatenated gzip files
+                        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    try:
+                        body = decompressor.decompress(compressed, _CHUNK)
+                    except zlib.error as e:
+                        raise _BadBody(f"Invalid gzip request body: {e}")
+                    compressed = decompressor.unused_data if decompressor.eof else decompressor.unconsumed_tail
+                    if body:
+                        return {'type': 'http.request', 'body': body, 'more_body': True}
+                elif not more_body:
+                    if not decompressor.eof:
+                        raise _BadBody("Truncated gzip request body")
+                    return {'type': 'http.request', 'body': b'', 'more_body': False}
+                else:
+                    message = await receive()
+                    if message['type'] != 'http.request':
+                        return message
+                    compressed = message.get('body', b'')
+                    more_body = message.get('more_body', False)
+
+        started = False
+
+        async def send_with_start(message):
+            nonlocal started
+            if message['type'] == 'http.response.start':
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive_decompressed, send_with_start)
+        except _BadBody as e:
+            if started:
+                raise
+            body = str(e).encode()
+            await send({'type': 'http.response.start', 'status': 400,
+                        'headers': [(b'content-type', b'text/plain; charset=utf-8'),
+                                    (b'content-length', str(len(body)).encode())]})
+            await send({'type': 'http.response.body', 'body': body})
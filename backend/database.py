@@ -0,0 +1,566 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from metrics import DB_CONNECTION_WAIT_SECONDS
+from text_utils import normalize_text
+
+# Path of the SQLite database file
+DB_PATH = os.environ.get('LATTES_DB', 'lattes.db')
+
+# Number of read-only connections kept open for searches
+DB_READ_POOL_SIZE = int(os.environ.get('DB_READ_POOL_SIZE', 4))
+
+# Seconds a search waits for a free reader connection before failing
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+
+# Milliseconds SQLite waits on a locked database before raising "database is locked"
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+
+# Bytes of the database file accessed through memory mapping
+DB_MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', 256 * 1024 * 1024))
+
+# Page cache size per connection, in KiB
+DB_CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', 64 * 1024))
+
+# The single writer connection of this process and the lock serializing its use
+_writer = None
+_writer_lock = threading.Lock()
+
+# Idle reader connections, and how many have been opened so far
+_readers = queue.Queue()
+_readers_opened = 0
+_readers_lock = threading.Lock()
+
+
+# Settings applied to every connection
+def _configure(conn):
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size = {-DB_CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+
+
+# Take the writer connection, opening it on first use. WAL mode lets the
+# readers keep serving searches while a write transaction is open.
+# The caller must hand it back with release_writer().
+def acquire_writer():
+    global _writer
+    with DB_CONNECTION_WAIT_SECONDS.time('writer'):
+        _writer_lock.acquire()
+    try:
+        if _writer is None:
+            conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode = WAL")
+            _configure(conn)
+            _writer = conn
+    except BaseException:
+        _writer_lock.release()
+        raise
+    return _writer
+
+
+# Give the writer connection back, rolling back anything left uncommitted
+def release_writer():
+    try:
+        if _writer is not None and _writer.in_transaction:
+            _writer.rollback()
+    finally:
+        _writer_lock.release()
+
+
+@contextmanager
+def writer_connection():
+    conn = acquire_writer()
+    try:
+        yield conn
+    finally:
+        release_writer()
+
+
+def _open_reader():
+    conn = sqlite3.connect(f'file:{DB_PATH}?mode=ro', uri=True, check_same_thread=False)
+    _configure(conn)
+    conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+# Borrow a read-only connection from the pool for the duration of the block
+@contextmanager
+def reader_connection():
+    with DB_CONNECTION_WAIT_SECONDS.time('reader'):
+        conn = _take_reader()
+    try:
+        yield conn
+    finally:
+        # Never hand a connection with an open read transaction back to the pool
+        if conn.in_transaction:
+            conn.rollback()
+        _readers.put(conn)
+
+
+# Take an idle reader, opening a new one while the pool is not full, or
+# wait for one to be handed back
+def _take_reader():
+    global _readers_opened
+    try:
+        conn = _readers.get_nowait()
+    except queue.Empty:
+        conn = None
+        with _readers_lock:
+            if _readers_opened < DB_READ_POOL_SIZE:
+                _readers_opened += 1
+                open_new = True
+            else:
+                open_new = False
+        if open_new:
+            try:
+                conn = _open_reader()
+            except BaseException:
+                with _readers_lock:
+                    _readers_opened -= 1
+                raise
+        else:
+            try:
+                conn = _readers.get(timeout=DB_POOL_TIMEOUT)
+            except queue.Empty:
+                raise RuntimeError(f"No database connection available after {DB_POOL_TIMEOUT} seconds")
+    return conn
+
+
+# Close every pooled connection
+def close_connections():
+    global _writer, _readers_opened
+    with _writer_lock:
+        if _writer is not None:
+            _writer.close()
+            _writer = None
+    with _readers_lock:
+        while True:
+            try:
+                _readers.get_nowait().close()
+            except queue.Empty:
+                break
+        _readers_opened = 0
+
+
+# Initialize the database schema
+def init_db():
+    with writer_connection() as conn:
+        _create_schema(conn)
+
+
+def _create_schema(conn):
+    cursor = conn.cursor()
+    
+    # Create researchers table
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS researchers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        full_name TEXT NOT NULL UNIQUE
+    )
+    ''')
+    
+    # Venues (journals, publishers, books and events) of publications, stored
+    # once each as they repeat across many publications
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS venues (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    )
+    ''')
+    
+    # LSH buckets of the works (see works.py): every band of the MinHash
+    # signature of the title of a work's first publication, as a 31-bit hash,
+    # with the work
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS work_bands (
+        band_key INTEGER NOT NULL,
+        work_id INTEGER NOT NULL,
+        PRIMARY KEY (band_key, work_id)
+    ) WITHOUT ROWID
+    ''')
+    
+    # Create publications table with UNIQUE constraint. Besides the title,
+    # publications have the metadata read from the CV: kind (article, book,
+    # chapter or conference), year, DOI and venue, NULL when missing. The
+    # publications of a paper in the CVs of its different authors are one
+    # work, identified by the id of the first of them to be stored.
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS publications (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT NOT NULL,
+        researcher_id INTEGER,
+        kind TEXT,
+        year INTEGER,
+        doi TEXT,
+        venue_id INTEGER,
+        work_id INTEGER,
+        FOREIGN KEY (researcher_id) REFERENCES researchers (id),
+        FOREIGN KEY (venue_id) REFERENCES venues (id),
+        UNIQUE(title, researcher_id)
+    )
+    ''')
+    
+    # Databases created before the metadata columns existed get them added
+    # empty. Their ingest ledger is then cleared (below), so uploading the
+    # same files again fills them in.
+    cursor.execute("PRAGMA table_info(publications)")
+    publication_columns = [column[1] for column in cursor.fetchall()]
+    metadata_added = False
+    for column, column_type in (('kind', 'TEXT'), ('year', 'INTEGER'), ('doi', 'TEXT'), ('venue_id', 'INTEGER')):
+        if column not in publication_columns:
+            cursor.execute(f"ALTER TABLE publications ADD COLUMN {column} {column_type}")
+            metadata_added = True
+    
+    # Publications stored before works existed get one on the next ingest
+    if 'work_id' not in publication_columns:
+        cursor.execute("ALTER TABLE publications ADD COLUMN work_id INTEGER")
+    
+    # Create the full-text index over publication titles. It is an external
+    # content table, so only the index is stored, and diacritics are removed
+    # so that "educacao" also matches "educação".
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'publications_fts'")
+    fts_exists = cursor.fetchone() is not None
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS publications_fts USING fts5(
+        title,
+        content='publications',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )
+    ''')
+    
+    # Keep the full-text index in sync with the publications table
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS publications_fts_insert AFTER INSERT ON publications BEGIN
+        INSERT INTO publications_fts (rowid, title) VALUES (new.id, new.title);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS publications_fts_delete AFTER DELETE ON publications BEGIN
+        INSERT INTO publications_fts (publications_fts, rowid, title) VALUES ('delete', old.id, old.title);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS publications_fts_update AFTER UPDATE OF title ON publications BEGIN
+        INSERT INTO publications_fts (publications_fts, rowid, title) VALUES ('delete', old.id, old.title);
+        INSERT INTO publications_fts (rowid, title) VALUES (new.id, new.title);
+    END
+    ''')
+    
+    # Index the publications stored before the full-text index existed
+    if not fts_exists:
+        cursor.execute("INSERT INTO publications_fts (publications_fts) VALUES ('rebuild')")
+    
+    # Index publications by researcher, used when listing an author's publications
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_publications_researcher ON publications (researcher_id)")
+    
+    # Index publications by work, with their researcher, used when listing
+    # the researchers of works and when assigning new publications to works
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_publications_work ON publications (work_id, researcher_id)")
+    
+    # Indexes for the search filters. DOIs and venues are often missing, so
+    # only the publications that have them are indexed.
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_publications_year ON publications (year)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_publications_kind_year ON publications (kind, year)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_publications_doi ON publications (doi) WHERE doi IS NOT NULL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_publications_venue ON publications (venue_id) "
+                   "WHERE venue_id IS NOT NULL")
+    
+    # Publication counts per researcher, year and kind, and per year and
+    # kind, maintained by triggers so search facets are summed from them
+    # instead of counting publications. An unknown year is stored as 0 and
+    # an unknown kind as ''.
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'publication_counts'")
+    counts_exist = cursor.fetchone() is not None
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS publication_counts (
+        researcher_id INTEGER NOT NULL,
+        year INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (researcher_id, year, kind)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS publication_year_counts (
+        year INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (year, kind)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS publication_counts_insert AFTER INSERT ON publications BEGIN
+        INSERT INTO publication_counts (researcher_id, year, kind, count)
+        VALUES (IFNULL(new.researcher_id, 0), IFNULL(new.year, 0), IFNULL(new.kind, ''), 1)
+        ON CONFLICT (researcher_id, year, kind) DO UPDATE SET count = count + 1;
+        INSERT INTO publication_year_counts (year, kind, count)
+        VALUES (IFNULL(new.year, 0), IFNULL(new.kind, ''), 1)
+        ON CONFLICT (year, kind) DO UPDATE SET count = count + 1;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS publication_counts_delete AFTER DELETE ON publications BEGIN
+        UPDATE publication_counts SET count = count - 1
+        WHERE researcher_id = IFNULL(old.researcher_id, 0) AND year = IFNULL(old.year, 0) AND kind = IFNULL(old.kind, '');
+        DELETE FROM publication_counts
+        WHERE researcher_id = IFNULL(old.researcher_id, 0) AND year = IFNULL(old.year, 0) AND kind = IFNULL(old.kind, '')
+        AND count = 0;
+        UPDATE publication_year_counts SET count = count - 1
+        WHERE year = IFNULL(old.year, 0) AND kind = IFNULL(old.kind, '');
+        DELETE FROM publication_year_counts
+        WHERE year = IFNULL(old.year, 0) AND kind = IFNULL(old.kind, '') AND count = 0;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS publication_counts_update AFTER UPDATE OF researcher_id, year, kind ON publications BEGIN
+        UPDATE publication_counts SET count = count - 1
+        WHERE researcher_id = IFNULL(old.researcher_id, 0) AND year = IFNULL(old.year, 0) AND kind = IFNULL(old.kind, '');
+        DELETE FROM publication_counts
+        WHERE researcher_id = IFNULL(old.researcher_id, 0) AND year = IFNULL(old.year, 0) AND kind = IFNULL(old.kind, '')
+        AND count = 0;
+        UPDATE publication_year_counts SET count = count - 1
+        WHERE year = IFNULL(old.year, 0) AND kind = IFNULL(old.kind, '');
+        DELETE FROM publication_year_counts
+        WHERE year = IFNULL(old.year, 0) AND kind = IFNULL(old.kind, '') AND count = 0;
+        INSERT INTO publication_counts (researcher_id, year, kind, count)
+        VALUES (IFNULL(new.researcher_id, 0), IFNULL(new.year, 0), IFNULL(new.kind, ''), 1)
+        ON CONFLICT (researcher_id, year, kind) DO UPDATE SET count = count + 1;
+        INSERT INTO publication_year_counts (year, kind, count)
+        VALUES (IFNULL(new.year, 0), IFNULL(new.kind, ''), 1)
+        ON CONFLICT (year, kind) DO UPDATE SET count = count + 1;
+    END
+    ''')
+    
+    # Count the publications stored before the counts existed
+    if not counts_exist:
+        cursor.execute('''
+        INSERT INTO publication_counts (researcher_id, year, kind, count)
+        SELECT IFNULL(researcher_id, 0), IFNULL(year, 0), IFNULL(kind, ''), COUNT(*)
+        FROM publications GROUP BY 1, 2, 3
+        ''')
+        cursor.execute('''
+        INSERT INTO publication_year_counts (year, kind, count)
+        SELECT year, kind, SUM(count) FROM publication_counts GROUP BY year, kind
+        ''')
+    
+    # Accent- and case-folded researcher names, filled in at ingest.
+    # Databases created before the column existed are backfilled here.
+    cursor.execute("PRAGMA table_info(researchers)")
+    if 'normalized_name' not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE researchers ADD COLUMN normalized_name TEXT")
+    cursor.execute("SELECT id, full_name FROM researchers WHERE normalized_name IS NULL")
+    cursor.executemany("UPDATE researchers SET normalized_name = ? WHERE id = ?",
+                       [(normalize_text(full_name), researcher_id) for researcher_id, full_name in cursor.fetchall()])
+    
+    # Trigram index over the normalized names, so substring queries on
+    # author names are answered from the index instead of a table scan
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'researchers_trigram'")
+    trigram_exists = cursor.fetchone() is not None
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS researchers_trigram USING fts5(
+        normalized_name,
+        content='researchers',
+        content_rowid='id',
+        tokenize='trigram'
+    )
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS researchers_trigram_insert AFTER INSERT ON researchers BEGIN
+        INSERT INTO researchers_trigram (rowid, normalized_name) VALUES (new.id, new.normalized_name);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS researchers_trigram_delete AFTER DELETE ON researchers BEGIN
+        INSERT INTO researchers_trigram (researchers_trigram, rowid, normalized_name)
+        VALUES ('delete', old.id, old.normalized_name);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS researchers_trigram_update AFTER UPDATE OF normalized_name ON researchers BEGIN
+        INSERT INTO researchers_trigram (researchers_trigram, rowid, normalized_name)
+        VALUES ('delete', old.id, old.normalized_name);
+        INSERT INTO researchers_trigram (rowid, normalized_name) VALUES (new.id, new.normalized_name);
+    END
+    ''')
+    if not trigram_exists:
+        cursor.execute("INSERT INTO researchers_trigram (researchers_trigram) VALUES ('rebuild')")
+    
+    # Data generation, bumped by every write that changes researchers or
+    # publications, so derived indexes and caches can tell when to refresh
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS data_generation (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        generation INTEGER NOT NULL
+    )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO data_generation (id, generation) VALUES (1, 0)")
+    
+    # Log of deleted publications, read by the indexes that are maintained
+    # outside SQLite (the semantic index) to tombstone them, and by those
+    # kept in memory to subtract them. Its rows are pruned once every
+    # consumer recorded in deletion_marks has read them; the indexes that
+    # only count deletions read the log's sequence (see get_deletion_mark),
+    # which pruning leaves in place.
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS publication_deletions (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        publication_id INTEGER NOT NULL,
+        researcher_id INTEGER,
+        title TEXT
+    )
+    ''')
+    
+    # Deletions are logged with their researcher, whose collaborations they
+    # change (see collaboration.py), and their title, whose terms they no
+    # longer count (see autocomplete.py). Databases created before get the
+    # columns, and the trigger is replaced to fill them in.
+    cursor.execute("PRAGMA table_info(publication_deletions)")
+    columns = [column[1] for column in cursor.fetchall()]
+    for column, column_type in (('researcher_id', 'INTEGER'), ('title', 'TEXT')):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE publication_deletions ADD COLUMN {column} {column_type}")
+            cursor.execute("DROP TRIGGER IF EXISTS publications_log_delete")
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS publications_log_delete AFTER DELETE ON publications BEGIN
+        INSERT INTO publication_deletions (publication_id, researcher_id, title)
+        VALUES (old.id, old.researcher_id, old.title);
+    END
+    ''')
+    
+    # Last deletion read by each consumer of the log: the repair of works
+    # below, the semantic index, the autocomplete suggestions and the
+    # collaboration graph
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'deletion_marks'")
+    deletion_marks_exist = cursor.fetchone() is not None
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS deletion_marks (
+        consumer TEXT PRIMARY KEY,
+        seq INTEGER NOT NULL
+    ) WITHOUT ROWID
+    ''')
+    
+    # Works still identified by a deleted publication, whose deletion did not
+    # move them (see works.move_works), move to their next publication. They
+    # keep the bands of the deleted title. Only the deletions logged since
+    # the last startup are read.
+    cursor.execute('''
+    CREATE TEMP TABLE moved_works AS
+    SELECT d.publication_id AS old_id, MIN(p.id) AS new_id
+    FROM (SELECT DISTINCT publication_id FROM publication_deletions
+          WHERE seq > IFNULL((SELECT seq FROM deletion_marks WHERE consumer = 'works'), 0)) d
+    JOIN publications p ON p.work_id = d.publication_id
+    GROUP BY d.publication_id
+    ''')
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM moved_works)")
+    if cursor.fetchone()[0]:
+        cursor.execute('''
+        UPDATE publications SET work_id = (SELECT new_id FROM moved_works WHERE old_id = publications.work_id)
+        WHERE work_id IN (SELECT old_id FROM moved_works)
+        ''')
+        cursor.execute('''
+        UPDATE work_bands SET work_id = (SELECT new_id FROM moved_works WHERE old_id = work_bands.work_id)
+        WHERE work_id IN (SELECT old_id FROM moved_works)
+        ''')
+    cursor.execute("DROP TABLE moved_works")
+    _record_deletion_mark(cursor, 'works', get_deletion_mark(cursor))
+    
+    # A semantic index built before the marks existed has not recorded its
+    # own yet, so nothing is pruned until it does
+    if deletion_marks_exist:
+        _prune_deletions(cursor)
+    
+    # Ledger of ingested files: the hash of their contents and, when the CV
+    # has them, its Lattes id and last update date (DATA-ATUALIZACAO), so
+    # uploads of files already ingested can be skipped before parsing
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ingest_ledger (
+        content_hash TEXT PRIMARY KEY,
+        lattes_id TEXT,
+        updated_at TEXT,
+        researcher_id INTEGER,
+        ingested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (researcher_id) REFERENCES researchers (id)
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ingest_ledger_cv ON ingest_ledger (lattes_id, updated_at)")
+    if metadata_added:
+        cursor.execute("DELETE FROM ingest_ledger")
+    
+    # Publications listed by each CV, by Lattes id. Researchers are merged by
+    # name, so a new version of a CV is diffed against the publications of
+    # this CV only, not against those of every CV with the same name. A
+    # publication listed by several such CVs is removed once none lists it.
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'cv_publications'")
+    cv_publications_exist = cursor.fetchone() is not None
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS cv_publications (
+        lattes_id TEXT NOT NULL,
+        publication_id INTEGER NOT NULL,
+        PRIMARY KEY (lattes_id, publication_id)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cv_publications_publication ON cv_publications (publication_id)")
+    
+    # CVs ingested before are linked to every publication of the researchers
+    # they were written to, so their next version removes no publication of
+    # another CV with the same name
+    if not cv_publications_exist:
+        cursor.execute('''
+        INSERT OR IGNORE INTO cv_publications (lattes_id, publication_id)
+        SELECT DISTINCT l.lattes_id, p.id FROM ingest_ledger l JOIN publications p ON p.researcher_id = l.researcher_id
+        WHERE l.lattes_id IS NOT NULL
+        ''')
+    
+    # Links of deleted publications go with them
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS cv_publications_delete AFTER DELETE ON publications BEGIN
+        DELETE FROM cv_publications WHERE publication_id = old.id;
+    END
+    ''')
+    
+    conn.commit()
+
+
+# Current data generation
+def get_generation(cursor):
+    cursor.execute("SELECT generation FROM data_generation WHERE id = 1")
+    return cursor.fetchone()[0]
+
+
+# Bump the data generation; call within the write transaction
+def bump_generation(cursor):
+    cursor.execute("UPDATE data_generation SET generation = generation + 1 WHERE id = 1")
+
+
+# Sequence number of the last logged publication deletion. It keeps counting
+# when the log is pruned, so the difference of two marks is the number of
+# publications deleted in between.
+def get_deletion_mark(cursor):
+    cursor.execute("SELECT IFNULL((SELECT seq FROM sqlite_sequence WHERE name = 'publication_deletions'), 0)")
+    return cursor.fetchone()[0]
+
+
+# Record that a consumer of the deletion log has read it up to a mark, and
+# prune the rows every consumer has read
+def record_deletion_mark(consumer, seq):
+    with writer_connection() as conn:
+        cursor = conn.cursor()
+        _record_deletion_mark(cursor, consumer, seq)
+        _prune_deletions(cursor)
+        conn.commit()
+
+
+def _record_deletion_mark(cursor, consumer, seq):
+    cursor.execute("INSERT INTO deletion_marks (consumer, seq) VALUES (?, ?) "
+                   "ON CONFLICT (consumer) DO UPDATE SET seq = excluded.seq", (consumer, seq))
+
+
+def _prune_deletions(cursor):
+    cursor.execute("DELETE FROM publication_deletions WHERE seq <= (SELECT MIN(seq) FROM deletion_marks)")
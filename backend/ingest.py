@@ -0,0 +1,645 @@
+import asyncio
+import collections
+import gzip
+import hashlib
+import os
+import threading
+import time
+import xml.etree.ElementTree as ET
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from database import acquire_writer, release_writer, bump_generation, reader_connection
+from lattes_parser import cv_date, parse_lattes_xml, read_cv_version
+from metrics import STAGE_SECONDS
+from profiling import carry_profile, profile_call
+from text_utils import normalize_text
+from works import assign_works, move_works
+
+# Number of worker processes used to parse uploaded XML files
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', os.cpu_count() or 1))
+
+# Maximum number of files parsed ahead of the database writer
+INGEST_MAX_PENDING = int(os.environ.get('INGEST_MAX_PENDING', 2 * INGEST_WORKERS))
+
+# Number of buffered publications that triggers a bulk write
+INGEST_BATCH_ROWS = int(os.environ.get('INGEST_BATCH_ROWS', 50000))
+
+_parse_pool = None
+
+# Every database write goes through this single thread, so there is exactly
+# one writer per process no matter how many files are parsed in parallel
+_writer_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='lattes-writer')
+
+# Held by an upload from its first write until it commits, so concurrent
+# uploads take turns on the writer instead of blocking its thread. Uploads
+# on different event loops share the writer thread too, so this is a
+# thread lock, polled without blocking the loop (see _take_write_turn).
+_write_turn = threading.Lock()
+
+# Seconds between two attempts at taking the write turn
+_WRITE_TURN_POLL = 0.05
+
+
+# Wait for the write turn. A cancelled upload gives up waiting without
+# taking it.
+async def _take_write_turn():
+    while not _write_turn.acquire(blocking=False):
+        await asyncio.sleep(_WRITE_TURN_POLL)
+
+
+# Get (creating it on first use) the process pool used for parsing
+def get_parse_pool():
+    global _parse_pool
+    if _parse_pool is None:
+        _parse_pool = ProcessPoolExecutor(max_workers=max(1, INGEST_WORKERS))
+    return _parse_pool
+
+
+# Stop the parsing processes, waiting for any running parse to finish
+def shutdown_parse_pool():
+    global _parse_pool
+    if _parse_pool is not None:
+        _parse_pool.shutdown()
+        _parse_pool = None
+
+
+# Maximum number of names looked up per SELECT ... IN (...) statement
+_LOOKUP_CHUNK = 500
+
+# Errors of a file that cannot be read or parsed, reported per file
+FILE_ERRORS = (ET.ParseError, OSError, EOFError, zlib.error, zipfile.BadZipFile)
+
+# ZIP archive last opened by this parsing process, with the (inode, mtime)
+# it had, kept open as reading the central directory of an archive with
+# many members for every member would be quadratic
+_open_archive = (None, None, None)
+
+# ZIP archive inside a ZIP archive last opened, with the outer archive it
+# was read from and the stream of its member
+_open_inner_archive = (None, None, None, None)
+
+
+# Split the path of a ZIP archive member ("archive.zip!member.xml") into the
+# archive path, the separator and the member name, at the first archive of
+# the path or, with last=True, at the innermost one. Archive suffixes are
+# matched in any case ("ARCHIVE.ZIP!member.xml").
+def _partition_member(path, last=False):
+    lowered = path.lower()
+    index = lowered.rfind('.zip!') if last else lowered.find('.zip!')
+    if index < 0:
+        return path, '', ''
+    return path[:index + 4], '!', path[index + 5:]
+
+
+# The ZIP archive at a path, which may be a member of a ZIP archive on disk
+# ("archive.zip!inner.zip")
+def _zip_archive(path):
+    global _open_archive, _open_inner_archive
+    outer_path, separator, member = _partition_member(path)
+    if separator:
+        outer = _zip_archive(outer_path)
+        open_path, open_outer, stream, archive = _open_inner_archive
+        if (open_path, open_outer) != (path, outer):
+            if archive is not None:
+                archive.close()
+                stream.close()
+            stream = outer.open(member)
+            archive = zipfile.ZipFile(stream)
+            _open_inner_archive = (path, outer, stream, archive)
+        return archive
+
+    stat = os.stat(path)
+    version = (stat.st_ino, stat.st_mtime_ns)
+    open_path, open_version, archive = _open_archive
+    if (open_path, open_version) != (path, version):
+        if archive is not None:
+            archive.close()
+        archive = zipfile.ZipFile(path)
+        _open_archive = (path, version, archive)
+    return archive
+
+
+# The (file name, path) of the XML members of a ZIP archive, as read by
+# open_source. An archive that cannot be read is kept as a single file,
+# which is reported as failed when it is read.
+def zip_members(name, path):
+    try:
+        if _partition_member(path)[1]:
+            infos = _zip_archive(path).infolist()
+        else:
+            with zipfile.ZipFile(path) as archive:
+                infos = archive.infolist()
+    except (OSError, zipfile.BadZipFile):
+        return [(name, path)]
+    members = sorted(info.filename for info in infos
+                     if not info.is_dir() and info.filename.lower().endswith('.xml'))
+    return [(f'{name}!{member}', f'{path}!{member}') for member in members]
+
+
+# Open a spooled upload for reading its XML: an XML file, a gzip-compressed
+# XML file (.gz) or a member of a ZIP archive ("archive.zip!member.xml"),
+# which may itself be a member of a ZIP archive ("archive.zip!cv.zip!cv.xml",
+# as in the per-CV ZIPs of Lattes exports). Compressed files are
+# decompressed as they are read, never as a whole.
+def open_source(path):
+    archive, separator, member = _partition_member(path, last=True)
+    if separator:
+        return _zip_archive(archive).open(member)
+    if path.lower().endswith('.zip'):
+        # An archive that could not be listed when spooled
+        zipfile.ZipFile(path).close()
+    if path.lower().endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+# File object hashing everything read from it
+class _HashingReader:
+    def __init__(self, source):
+        self.source = source
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        chunk = self.source.read(size)
+        self.digest.update(chunk)
+        return chunk
+
+
+# Fingerprint of an XML file, computed in the parsing processes: the hash
+# of its (decompressed) contents and the Lattes id and update date of the
+# CV, if any. The file is read once, the version coming from its start.
+def fingerprint_file(path, chunk_size=1024 * 1024):
+    with open_source(path) as f:
+        reader = _HashingReader(f)
+        try:
+            lattes_id, updated_at = read_cv_version(reader)
+        except ET.ParseError:
+            lattes_id, updated_at = None, None
+        for _ in iter(lambda: reader.read(chunk_size), b''):
+            pass
+    return reader.digest.hexdigest(), lattes_id, updated_at
+
+
+def _parse_source(path):
+    with open_source(path) as f:
+        return parse_lattes_xml(f)
+
+
+# Parse a file in a parsing process. Returns the parse result, the time it
+# took, which is recorded by the calling process, and no profile.
+def parse_file_timed(path):
+    started = time.perf_counter()
+    parsed = _parse_source(path)
+    return parsed, time.perf_counter() - started, None
+
+
+# Parse a file in a parsing process under the sampling profiler, returning
+# the collapsed stacks sampled as well
+def parse_file_profiled(path):
+    started = time.perf_counter()
+    parsed, stacks = profile_call(_parse_source, path)
+    return parsed, time.perf_counter() - started, stacks
+
+
+# Look up fingerprints in the ingest ledger. Returns the content hashes
+# already ingested and, by Lattes id, the date of the newest version of the
+# CV ingested.
+def find_ingested(fingerprints):
+    hashes = list({content_hash for content_hash, _, _ in fingerprints})
+    lattes_ids = list({lattes_id for _, lattes_id, updated_at in fingerprints if lattes_id and updated_at})
+    known_hashes = set()
+    latest_dates = {}
+    with reader_connection() as conn:
+        cursor = conn.cursor()
+        for start in range(0, len(hashes), _LOOKUP_CHUNK):
+            chunk = hashes[start:start + _LOOKUP_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(f"SELECT content_hash FROM ingest_ledger WHERE content_hash IN ({placeholders})", chunk)
+            known_hashes.update(row[0] for row in cursor.fetchall())
+        for start in range(0, len(lattes_ids), _LOOKUP_CHUNK):
+            chunk = lattes_ids[start:start + _LOOKUP_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(f"SELECT lattes_id, updated_at FROM ingest_ledger WHERE lattes_id IN ({placeholders})", chunk)
+            for lattes_id, updated_at in cursor.fetchall():
+                _add_date(latest_dates, lattes_id, cv_date(updated_at))
+    return known_hashes, latest_dates
+
+
+def _add_date(latest_dates, lattes_id, date):
+    if lattes_id and date is not None:
+        latest_dates[lattes_id] = max(date, latest_dates.get(lattes_id, date))
+
+
+# Whether a fingerprinted file is not to be ingested, given what find_ingested
+# returned: its contents have been ingested already, or a version of its CV
+# as recent or newer (by DATA-ATUALIZACAO), which an older version must not
+# overwrite
+def is_ingested(fingerprint, known_hashes, latest_dates):
+    content_hash, lattes_id, updated_at = fingerprint
+    if content_hash in known_hashes:
+        return True
+    date = cv_date(updated_at)
+    return date is not None and lattes_id in latest_dates and date <= latest_dates[lattes_id]
+
+
+# Record a file about to be ingested, so is_ingested skips it, and older
+# versions of its CV, later in the same run
+def mark_ingested(fingerprint, known_hashes, latest_dates):
+    content_hash, lattes_id, updated_at = fingerprint
+    known_hashes.add(content_hash)
+    _add_date(latest_dates, lattes_id, cv_date(updated_at))
+
+
+# Writes parsed CVs to the database within a single transaction.
+# Parsed CVs are buffered and written with set-based statements once enough
+# rows have accumulated. A new version of a CV already in the ingest ledger
+# is diffed against the publications of that CV (cv_publications), so only
+# added and removed titles, and titles whose metadata changed, are written.
+# A version older than one already written is only recorded in the ledger.
+# The process' writer connection is held from the first write until
+# close(). All methods must be called from the writer thread.
+class BatchWriter:
+    def __init__(self, batch_rows=INGEST_BATCH_ROWS):
+        self.batch_rows = batch_rows
+        self.conn = None
+        self.researchers_added = 0
+        self.publications_added = 0
+        self.publications_removed = 0
+        self.publications_updated = 0
+        self._committed_counts = (0, 0, 0, 0)
+
+        # Whether the database has publications stored before their metadata
+        # was kept, whose metadata is filled in when their CV is written again
+        # (looked up on the first write)
+        self.legacy_publications = None
+
+        # Researcher name -> id, kept for the lifetime of the batch
+        self.researcher_ids = {}
+
+        # Venue name -> id, kept for the lifetime of the batch
+        self.venue_ids = {None: None}
+
+        # Lattes id -> (date, researcher id) of the newest version of the CV
+        # written, for the CVs ingested before, kept for the lifetime of the batch
+        self.cv_versions = {}
+
+        # Buffered (full_name, publications, fingerprint) tuples not yet written
+        self.pending = []
+        self.pending_rows = 0
+        self.pending_lattes_ids = set()
+
+    # Buffer a parsed CV, with its publications as lattes_parser.Publication
+    # tuples. full_name may be None for a file without a CV or a CV without
+    # a name. A new version of a CV is written to the researcher of the
+    # previous one when it has no name, and removes all of its publications
+    # when it has none. Otherwise, a CV without a name or publications only
+    # has its fingerprint recorded.
+    def write(self, full_name, publications, fingerprint=None):
+        lattes_id = fingerprint[1] if fingerprint else None
+        if lattes_id is not None:
+            # Versions of the same CV are diffed one after the other
+            if lattes_id in self.pending_lattes_ids:
+                self.flush()
+            self.pending_lattes_ids.add(lattes_id)
+
+        self.pending.append((full_name, publications, fingerprint))
+        self.pending_rows += len(publications)
+        if self.pending_rows >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        if self.conn is None:
+            self.conn = acquire_writer()
+        with STAGE_SECONDS.time('db_write'):
+            self._write_pending(self.conn.cursor())
+
+    def _write_pending(self, cursor):
+        if self.legacy_publications is None:
+            cursor.execute("SELECT EXISTS (SELECT 1 FROM publications WHERE kind IS NULL)")
+            self.legacy_publications = bool(cursor.fetchone()[0])
+
+        # Upsert the researchers of the CVs with publications not resolved
+        # yet, in first-seen order
+        new_names = []
+        for full_name, publications, _ in self.pending:
+            if full_name and publications and full_name not in self.researcher_ids:
+                self.researcher_ids[full_name] = None
+                new_names.append(full_name)
+
+        if new_names:
+            cursor.executemany("INSERT OR IGNORE INTO researchers (full_name, normalized_name) VALUES (?, ?)",
+                               ((name, normalize_text(name)) for name in new_names))
+            self.researchers_added += cursor.rowcount
+
+            for start in range(0, len(new_names), _LOOKUP_CHUNK):
+                chunk = new_names[start:start + _LOOKUP_CHUNK]
+                placeholders = ','.join('?' * len(chunk))
+                cursor.execute(f"SELECT full_name, id FROM researchers WHERE full_name IN ({placeholders})",
+                               chunk)
+                self.researcher_ids.update(cursor.fetchall())
+
+        # Same for the venues
+        new_venues = []
+        for _, publications, _ in self.pending:
+            for publication in publications:
+                if publication.venue not in self.venue_ids:
+                    self.venue_ids[publication.venue] = None
+                    new_venues.append(publication.venue)
+
+        if new_venues:
+            cursor.executemany("INSERT OR IGNORE INTO venues (name) VALUES (?)", ((name,) for name in new_venues))
+            for start in range(0, len(new_venues), _LOOKUP_CHUNK):
+                chunk = new_venues[start:start + _LOOKUP_CHUNK]
+                placeholders = ','.join('?' * len(chunk))
+                cursor.execute(f"SELECT name, id FROM venues WHERE name IN ({placeholders})", chunk)
+                self.venue_ids.update(cursor.fetchall())
+
+        # Find which CVs have been ingested before: the date of their newest
+        # version and the researcher it was written to
+        new_lattes_ids = [lattes_id for lattes_id in self.pending_lattes_ids if lattes_id not in self.cv_versions]
+        for start in range(0, len(new_lattes_ids), _LOOKUP_CHUNK):
+            chunk = new_lattes_ids[start:start + _LOOKUP_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(f"SELECT lattes_id, updated_at, researcher_id FROM ingest_ledger "
+                           f"WHERE lattes_id IN ({placeholders}) ORDER BY rowid", chunk)
+            for lattes_id, updated_at, researcher_id in cursor.fetchall():
+                self._add_version(lattes_id, cv_date(updated_at), researcher_id)
+
+        rows = []
+        links = []
+        unlinked = []
+        updated_rows = []
+        ledger_rows = []
+        for full_name, publications, fingerprint in self.pending:
+            researcher_id = self.researcher_ids.get(full_name)
+            lattes_id = fingerprint[1] if fingerprint else None
+
+            if lattes_id is None:
+                if researcher_id is not None:
+                    rows.extend((publication.title, researcher_id) + self._metadata(publication)
+                                for publication in publications)
+            elif self._is_older(lattes_id, cv_date(fingerprint[2])):
+                # Uploaded after a newer version of the CV was written
+                researcher_id = None
+            else:
+                previous = self.cv_versions.get(lattes_id)
+                if researcher_id is None and previous is not None and (full_name or publications):
+                    researcher_id = previous[1]
+                if researcher_id is not None:
+                    self._diff_cv(cursor, lattes_id, researcher_id, publications, previous is not None,
+                                  rows, links, unlinked, updated_rows)
+                self._add_version(lattes_id, cv_date(fingerprint[2]), researcher_id)
+
+            if fingerprint:
+                ledger_rows.append((fingerprint[0], lattes_id, fingerprint[2], researcher_id))
+
+        # Publications no longer in a CV are removed once no CV lists them
+        if unlinked:
+            cursor.executemany("DELETE FROM cv_publications WHERE lattes_id = ? AND publication_id = ?", unlinked)
+            deleted_works = self._deleted_works(cursor, {publication_id for _, publication_id in unlinked})
+            cursor.executemany("DELETE FROM publications WHERE id = ? AND NOT EXISTS "
+                               "(SELECT 1 FROM cv_publications WHERE publication_id = ?)",
+                               ((publication_id, publication_id) for _, publication_id in unlinked))
+            self.publications_removed += cursor.rowcount
+            move_works(cursor, deleted_works)
+
+        # Insert all new publications at once; INSERT OR IGNORE skips
+        # duplicates. For executemany, rowcount is the sum of changes() over
+        # every execution, which leaves out rows written by triggers.
+        if rows:
+            cursor.executemany("INSERT OR IGNORE INTO publications (title, researcher_id, kind, year, doi, venue_id) "
+                               "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.publications_added += cursor.rowcount
+            cursor.executemany("INSERT OR IGNORE INTO cv_publications (lattes_id, publication_id) "
+                               "SELECT ?, id FROM publications WHERE title = ? AND researcher_id = ?", links)
+            if self.legacy_publications:
+                cursor.executemany("UPDATE publications SET kind = ?, year = ?, doi = ?, venue_id = ? "
+                                   "WHERE title = ? AND researcher_id = ? AND kind IS NULL",
+                                   (row[2:] + row[:2] for row in rows))
+                self.publications_updated += cursor.rowcount
+
+        if updated_rows:
+            cursor.executemany("UPDATE publications SET kind = ?, year = ?, doi = ?, venue_id = ? WHERE id = ?",
+                               updated_rows)
+            self.publications_updated += cursor.rowcount
+
+        self._assign_works(cursor)
+
+        cursor.executemany("INSERT OR REPLACE INTO ingest_ledger (content_hash, lattes_id, updated_at, researcher_id) "
+                           "VALUES (?, ?, ?, ?)", ledger_rows)
+
+        self.pending = []
+        self.pending_rows = 0
+        self.pending_lattes_ids = set()
+
+    # Diff a version of a CV, written to a researcher, against the
+    # publications of its previous versions (when it has any), adding to the
+    # rows to insert, the (lattes_id, title, researcher_id) links to add, the
+    # (lattes_id, publication_id) links to remove and the rows to update.
+    # Publications of previous versions written to another researcher (as
+    # the CV changed its name) are all removed.
+    def _diff_cv(self, cursor, lattes_id, researcher_id, publications, ingested, rows, links, unlinked,
+                 updated_rows):
+        stored = {}
+        if ingested:
+            cursor.execute("SELECT p.id, p.title, p.researcher_id, p.kind, p.year, p.doi, p.venue_id "
+                           "FROM cv_publications c JOIN publications p ON p.id = c.publication_id "
+                           "WHERE c.lattes_id = ?", (lattes_id,))
+            for row in cursor.fetchall():
+                if row[2] == researcher_id:
+                    stored[row[1]] = row
+                else:
+                    unlinked.append((lattes_id, row[0]))
+
+        titles = set()
+        for publication in publications:
+            if publication.title in titles:
+                continue
+            titles.add(publication.title)
+            metadata = self._metadata(publication)
+            row = stored.get(publication.title)
+            if row is None:
+                rows.append((publication.title, researcher_id) + metadata)
+                links.append((lattes_id, publication.title, researcher_id))
+            elif row[3:] != metadata:
+                updated_rows.append(metadata + (row[0],))
+        unlinked.extend((lattes_id, row[0]) for title, row in stored.items() if title not in titles)
+
+    # Whether a version of a CV is older than the newest written
+    def _is_older(self, lattes_id, date):
+        latest_date = self.cv_versions.get(lattes_id, (None, None))[0]
+        return date is not None and latest_date is not None and date < latest_date
+
+    # Record a version of a CV, and the researcher it was written to (None if
+    # it had no name), unless a newer one has been recorded
+    def _add_version(self, lattes_id, date, researcher_id):
+        if self._is_older(lattes_id, date):
+            return
+        latest_date, latest_researcher = self.cv_versions.get(lattes_id, (None, None))
+        self.cv_versions[lattes_id] = (date or latest_date,
+                                       latest_researcher if researcher_id is None else researcher_id)
+
+    # The (id, title) of the publications about to be deleted, among those
+    # unlinked from their CVs, that identify a work
+    def _deleted_works(self, cursor, publication_ids):
+        publication_ids = sorted(publication_ids)
+        deleted = []
+        for start in range(0, len(publication_ids), _LOOKUP_CHUNK):
+            chunk = publication_ids[start:start + _LOOKUP_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(f"SELECT p.id, p.title FROM publications p WHERE p.id IN ({placeholders}) "
+                           "AND p.work_id = p.id "
+                           "AND NOT EXISTS (SELECT 1 FROM cv_publications c WHERE c.publication_id = p.id)", chunk)
+            deleted.extend(cursor.fetchall())
+        return deleted
+
+    # Assign works to the publications just inserted, and on the first write
+    # to those stored before works existed. Both are the publications without
+    # a work, as every publication gets one in the transaction writing it.
+    def _assign_works(self, cursor):
+        while True:
+            cursor.execute("SELECT id, title, researcher_id, kind, year, doi FROM publications "
+                           "WHERE work_id IS NULL ORDER BY id LIMIT ?", (self.batch_rows,))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            work_ids = assign_works(cursor, rows)
+            cursor.executemany("UPDATE publications SET work_id = ? WHERE id = ?",
+                               zip(work_ids, (row[0] for row in rows)))
+
+    # The (kind, year, doi, venue_id) columns of a publication
+    def _metadata(self, publication):
+        return publication.kind, publication.year, publication.doi, self.venue_ids[publication.venue]
+
+    # Commit everything written so far. May be called more than once; the
+    # writer keeps going in a new transaction.
+    def commit(self):
+        self.flush()
+        if self.conn is not None:
+            counts = (self.researchers_added, self.publications_added, self.publications_removed,
+                      self.publications_updated)
+            with STAGE_SECONDS.time('db_commit'):
+                if counts != self._committed_counts:
+                    bump_generation(self.conn.cursor())
+                self.conn.commit()
+            self._committed_counts = counts
+
+    # Hand the writer connection back; uncommitted writes are rolled back
+    def close(self):
+        if self.conn is not None:
+            self.conn = None
+            release_writer()
+
+
+# Parse files across the process pool and hand the results, in order, to a
+# single writer. `paths` are XML files on disk, read by the parsing
+# processes themselves. Files are fingerprinted a chunk of INGEST_MAX_PENDING
+# at a time, ahead of their parsing, and those already in the ingest ledger
+# or earlier in the batch (same contents, or a version of the CV as recent
+# or newer) are reported to on_skip without being parsed.
+# A file that fails to parse is reported to on_error and skipped;
+# on_progress is called with the writer and the number of publications read
+# after every parsed file. When profile_stacks is given, files are parsed
+# under the sampling profiler and their stacks are added to it.
+# Returns the number of processed files, those with a researcher name and
+# publications, together with the writer, which holds the insert counts.
+async def ingest_files(paths, on_progress=None, on_error=None, on_skip=None, profile_stacks=None):
+    loop = asyncio.get_running_loop()
+    pool = get_parse_pool()
+    parse = parse_file_timed if profile_stacks is None else parse_file_profiled
+    writer = BatchWriter()
+    pending = collections.deque()
+    processed_count = 0
+    has_write_turn = False
+
+    async def write_next():
+        nonlocal processed_count, has_write_turn
+        path, fingerprint, parsed = pending.popleft()
+        try:
+            (full_name, publications), parse_seconds, stacks = await parsed
+            STAGE_SECONDS.observe(parse_seconds, 'xml_parse')
+            if stacks:
+                profile_stacks.update(stacks)
+        except FILE_ERRORS as e:
+            if on_error is None:
+                raise
+            on_error(path, str(e))
+            return
+
+        if not has_write_turn:
+            await _take_write_turn()
+            has_write_turn = True
+        await loop.run_in_executor(_writer_thread, carry_profile(writer.write),
+                                   full_name, publications, fingerprint)
+        if full_name and publications:
+            processed_count += 1
+        if on_progress is not None:
+            on_progress(writer, len(publications))
+
+    # Fingerprint a chunk of files in the parsing processes, looking them up
+    # in the ingest ledger. Files that cannot be read (a corrupt archive or
+    # gzip stream) are reported like files that cannot be parsed.
+    async def fingerprint_chunk(chunk, futures):
+        with STAGE_SECONDS.time('fingerprint'):
+            fingerprints = await asyncio.gather(*futures, return_exceptions=True)
+        readable = []
+        for path, fingerprint in zip(chunk, fingerprints):
+            if isinstance(fingerprint, FILE_ERRORS) and on_error is not None:
+                on_error(path, str(fingerprint))
+            elif isinstance(fingerprint, BaseException):
+                raise fingerprint
+            else:
+                readable.append((path, fingerprint))
+        found = await loop.run_in_executor(
+            None, carry_profile(find_ingested), [fingerprint for _, fingerprint in readable])
+        return readable, found
+
+    def start_fingerprints(chunk):
+        return [loop.run_in_executor(pool, fingerprint_file, path) for path in chunk]
+
+    chunk_size = max(1, INGEST_MAX_PENDING)
+    chunks = [paths[start:start + chunk_size] for start in range(0, len(paths), chunk_size)]
+    known_hashes, latest_dates = set(), {}
+    fingerprinting = start_fingerprints(chunks[0]) if chunks else []
+    try:
+        for index, chunk in enumerate(chunks):
+            readable, (found_hashes, found_dates) = await fingerprint_chunk(chunk, fingerprinting)
+            known_hashes.update(found_hashes)
+            for lattes_id, date in found_dates.items():
+                _add_date(latest_dates, lattes_id, date)
+            # The next chunk is fingerprinted while this one is parsed
+            fingerprinting = start_fingerprints(chunks[index + 1]) if index + 1 < len(chunks) else []
+
+            for path, fingerprint in readable:
+                if is_ingested(fingerprint, known_hashes, latest_dates):
+                    if on_skip is not None:
+                        on_skip(path)
+                    continue
+                mark_ingested(fingerprint, known_hashes, latest_dates)
+
+                pending.append((path, fingerprint, loop.run_in_executor(pool, parse, path)))
+
+                # Keep a bounded number of files in flight
+                if len(pending) >= INGEST_MAX_PENDING:
+                    await write_next()
+
+        while pending:
+            await write_next()
+
+        await loop.run_in_executor(_writer_thread, carry_profile(writer.commit))
+    finally:
+        # Do not leave parses or fingerprints running for a cancelled or
+        # failed ingest
+        for _, _, parsed in pending:
+            parsed.cancel()
+        for fingerprint in fingerprinting:
+            fingerprint.cancel()
+        await loop.run_in_executor(_writer_thread, carry_profile(writer.close))
+        if has_write_turn:
+            _write_turn.release()
+
+    return processed_count, writer
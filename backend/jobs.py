@@ -0,0 +1,242 @@
+import asyncio
+import collections
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from ingest import ingest_files, zip_members
+from metrics import STAGE_SECONDS, INGEST_FILES, INGEST_ROWS, INGEST_LAST_JOB_RATE
+from profiling import ProfileScope, Sampler, carry_profile, profile_scope, store_profile, PROFILE_SAMPLE_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Directory uploads are spooled to until their job has ingested them
+# (defaults to the system temporary directory)
+INGEST_SPOOL_DIR = os.environ.get('INGEST_SPOOL_DIR') or None
+
+# Bytes copied at a time when spooling an upload to disk
+INGEST_SPOOL_CHUNK = int(os.environ.get('INGEST_SPOOL_CHUNK', 1024 * 1024))
+
+# Number of finished jobs whose status is kept for GET /jobs/{id}
+INGEST_JOB_HISTORY = int(os.environ.get('INGEST_JOB_HISTORY', 100))
+
+
+# Upload file name endings accepted, and the suffix of their spooled copy
+_UPLOAD_SUFFIXES = (('.xml.gz', '.xml.gz'), ('.xml', '.xml'), ('.zip', '.zip'))
+
+
+# Copy the uploads to a new spool directory, a chunk at a time. Uploads may
+# be XML files, gzip-compressed XML files (.xml.gz) or ZIP archives of XML
+# files; compressed uploads are spooled as they are and decompressed while
+# being ingested. Returns the directory, the (file name, path) of every
+# spooled XML file, with one entry per XML member of an archive, and the
+# names of the uploads that are none of these.
+async def spool_uploads(files):
+    with STAGE_SECONDS.time('spool'):
+        return await _spool(files)
+
+
+async def _spool(files):
+    loop = asyncio.get_running_loop()
+    directory = tempfile.mkdtemp(prefix='lattes-upload-', dir=INGEST_SPOOL_DIR)
+    spooled = []
+    ignored = []
+    try:
+        for index, file in enumerate(files):
+            name = file.filename or ''
+            suffix = next((suffix for ending, suffix in _UPLOAD_SUFFIXES if name.lower().endswith(ending)), None)
+            if suffix is None:
+                ignored.append(name)
+                continue
+
+            # Disk writes and the listing of archives, which reads their
+            # whole central directory, run in a thread so the event loop
+            # keeps serving other requests while a large upload is spooled
+            path = os.path.join(directory, f'{index:06d}{suffix}')
+            out = await loop.run_in_executor(None, open, path, 'wb')
+            try:
+                while True:
+                    chunk = await file.read(INGEST_SPOOL_CHUNK)
+                    if not chunk:
+                        break
+                    await loop.run_in_executor(None, carry_profile(out.write), chunk)
+            finally:
+                await loop.run_in_executor(None, out.close)
+            if suffix == '.zip':
+                spooled.extend(await loop.run_in_executor(None, carry_profile(zip_members), name, path))
+            else:
+                spooled.append((name, path))
+    except BaseException:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+    return directory, spooled, ignored
+
+
+# Background ingestion of one batch of spooled uploads
+class IngestJob:
+    def __init__(self, directory, files, profile=False):
+        self.id = uuid.uuid4().hex
+        self.directory = directory
+        self.file_names = {path: name for name, path in files}
+        self.paths = [path for _, path in files]
+        self.status = 'queued'
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.files_parsed = 0
+        self.files_processed = 0
+        self.files_skipped = 0
+        self.publications_parsed = 0
+        self.researchers_added = 0
+        self.publications_added = 0
+        self.publications_removed = 0
+        self.publications_updated = 0
+        self.errors = []
+        self.task = None
+        self.profile = profile
+
+    def _on_progress(self, writer, publication_count):
+        self.files_parsed += 1
+        self.publications_parsed += publication_count
+        self.researchers_added = writer.researchers_added
+        self.publications_added = writer.publications_added
+        self.publications_removed = writer.publications_removed
+        self.publications_updated = writer.publications_updated
+
+    def _on_skip(self, path):
+        self.files_skipped += 1
+        INGEST_FILES.inc('skipped')
+
+    def _on_error(self, path, message):
+        self.files_parsed += 1
+        INGEST_FILES.inc('failed')
+        self.errors.append({"file": self.file_names.get(path, path), "error": message})
+
+    async def run(self):
+        self.status = 'running'
+        self.started_at = time.time()
+
+        # A profiled job samples its own work in this process (this coroutine
+        # and the threads of the ingest writer) and the parsing processes. The
+        # job is not part of the profile of the request that started it.
+        scope = None
+        sampler = None
+        profile_stacks = None
+        if self.profile:
+            scope = ProfileScope(sys._getframe())
+            sampler = Sampler(PROFILE_SAMPLE_INTERVAL, scope=scope).start()
+            profile_stacks = collections.Counter()
+
+        try:
+            with profile_scope(scope):
+                self.files_processed, writer = await ingest_files(self.paths, self._on_progress, self._on_error,
+                                                                  self._on_skip, profile_stacks)
+            self.researchers_added = writer.researchers_added
+            self.publications_added = writer.publications_added
+            self.publications_removed = writer.publications_removed
+            self.publications_updated = writer.publications_updated
+            self.status = 'completed'
+            self._record_metrics()
+        except asyncio.CancelledError:
+            self.status = 'cancelled'
+            raise
+        except Exception as e:
+            # Nothing of a failed job is committed
+            logger.exception("Ingest job %s failed", self.id)
+            self.status = 'failed'
+            self.researchers_added = 0
+            self.publications_added = 0
+            self.publications_removed = 0
+            self.publications_updated = 0
+            self.errors.append({"file": None, "error": str(e)})
+        finally:
+            self.finished_at = time.time()
+            shutil.rmtree(self.directory, ignore_errors=True)
+            if sampler is not None:
+                sampler.stop()
+                profile_stacks.update(sampler.stacks)
+                store_profile(f'ingest job {self.id}', 'job', self.finished_at - self.started_at,
+                              profile_stacks, sampler.sample_count, sampler.interval)
+
+    def _record_metrics(self):
+        INGEST_FILES.inc('processed', amount=self.files_processed)
+        INGEST_ROWS.inc('researchers', 'insert', amount=self.researchers_added)
+        INGEST_ROWS.inc('publications', 'insert', amount=self.publications_added)
+        INGEST_ROWS.inc('publications', 'delete', amount=self.publications_removed)
+        INGEST_ROWS.inc('publications', 'update', amount=self.publications_updated)
+        elapsed = time.time() - self.started_at
+        if elapsed > 0:
+            INGEST_LAST_JOB_RATE.set((self.files_parsed + self.files_skipped) / elapsed, 'files')
+            INGEST_LAST_JOB_RATE.set(self.publications_added / elapsed, 'rows')
+
+    def to_dict(self):
+        elapsed = None
+        if self.started_at is not None:
+            elapsed = (self.finished_at or time.time()) - self.started_at
+
+        def rate(count):
+            return round(count / elapsed, 1) if elapsed else None
+
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "files_total": len(self.paths),
+            "files_parsed": self.files_parsed,
+            "files_processed": self.files_processed,
+            "files_skipped": self.files_skipped,
+            "publications_parsed": self.publications_parsed,
+            "researchers_added": self.researchers_added,
+            "publications_added": self.publications_added,
+            "publications_removed": self.publications_removed,
+            "publications_updated": self.publications_updated,
+            "elapsed_seconds": round(elapsed, 3) if elapsed is not None else None,
+            "files_per_second": rate(self.files_parsed + self.files_skipped),
+            "publications_per_second": rate(self.publications_parsed),
+            "errors": self.errors,
+        }
+
+
+# Ingest jobs of this process, by id. Finished jobs are forgotten oldest
+# first once there are more than INGEST_JOB_HISTORY of them.
+_jobs = collections.OrderedDict()
+_jobs_lock = threading.Lock()
+
+
+# Start ingesting spooled uploads in the background; on_done is called once
+# the job has finished successfully. A profiled job stores its profile
+# with the request profiles.
+def start_job(directory, files, on_done=None, profile=False):
+    job = IngestJob(directory, files, profile)
+
+    async def run():
+        await job.run()
+        if on_done is not None and job.status == 'completed':
+            on_done()
+
+    with _jobs_lock:
+        _jobs[job.id] = job
+        finished = [job_id for job_id, other in _jobs.items() if other.finished_at is not None]
+        for job_id in finished[:max(0, len(finished) - INGEST_JOB_HISTORY)]:
+            del _jobs[job_id]
+
+    job.task = asyncio.get_running_loop().create_task(run())
+    return job
+
+
+def get_job(job_id):
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+# Cancel the jobs still running and wait for them to roll back
+async def shutdown_jobs():
+    with _jobs_lock:
+        tasks = [job.task for job in _jobs.values() if job.task is not None and not job.task.done()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
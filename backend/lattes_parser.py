@@ -0,0 +1,154 @@
+import collections
+import datetime
+import io
+import re
+import xml.etree.ElementTree as ET
+
+# Publication kinds read from PRODUCAO-BIBLIOGRAFICA, in the order they are
+# returned: element tag -> (kind, basic data element, title attribute,
+# year attribute, detail element, venue attribute). The venue is the
+# journal of an article, the publisher of a book, the book of a chapter and
+# the event of a conference paper.
+PUBLICATION_KINDS = {
+    'ARTIGO-PUBLICADO': ('article', 'DADOS-BASICOS-DO-ARTIGO', 'TITULO-DO-ARTIGO', 'ANO-DO-ARTIGO',
+                         'DETALHAMENTO-DO-ARTIGO', 'TITULO-DO-PERIODICO-OU-REVISTA'),
+    'LIVRO-PUBLICADO-OU-ORGANIZADO': ('book', 'DADOS-BASICOS-DO-LIVRO', 'TITULO-DO-LIVRO', 'ANO',
+                                      'DETALHAMENTO-DO-LIVRO', 'NOME-DA-EDITORA'),
+    'CAPITULO-DE-LIVRO-PUBLICADO': ('chapter', 'DADOS-BASICOS-DO-CAPITULO', 'TITULO-DO-CAPITULO-DO-LIVRO', 'ANO',
+                                    'DETALHAMENTO-DO-CAPITULO', 'TITULO-DO-LIVRO'),
+    'TRABALHO-EM-EVENTOS': ('conference', 'DADOS-BASICOS-DO-TRABALHO', 'TITULO-DO-TRABALHO', 'ANO-DO-TRABALHO',
+                            'DETALHAMENTO-DO-TRABALHO', 'NOME-DO-EVENTO'),
+}
+
+# Publication kinds, as stored
+KINDS = tuple(kind for kind, *_ in PUBLICATION_KINDS.values())
+
+# A publication read from a CV. Missing fields are None; the year is an
+# int and the DOI is lowercased, without any URL or "doi:" prefix.
+Publication = collections.namedtuple('Publication', 'title kind year doi venue')
+
+_DOI_PREFIX = re.compile(r'^(?:https?://(?:dx\.)?doi\.org/|doi:\s*)', re.IGNORECASE)
+
+
+def _year(value):
+    value = (value or '').strip()
+    return int(value) if len(value) == 4 and value.isdigit() else None
+
+
+# Normalize a DOI as stored: lowercased, without URL or "doi:" prefix
+def normalize_doi(value):
+    value = _DOI_PREFIX.sub('', (value or '').strip())
+    return value.lower() or None
+
+
+# Function to parse a Lattes XML and extract the researcher name and the
+# publications (title, kind, year, DOI and venue) in a single streaming pass.
+#
+# `source` may be the raw XML bytes, a file path or any binary file-like
+# object (for example an UploadFile's underlying file). Elements are dropped from the
+# partial tree as soon as they are closed, so memory stays bounded by the
+# depth of the document instead of its size.
+def parse_lattes_xml(source):
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+
+    full_name = None
+    found_dados_gerais = False
+
+    # State of the (first) PRODUCAO-BIBLIOGRAFICA section
+    producao = None
+    producao_done = False
+
+    # State of the publication element currently open inside it: its
+    # element, tag and fields read so far (None until its basic data is seen)
+    publication = None
+    publication_kind = None
+    fields = None
+    detail_seen = False
+
+    publications_by_kind = {kind: [] for kind in PUBLICATION_KINDS}
+
+    # Open elements, from the root down to the current one
+    path = []
+
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            tag = elem.tag
+
+            # Attributes are already available on start events
+            if tag == 'DADOS-GERAIS' and path and not found_dados_gerais:
+                found_dados_gerais = True
+                full_name = elem.get('NOME-COMPLETO')
+            elif tag == 'PRODUCAO-BIBLIOGRAFICA' and path and producao is None and not producao_done:
+                producao = elem
+            elif producao is not None:
+                if publication is None and tag in PUBLICATION_KINDS:
+                    publication = elem
+                    publication_kind = tag
+                    fields = None
+                    detail_seen = False
+                elif publication is not None:
+                    kind, basic_data_tag, title_attr, year_attr, detail_tag, venue_attr = \
+                        PUBLICATION_KINDS[publication_kind]
+                    if tag == basic_data_tag and fields is None:
+                        fields = [elem.get(title_attr), kind, _year(elem.get(year_attr)),
+                                  normalize_doi(elem.get('DOI')), None]
+                    elif tag == detail_tag and not detail_seen:
+                        detail_seen = True
+                        venue = (elem.get(venue_attr) or '').strip() or None
+                        if fields is not None:
+                            fields[4] = venue
+
+            path.append(elem)
+        else:
+            path.pop()
+
+            if elem is publication:
+                if fields is not None and fields[0]:
+                    publications_by_kind[publication_kind].append(Publication(*fields))
+                publication = None
+                publication_kind = None
+            elif elem is producao:
+                producao = None
+                producao_done = True
+
+            # The element that just closed is always the last child of its
+            # parent, so it can be detached in constant time
+            elem.clear()
+            if path:
+                del path[-1][-1]
+
+    if not found_dados_gerais:
+        return None, []
+
+    publications = []
+    for kind in PUBLICATION_KINDS:
+        publications.extend(publications_by_kind[kind])
+
+    return full_name, publications
+
+
+# Read the Lattes id (NUMERO-IDENTIFICADOR) and last update date
+# (DATA-ATUALIZACAO) of a CV from its root element, without reading the rest
+# of the document. Either is None when missing. `source` may be the raw XML
+# bytes or a binary file-like object.
+def read_cv_version(source):
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+
+    parser = ET.XMLPullParser(events=('start',))
+    while True:
+        chunk = source.read(16384)
+        if not chunk:
+            return None, None
+        parser.feed(chunk)
+        for _, elem in parser.read_events():
+            return elem.get('NUMERO-IDENTIFICADOR') or None, elem.get('DATA-ATUALIZACAO') or None
+
+
+# Date of a DATA-ATUALIZACAO value (ddmmyyyy), or None if it is not one
+def cv_date(updated_at):
+    try:
+        return datetime.datetime.strptime(updated_at, '%d%m%Y').date()
+    except (TypeError, ValueError):
+        return None
@@ -1,11 +1,43 @@
-from fastapi import FastAPI, UploadFile, File, Query
+from fastapi import FastAPI, UploadFile, File, Query, Header, HTTPException, Response, Depends
+from fastapi.responses import StreamingResponse
+from fastapi.routing import APIRoute
 from fastapi.middleware.cors import CORSMiddleware
-import sqlite3
-import xml.etree.ElementTree as ET
-from typing import List
+import re
+import json
+import base64
+from collections import namedtuple
+from contextlib import contextmanager
+import inspect
+from typing import List, Optional
 import os
 
+from text_utils import normalize_text
+from lattes_parser import KINDS, normalize_doi
+from database import init_db, reader_connection, close_connections, get_generation
+from cache import ResultCache
+from ingest import shutdown_parse_pool
+from jobs import spool_uploads, start_job, get_job, shutdown_jobs
+from semantic import SemanticIndexer
+from autocomplete import Autocompleter, AUTOCOMPLETE_MAX_LIMIT
+from collaboration import Collaborations, COLLABORATION_MAX_LIMIT
+from compression import GzipRequestMiddleware
+from metrics import (RequestMetricsMiddleware, Gauge, STAGE_SECONDS, SEARCH_ROWS_FETCHED, SEARCH_ROWS_RETURNED,
+                     SEARCH_VM_STEPS, render as render_metrics)
+from profiling import (ProfilingMiddleware, PROFILE_ADMIN_TOKEN, is_admin_token, is_profiling, list_profiles,
+                       get_profile, collapsed, start_slow_sampler, stop_slow_sampler, profiled)
+
+
+# Routes whose synchronous endpoints, run in the threadpool, are counted in
+# the profile of their request
+class ProfiledRoute(APIRoute):
+    def __init__(self, path, endpoint, **kwargs):
+        if not inspect.iscoroutinefunction(endpoint):
+            endpoint = profiled(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+
 app = FastAPI()
+app.router.route_class = ProfiledRoute
 
 # Add CORS middleware to allow requests from the frontend
 app.add_middleware(
@@ -14,181 +46,666 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
-# Initialize the database
-def init_db():
-    conn = sqlite3.connect('lattes.db')
-    cursor = conn.cursor()
-    
-    # Create researchers table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS researchers (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        full_name TEXT NOT NULL UNIQUE
-    )
-    ''')
-    
-    # Create publications table with UNIQUE constraint
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS publications (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        title TEXT NOT NULL,
-        researcher_id INTEGER,
-        FOREIGN KEY (researcher_id) REFERENCES researchers (id),
-        UNIQUE(title, researcher_id)
-    )
-    ''')
-    
-    conn.commit()
-    conn.close()
-
-# Initialize the database on startup
+# Record the latency of every request for /metrics
+app.add_middleware(RequestMetricsMiddleware)
+
+# Profile requests on demand or when they are slow, for /debug/profiles
+app.add_middleware(ProfilingMiddleware)
+
+# Accept request bodies compressed with Content-Encoding: gzip
+app.add_middleware(GzipRequestMiddleware)
+
+# Keeps the semantic index over publication titles current once it has
+# been built with `python -m semantic build`
+semantic_indexer = None
+
+# Keeps the autocomplete suggestions current
+autocompleter = None
+
+# Keeps the collaboration graph current
+collaborations = None
+
+# Initialize the database and start the semantic indexer, the autocompleter
+# and the collaboration graph on startup
 @app.on_event("startup")
 async def startup_event():
+    global semantic_indexer, autocompleter, collaborations
     init_db()
+    semantic_indexer = SemanticIndexer()
+    semantic_indexer.start()
+    autocompleter = Autocompleter()
+    autocompleter.start()
+    collaborations = Collaborations()
+    collaborations.start()
+    start_slow_sampler()
 
-# Function to parse XML and extract data
-def parse_lattes_xml(xml_content):
-    root = ET.fromstring(xml_content)
-    
-    # Extract researcher's full name from DADOS-GERAIS
-    dados_gerais = root.find('.//DADOS-GERAIS')
-    if dados_gerais is None:
-        return None, []
-    
-    full_name = dados_gerais.get('NOME-COMPLETO')
-    
-    # Extract publication titles from PRODUCAO-BIBLIOGRAFICA
-    publications = []
-    producao_bibliografica = root.find('.//PRODUCAO-BIBLIOGRAFICA')
-    
-    if producao_bibliografica is not None:
-        # Look for articles
-        for artigo in producao_bibliografica.findall('.//ARTIGO-PUBLICADO'):
-            dados_basicos = artigo.find('.//DADOS-BASICOS-DO-ARTIGO')
-            if dados_basicos is not None and dados_basicos.get('TITULO-DO-ARTIGO'):
-                publications.append(dados_basicos.get('TITULO-DO-ARTIGO'))
-        
-        # Look for books
-        for livro in producao_bibliografica.findall('.//LIVRO-PUBLICADO-OU-ORGANIZADO'):
-            dados_basicos = livro.find('.//DADOS-BASICOS-DO-LIVRO')
-            if dados_basicos is not None and dados_basicos.get('TITULO-DO-LIVRO'):
-                publications.append(dados_basicos.get('TITULO-DO-LIVRO'))
-        
-        # Look for book chapters
-        for capitulo in producao_bibliografica.findall('.//CAPITULO-DE-LIVRO-PUBLICADO'):
-            dados_basicos = capitulo.find('.//DADOS-BASICOS-DO-CAPITULO')
-            if dados_basicos is not None and dados_basicos.get('TITULO-DO-CAPITULO-DO-LIVRO'):
-                publications.append(dados_basicos.get('TITULO-DO-CAPITULO-DO-LIVRO'))
-        
-        # Look for conference papers
-        for trabalho in producao_bibliografica.findall('.//TRABALHO-EM-EVENTOS'):
-            dados_basicos = trabalho.find('.//DADOS-BASICOS-DO-TRABALHO')
-            if dados_basicos is not None and dados_basicos.get('TITULO-DO-TRABALHO'):
-                publications.append(dados_basicos.get('TITULO-DO-TRABALHO'))
-    
-    return full_name, publications
+# Stop the background workers and close the database connections on shutdown
+@app.on_event("shutdown")
+async def shutdown_event():
+    await shutdown_jobs()
+    stop_slow_sampler()
+    semantic_indexer.stop()
+    autocompleter.stop()
+    collaborations.stop()
+    shutdown_parse_pool()
+    close_connections()
 
 # Endpoint to process XML files
-@app.post("/process-xmls")
+# Uploads may be XML files, gzip-compressed XML files (.xml.gz) or ZIP
+# archives of XML files. They are spooled to disk and ingested by a
+# background job; the response carries the job id to follow its progress
+# with GET /jobs/{id}. When the request is profiled, so is the job.
+@app.post("/process-xmls", status_code=202)
 async def process_xmls(files: List[UploadFile] = File(...)):
-    conn = sqlite3.connect('lattes.db')
-    cursor = conn.cursor()
-    
-    processed_count = 0
-    researchers_count = 0
-    publications_count = 0
-    
-    for file in files:
-        if not file.filename.endswith('.xml'):
-            continue
-        
-        content = await file.read()
-        full_name, publications = parse_lattes_xml(content)
-        
-        if full_name and publications:
-            # Insert or get researcher
-            cursor.execute("SELECT id FROM researchers WHERE full_name = ?", (full_name,))
-            researcher = cursor.fetchone()
-            
-            if researcher is None:
-                cursor.execute("INSERT INTO researchers (full_name) VALUES (?)", (full_name,))
-                researcher_id = cursor.lastrowid
-                researchers_count += 1
-            else:
-                researcher_id = researcher[0]
-            
-            # Insert publications using INSERT OR IGNORE to prevent duplicates
-            for title in publications:
-                cursor.execute("INSERT OR IGNORE INTO publications (title, researcher_id) VALUES (?, ?)", 
-                              (title, researcher_id))
-                # Only increment the count if a row was actually inserted
-                if cursor.rowcount > 0:
-                    publications_count += 1
-            
-            processed_count += 1
-    
-    conn.commit()
-    conn.close()
+    directory, spooled, ignored = await spool_uploads(files)
+    
+    # Files are parsed in parallel worker processes and written by a single
+    # writer; the new publications are indexed for semantic search,
+    # autocomplete and the collaboration graph right after
+    job = start_job(directory, spooled, on_done=_data_changed, profile=is_profiling())
     
     return {
-        "message": f"Successfully processed {processed_count} XML files",
-        "researchers_added": researchers_count,
-        "publications_added": publications_count
+        "message": f"Processing {len(spooled)} XML files",
+        "job_id": job.id,
+        "status": job.status,
+        "ignored_files": ignored
     }
 
+def _data_changed():
+    semantic_indexer.wake()
+    autocompleter.wake()
+    collaborations.wake()
+
+# Endpoint to get the progress of an ingest job
+@app.get("/jobs/{job_id}")
+async def get_ingest_job(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+# Cache of search results, invalidated whenever the data generation changes
+search_cache = ResultCache()
+
+SEARCH_CACHE_STATS = Gauge("search_cache", "Size and hit/miss/eviction counters of the search result cache",
+                           ("stat",))
+
+# Return the cached value for the key, computing it on a miss.
+# The generation is read before searching, so a result is never cached
+# under a generation newer than its data.
+def _cached(cursor, cache_key, search):
+    generation = get_generation(cursor)
+    cached = search_cache.get(cache_key, generation)
+    if cached is None:
+        cached = search(cursor)
+        search_cache.put(cache_key, generation, cached)
+    return cached
+
+# Build an FTS5 query from free text: every word must match, as a prefix
+def build_fts_query(query):
+    terms = re.findall(r'\w+', query)
+    return ' '.join(f'"{term}"*' for term in terms)
+
+# Pagination cursors are the sort key of the last row returned, as
+# URL-safe base64 JSON. They are opaque to clients.
+def _encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode()
+
+def _decode_cursor(cursor, key_length):
+    if cursor is None:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        key = None
+    if not isinstance(key, list) or len(key) != key_length:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return key
+
+# Filters on publication metadata accepted by the search endpoints. kind
+# is a tuple of publication kinds; a publication matches any of them.
+SearchFilters = namedtuple("SearchFilters", "year_from year_to kind doi venue")
+
+def search_filters(year_from: Optional[int] = Query(None, ge=1),
+                   year_to: Optional[int] = Query(None, ge=1),
+                   kind: Optional[List[str]] = Query(None),
+                   doi: Optional[str] = Query(None),
+                   venue: Optional[str] = Query(None)):
+    for value in kind or ():
+        if value not in KINDS:
+            raise HTTPException(status_code=400,
+                                detail=f"Unknown publication kind '{value}', expected one of {', '.join(KINDS)}")
+    return SearchFilters(year_from, year_to, tuple(sorted(set(kind))) if kind else None,
+                         normalize_doi(doi) if doi else None, venue)
+
+# SQL conditions and parameters of the filters, on the table with the given
+# alias. The year and kind filters also apply to the publication count tables.
+def _filter_conditions(filters, alias="p"):
+    conditions = []
+    params = []
+    if filters.year_from is not None:
+        conditions.append(f"{alias}.year >= ?")
+        params.append(filters.year_from)
+    if filters.year_to is not None:
+        conditions.append(f"{alias}.year <= ?")
+        params.append(filters.year_to)
+    if filters.kind:
+        conditions.append(f"{alias}.kind IN ({','.join('?' * len(filters.kind))})")
+        params.extend(filters.kind)
+    if filters.doi is not None:
+        conditions.append(f"{alias}.doi = ?")
+        params.append(filters.doi)
+    if filters.venue is not None:
+        conditions.append(f"{alias}.venue_id = (SELECT id FROM venues WHERE name = ?)")
+        params.append(filters.venue)
+    return conditions, params
+
+_NO_FILTERS = SearchFilters(None, None, None, None, None)
+
+# A search is the FROM and WHERE clauses selecting the matching publications
+# (p) with their researchers (r) and venues (v), their parameters, and the columns of the
+# sort key, which keyset pagination continues after.
+#
+# Title search: full-text matches in BM25 order (ties broken by id), or
+# substring matches in id order. Without a query, the publications matching
+# the filters, in id order.
+def _title_search(query, mode, filters=_NO_FILTERS):
+    conditions, params = _filter_conditions(filters)
+    fts_query = build_fts_query(query) if query is not None and mode == "fts" else ""
+    
+    if fts_query:
+        # Full-text search, best BM25 matches first
+        from_sql = """
+        FROM publications_fts f 
+        JOIN publications p ON p.id = f.rowid 
+        JOIN researchers r ON p.researcher_id = r.id 
+        LEFT JOIN venues v ON v.id = p.venue_id 
+        WHERE publications_fts MATCH ? 
+        """
+        params = [fts_query] + params
+        order = ["f.rank", "p.id"]
+    elif query is not None:
+        # Search for publications with titles containing the query (case-insensitive)
+        from_sql = """
+        FROM publications p 
+        JOIN researchers r ON p.researcher_id = r.id 
+        LEFT JOIN venues v ON v.id = p.venue_id 
+        WHERE LOWER(p.title) LIKE LOWER(?) 
+        """
+        params = [f'%{query}%'] + params
+        order = ["p.id"]
+    else:
+        from_sql = """
+        FROM publications p 
+        JOIN researchers r ON p.researcher_id = r.id 
+        LEFT JOIN venues v ON v.id = p.venue_id 
+        WHERE 1 
+        """
+        order = ["p.id"]
+    
+    return from_sql + "".join(f"AND {condition} " for condition in conditions), params, order
+
+# Author search: researchers with names containing the query (case- and
+# accent-insensitive) through the trigram index, and all their publications,
+# ordered by researcher name and title (unique together)
+def _author_search(name, filters=_NO_FILTERS):
+    conditions, params = _filter_conditions(filters)
+    from_sql = """
+    FROM researchers_trigram t
+    JOIN researchers r ON r.id = t.rowid
+    JOIN publications p ON p.researcher_id = r.id 
+    LEFT JOIN venues v ON v.id = p.venue_id 
+    WHERE t.normalized_name LIKE ? 
+    """
+    return (from_sql + "".join(f"AND {condition} " for condition in conditions),
+            [f'%{normalize_text(name)}%'] + params, ["r.full_name", "p.title"])
+
+# Columns of a search result, selected before the sort key
+_RESULT_COLUMNS = "p.title, r.full_name, p.kind, p.year, p.doi, v.name"
+_RESULT_COLUMN_COUNT = 6
+
+def _result(row):
+    return {
+        "title": row[0],
+        "researcher": row[1],
+        "kind": row[2],
+        "year": row[3],
+        "doi": row[4],
+        "venue": row[5]
+    }
+
+# Results of rows of _RESULT_COLUMNS
+def _results(rows):
+    return [_result(row) for row in rows]
+
+# Columns of a work result, selected before the sort key instead of
+# _RESULT_COLUMNS (and as many): the work's first publication (w) stands
+# for it
+_WORK_COLUMNS = "w.title, w.work_id, w.kind, w.year, w.doi, v.name"
+
+# Results of rows of _WORK_COLUMNS: works with all their researchers, in
+# name order
+def _work_results(conn, rows):
+    researchers = {row[1]: [] for row in rows}
+    if researchers:
+        placeholders = ','.join('?' * len(researchers))
+        cursor = conn.execute(f"""
+        SELECT p.work_id, r.full_name FROM publications p JOIN researchers r ON r.id = p.researcher_id 
+        WHERE p.work_id IN ({placeholders}) ORDER BY p.work_id, r.full_name
+        """, list(researchers))
+        for work_id, full_name in cursor:
+            researchers[work_id].append(full_name)
+    return [{
+        "work_id": row[1],
+        "title": row[0],
+        "researchers": researchers[row[1]],
+        "kind": row[2],
+        "year": row[3],
+        "doi": row[4],
+        "venue": row[5]
+    } for row in rows]
+
+# The query of a search: its results and sort key, after the cursor's row.
+# By work, its matching publications are grouped by work, each work coming
+# at the place of its first match (by the first column of the sort key,
+# then work id). Publications not assigned a work yet are left out.
+def _search_sql(search, cursor=None, by_work=False):
+    from_sql, params, order = search
+    columns = _RESULT_COLUMNS
+    if by_work:
+        from_sql = f"""
+        FROM (SELECT p.work_id, MIN({order[0]}) AS first_key {from_sql}GROUP BY p.work_id) m 
+        JOIN publications w ON w.id = (SELECT MIN(id) FROM publications WHERE work_id = m.work_id) 
+        LEFT JOIN venues v ON v.id = w.venue_id 
+        WHERE 1 
+        """
+        order = ["m.first_key", "m.work_id"]
+        columns = _WORK_COLUMNS
+    after = _decode_cursor(cursor, len(order))
+    sort_key = ", ".join(order)
+    sql = f"SELECT {columns}, {sort_key} {from_sql}"
+    if after is not None:
+        sql += f"AND ({sort_key}) > ({', '.join('?' * len(order))}) "
+        params = params + after
+    sql += f"ORDER BY {sort_key}"
+    return sql, params
+
+def _title_search_sql(query, mode, cursor=None, filters=_NO_FILTERS, by_work=False):
+    return _search_sql(_title_search(query, mode, filters), cursor, by_work)
+
+def _author_search_sql(name, cursor=None, filters=_NO_FILTERS, by_work=False):
+    return _search_sql(_author_search(name, filters), cursor, by_work)
+
+# Number of researchers in the top_researchers facet
+FACET_TOP_RESEARCHERS = 10
+
+# Fold (researcher id, year, kind, count) rows into facets: publication
+# counts per year (most recent first), per kind and for the researchers
+# with most publications. Unknown years and kinds (0 and '' in the count
+# tables) are reported as null.
+def _facets(cursor, rows, top_researchers=None):
+    years = {}
+    kinds = {}
+    researchers = {}
+    for researcher_id, year, kind, count in rows:
+        years[year or None] = years.get(year or None, 0) + count
+        kinds[kind or None] = kinds.get(kind or None, 0) + count
+        if top_researchers is None:
+            researchers[researcher_id] = researchers.get(researcher_id, 0) + count
+    if top_researchers is None:
+        top_researchers = sorted(researchers.items(), key=lambda item: (-item[1], item[0]))[:FACET_TOP_RESEARCHERS]
+    
+    names = {}
+    if top_researchers:
+        placeholders = ','.join('?' * len(top_researchers))
+        cursor.execute(f"SELECT id, full_name FROM researchers WHERE id IN ({placeholders})",
+                       [researcher_id for researcher_id, _ in top_researchers])
+        names = dict(cursor.fetchall())
+    
+    return {
+        "years": [{"year": year, "count": count}
+                  for year, count in sorted(years.items(), key=lambda item: -(item[0] or 0))],
+        "kinds": [{"kind": kind, "count": count}
+                  for kind, count in sorted(kinds.items(), key=lambda item: (-item[1], item[0] or ""))],
+        "top_researchers": [{"researcher": names.get(researcher_id), "count": count}
+                            for researcher_id, count in top_researchers],
+    }
+
+# Facets of a search, counted over its matching publications. Used when the
+# publication count tables cannot answer: for title queries, and for DOI and
+# venue filters.
+def _facets_of_matches(cursor, search):
+    from_sql, params, _ = search
+    cursor.execute(f"SELECT p.researcher_id, p.year, p.kind, COUNT(*) {from_sql} GROUP BY 1, 2, 3", params)
+    return _facets(cursor, cursor.fetchall())
+
+# Facets of the publications matching the filters, or of all publications,
+# summed from the publication count tables
+def _title_facets(cursor, query, mode, filters):
+    if query is not None or filters.doi is not None or filters.venue is not None:
+        return _facets_of_matches(cursor, _title_search(query, mode, filters))
+    
+    conditions, params = _filter_conditions(filters, "c")
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    cursor.execute(f"""
+    SELECT researcher_id, SUM(count) FROM publication_counts c {where} 
+    GROUP BY researcher_id ORDER BY 2 DESC, 1 LIMIT ?
+    """, params + [FACET_TOP_RESEARCHERS])
+    top_researchers = cursor.fetchall()
+    cursor.execute(f"SELECT NULL, year, kind, count FROM publication_year_counts c {where}", params)
+    return _facets(cursor, cursor.fetchall(), top_researchers)
+
+# Facets of an author search, summed from the counts of the matching researchers
+def _author_facets(cursor, name, filters):
+    if filters.doi is not None or filters.venue is not None:
+        return _facets_of_matches(cursor, _author_search(name, filters))
+    
+    conditions, params = _filter_conditions(filters, "c")
+    cursor.execute(f"""
+    SELECT c.researcher_id, c.year, c.kind, c.count 
+    FROM researchers_trigram t 
+    JOIN publication_counts c ON c.researcher_id = t.rowid 
+    WHERE t.normalized_name LIKE ? {"".join(f"AND {condition} " for condition in conditions)}
+    """, [f'%{normalize_text(name)}%'] + params)
+    return _facets(cursor, cursor.fetchall())
+
+# Count, in thousands, the SQLite virtual machine instructions run on a
+# connection while the block runs: a cheap measure of the rows scanned
+@contextmanager
+def _count_vm_steps(conn, endpoint):
+    steps = [0]
+    
+    def progress():
+        steps[0] += 1
+    
+    conn.set_progress_handler(progress, 1000)
+    try:
+        yield
+    finally:
+        conn.set_progress_handler(None, 1000)
+        SEARCH_VM_STEPS.observe(steps[0], endpoint)
+
+# Run a search query and return a page of results with the cursor of the
+# next page (None on the last page, or when no limit was given). Rows are
+# made results by _results, or by format_rows, a function of the connection
+# and the rows such as _work_results.
+def _search_page(cursor, sql, params, limit, endpoint="/search", format_rows=None):
+    if limit is not None:
+        # One extra row tells whether there is a next page
+        sql += " LIMIT ?"
+        params = params + [limit + 1]
+    with STAGE_SECONDS.time("db_query"), _count_vm_steps(cursor.connection, endpoint):
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    SEARCH_ROWS_FETCHED.observe(len(rows), endpoint)
+    
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1][_RESULT_COLUMN_COUNT:])
+    
+    results = _results(rows) if format_rows is None else format_rows(cursor.connection, rows)
+    
+    return results, next_cursor
+
+# Yield the results of a search query as NDJSON, straight from the database
+# cursor, a batch of rows at a time. The reader connection is held until the
+# response is complete.
+@profiled
+def _stream_search(sql, params, limit, endpoint, batch_size=500, format_rows=None):
+    if limit is not None:
+        sql += " LIMIT ?"
+        params = params + [limit]
+    row_count = 0
+    with reader_connection() as conn, _count_vm_steps(conn, endpoint):
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        while True:
+            with STAGE_SECONDS.time("db_query"):
+                rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            row_count += len(rows)
+            results = _results(rows) if format_rows is None else format_rows(conn, rows)
+            with STAGE_SECONDS.time("json_serialization"):
+                chunk = ''.join(
+                    json.dumps(result, ensure_ascii=False) + "\n"
+                    for result in results
+                )
+            yield chunk
+    SEARCH_ROWS_FETCHED.observe(row_count, endpoint)
+    SEARCH_ROWS_RETURNED.observe(row_count, endpoint)
+
+# Serialize a response body as JSON, the same way FastAPI does, timing it
+def _json_response(content, headers=None):
+    with STAGE_SECONDS.time("json_serialization"):
+        body = json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+    return Response(body, media_type="application/json", headers=headers)
+
+# Serve a search: streamed as NDJSON when requested, otherwise a (cached)
+# page of results with the next page's cursor in the X-Next-Cursor header.
+# With facets, a (cache key, function of a cursor) pair, the page and the
+# facets are returned together as {"results", "facets"}; facets are cached
+# separately from pages, so paging does not count them again.
+def _search_response(endpoint, cache_key, sql, params, limit, stream, facets=None, format_rows=None):
+    if stream:
+        if facets is not None:
+            raise HTTPException(status_code=400, detail="Facets are not available with stream=true")
+        return StreamingResponse(_stream_search(sql, params, limit, endpoint, format_rows=format_rows),
+                                 media_type="application/x-ndjson")
+    
+    with reader_connection() as conn:
+        cursor = conn.cursor()
+        results, next_cursor = _cached(cursor, cache_key,
+                                       lambda cursor: _search_page(cursor, sql, params, limit, endpoint, format_rows))
+        if facets is not None:
+            facets_key, count_facets = facets
+            with STAGE_SECONDS.time("facets"):
+                counts, _ = _cached(cursor, facets_key, lambda cursor: (count_facets(cursor), None))
+    SEARCH_ROWS_RETURNED.observe(len(results), endpoint)
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor is not None else None
+    if facets is not None:
+        return _json_response({"results": results, "facets": counts}, headers)
+    return _json_response(results, headers)
+
 # Endpoint to search for publications by title
+# mode=fts (default) runs a ranked full-text search over title words;
+# mode=substring keeps the plain case-insensitive substring match.
+# year_from, year_to, kind (repeatable), doi and venue filter the results;
+# without a query, the publications matching the filters are listed.
+# limit and cursor page through the results; stream=true returns NDJSON;
+# facets=true adds publication counts per year, kind and researcher.
+# by_work=true returns one result per work instead of per publication, with
+# all the researchers listing it; facets still count publications.
+# Search handlers are plain functions, so FastAPI runs them in its thread
+# pool, each on its own pooled reader connection.
 @app.get("/search")
-async def search_publications(query: str = Query(...)):
-    conn = sqlite3.connect('lattes.db')
-    cursor = conn.cursor()
-    
-    # Search for publications with titles containing the query (case-insensitive)
-    cursor.execute("""
-    SELECT p.title, r.full_name 
-    FROM publications p 
-    JOIN researchers r ON p.researcher_id = r.id 
-    WHERE LOWER(p.title) LIKE LOWER(?)
-    """, (f'%{query}%',))
-    
-    results = []
-    for row in cursor.fetchall():
-        results.append({
-            "title": row[0],
-            "researcher": row[1]
-        })
-    
-    conn.close()
-    
-    return results
-
-# Endpoint to search for publications by author name
+def search_publications(query: Optional[str] = Query(None),
+                        mode: str = Query("fts", pattern="^(fts|substring)$"),
+                        limit: Optional[int] = Query(None, ge=1, le=10000),
+                        cursor: Optional[str] = Query(None),
+                        stream: bool = Query(False),
+                        facets: bool = Query(False),
+                        by_work: bool = Query(False),
+                        filters: SearchFilters = Depends(search_filters)):
+    if query is None and filters == _NO_FILTERS:
+        raise HTTPException(status_code=400, detail="A query or a filter is required")
+    sql, params = _title_search_sql(query, mode, cursor, filters, by_work)
+    # Full-text matching ignores case and accents, so normalized queries
+    # share cache entries; substring matching does not
+    query_key = normalize_text(query) if query is not None and mode == "fts" else query
+    cache_key = ("search", mode, query_key, filters, limit, cursor, by_work)
+    facets_key = ("search-facets", mode, query_key, filters)
+    return _search_response("/search", cache_key, sql, params, limit, stream,
+                            (facets_key, lambda cursor: _title_facets(cursor, query, mode, filters)) if facets else None,
+                            _work_results if by_work else None)
+
+# Endpoint to search for publications by author name, with the same
+# filters and options as /search
 @app.get("/search-by-author")
-async def search_publications_by_author(name: str = Query(...)):
-    conn = sqlite3.connect('lattes.db')
-    cursor = conn.cursor()
-    
-    # Search for researchers with names containing the query (case-insensitive)
-    # and retrieve all their publications
-    cursor.execute("""
-    SELECT p.title, r.full_name 
-    FROM researchers r
-    JOIN publications p ON p.researcher_id = r.id 
-    WHERE LOWER(r.full_name) LIKE LOWER(?)
-    ORDER BY r.full_name, p.title
-    """, (f'%{name}%',))
-    
-    results = []
-    for row in cursor.fetchall():
-        results.append({
-            "title": row[0],
-            "researcher": row[1]
-        })
+def search_publications_by_author(name: str = Query(...),
+                                  limit: Optional[int] = Query(None, ge=1, le=10000),
+                                  cursor: Optional[str] = Query(None),
+                                  stream: bool = Query(False),
+                                  facets: bool = Query(False),
+                                  by_work: bool = Query(False),
+                                  filters: SearchFilters = Depends(search_filters)):
+    sql, params = _author_search_sql(name, cursor, filters, by_work)
+    cache_key = ("search-by-author", normalize_text(name), filters, limit, cursor, by_work)
+    facets_key = ("search-by-author-facets", normalize_text(name), filters)
+    return _search_response("/search-by-author", cache_key, sql, params, limit, stream,
+                            (facets_key, lambda cursor: _author_facets(cursor, name, filters)) if facets else None,
+                            _work_results if by_work else None)
+
+# Endpoint returning the facets of all publications, or of those matching
+# the filters, for dashboards. Without DOI and venue filters, they are
+# summed from the publication count tables.
+@app.get("/facets")
+def get_facets(filters: SearchFilters = Depends(search_filters)):
+    with reader_connection() as conn, STAGE_SECONDS.time("facets"):
+        counts, _ = _cached(conn.cursor(), ("facets", filters),
+                            lambda cursor: (_title_facets(cursor, None, "fts", filters), None))
+    return _json_response(counts)
+
+# Endpoint suggesting researchers whose name (or a word of it) starts with
+# the query, and completions of its last word with frequent title terms,
+# for search boxes to call on every keystroke. Suggestions are served from
+# memory, so unlike the search endpoints it runs on the event loop.
+@app.get("/autocomplete")
+async def autocomplete(q: str = Query(..., min_length=1, max_length=200),
+                       limit: int = Query(10, ge=1, le=AUTOCOMPLETE_MAX_LIMIT)):
+    return _json_response(autocompleter.suggest(q, limit))
+
+# Endpoint listing the researchers whose names contain the term, ignoring
+# case and accents, with their ids for the collaboration endpoints
+@app.get("/researchers")
+def list_researchers(name: str = Query(..., min_length=1),
+                     limit: int = Query(20, ge=1, le=100)):
+    with reader_connection() as conn:
+        cursor = conn.execute("""
+        SELECT r.id, r.full_name FROM researchers_trigram t JOIN researchers r ON r.id = t.rowid 
+        WHERE t.normalized_name LIKE ? ORDER BY r.full_name LIMIT ?
+        """, (f'%{normalize_text(name)}%', limit))
+        return _json_response([{"id": researcher_id, "name": full_name} for researcher_id, full_name in cursor])
+
+# Names of researchers by id; raises a 404 error if any does not exist
+def _researcher_names(conn, researcher_ids):
+    names = {}
+    for start in range(0, len(researcher_ids), 500):
+        chunk = researcher_ids[start:start + 500]
+        placeholders = ','.join('?' * len(chunk))
+        names.update(conn.execute(f"SELECT id, full_name FROM researchers WHERE id IN ({placeholders})", chunk))
+    for researcher_id in researcher_ids:
+        if researcher_id not in names:
+            raise HTTPException(status_code=404, detail=f"Researcher {researcher_id} not found")
+    return names
+
+def _collaboration_graph():
+    graph = collaborations.graph
+    if graph is None:
+        raise HTTPException(status_code=503, detail="Collaboration graph not built yet, try again shortly")
+    return graph
+
+# Endpoint returning the researchers who share most works with a researcher,
+# most shared first, from the in-memory collaboration graph
+@app.get("/researchers/{researcher_id}/collaborators")
+def get_collaborators(researcher_id: int, k: int = Query(10, ge=1, le=COLLABORATION_MAX_LIMIT)):
+    collaborators = _collaboration_graph().collaborators(researcher_id, k)
+    with reader_connection() as conn:
+        names = _researcher_names(conn, [researcher_id] + [collaborator_id for collaborator_id, _ in collaborators])
+    return _json_response({
+        "id": researcher_id,
+        "name": names[researcher_id],
+        "collaborators": [{"id": collaborator_id, "name": names[collaborator_id], "shared_works": shared_works}
+                          for collaborator_id, shared_works in collaborators],
+    })
+
+# Endpoint returning a shortest chain of collaborations between two
+# researchers (each sharing a work with the next), or null if there is none
+@app.get("/collaboration-path")
+def get_collaboration_path(from_id: int = Query(..., alias="from"), to_id: int = Query(..., alias="to")):
+    path = _collaboration_graph().path(from_id, to_id)
+    with reader_connection() as conn:
+        names = _researcher_names(conn, path or [from_id, to_id])
+    return _json_response({
+        "path": [{"id": researcher_id, "name": names[researcher_id]} for researcher_id in path]
+        if path is not None else None,
+    })
+
+# Fetch the search results of the given publications, in the given order
+def _fetch_publications(cursor, publication_ids):
+    rows = {}
+    for start in range(0, len(publication_ids), 500):
+        chunk = publication_ids[start:start + 500]
+        placeholders = ','.join('?' * len(chunk))
+        cursor.execute(f"""
+        SELECT {_RESULT_COLUMNS}, p.id 
+        FROM publications p 
+        JOIN researchers r ON p.researcher_id = r.id 
+        LEFT JOIN venues v ON v.id = p.venue_id 
+        WHERE p.id IN ({placeholders})
+        """, chunk)
+        for row in cursor.fetchall():
+            rows[row[_RESULT_COLUMN_COUNT]] = _result(row)
+    return [rows[publication_id] for publication_id in publication_ids if publication_id in rows]
+
+# Endpoint to search for publications with titles semantically close to the query
+# nprobe (IVF indexes only) sets how many inverted lists are scanned:
+# higher is slower but finds more of the exact nearest neighbors
+@app.get("/semantic-search")
+def semantic_search(query: str = Query(...), k: int = Query(10, ge=1, le=1000),
+                    nprobe: Optional[int] = Query(None, ge=1)):
+    semantic_index = semantic_indexer.index
+    if semantic_index is None:
+        raise HTTPException(status_code=503,
+                            detail="Semantic index not built. Run `python -m semantic build` in the backend directory.")
     
-    conn.close()
+    with STAGE_SECONDS.time("semantic_search"):
+        hits = semantic_index.search(query, k, nprobe)
     
-    return results
+    with reader_connection() as conn, STAGE_SECONDS.time("db_query"):
+        results = _fetch_publications(conn.cursor(), [publication_id for publication_id, _ in hits])
+    SEARCH_ROWS_RETURNED.observe(len(results), "/semantic-search")
+    return _json_response(results)
+
+# Endpoint to monitor the search result cache
+@app.get("/cache/stats")
+async def cache_stats():
+    return search_cache.stats()
+
+# Endpoint exposing the metrics of this process in the Prometheus text format
+@app.get("/metrics")
+async def get_metrics():
+    for stat, value in search_cache.stats().items():
+        SEARCH_CACHE_STATS.set(value, stat)
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4")
+
+# Profiles are only served to admins
+def _require_admin(token):
+    if PROFILE_ADMIN_TOKEN is None:
+        raise HTTPException(status_code=403, detail="Profiling is disabled. Set PROFILE_ADMIN_TOKEN to enable it.")
+    if not is_admin_token(token):
+        raise HTTPException(status_code=403, detail="Invalid profile token")
+
+# Endpoint listing the stored profiles, most recent first
+# The admin token is passed in the X-Profile-Token header or the token parameter.
+@app.get("/debug/profiles")
+async def debug_profiles(token: Optional[str] = Query(None), x_profile_token: Optional[str] = Header(None)):
+    _require_admin(x_profile_token or token)
+    return list_profiles()
+
+# Endpoint serving one profile in collapsed-stack format, for flamegraph tools
+@app.get("/debug/profiles/{profile_id}")
+async def debug_profile(profile_id: int, token: Optional[str] = Query(None),
+                        x_profile_token: Optional[str] = Header(None)):
+    _require_admin(x_profile_token or token)
+    profile = get_profile(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return Response(collapsed(profile), media_type="text/plain")
 
 # Root endpoint for testing
 @app.get("/")
@@ -0,0 +1,190 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# In-process metrics, exposed in the Prometheus text format by GET /metrics.
+#
+# Every metric keeps its values per combination of label values, guarded by
+# its own lock; recording a value is a dictionary lookup and a few additions.
+# Values are per backend process.
+
+# Default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Histogram buckets for row counts
+ROW_BUCKETS = (0, 1, 10, 20, 50, 100, 500, 1000, 5000, 10000, 50000, 100000, 1000000)
+
+# Every metric created, in creation order
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        lines = self._header()
+        for label_values, value in sorted(values):
+            lines.append(f'{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}')
+        return lines
+
+
+# Monotonically increasing count
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+# Value that can go up and down
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+
+# Distribution of observed values over fixed buckets
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                # Per-bucket counts (the last one is +Inf), sum
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0]
+            state[0][index] += 1
+            state[1] += value
+
+    # Observe the duration of the block, in seconds
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def render(self):
+        with self._lock:
+            values = [(label_values, (list(counts), total)) for label_values, (counts, total) in self._values.items()]
+        lines = self._header()
+        for label_values, (counts, total) in sorted(values):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labels, label_values, ('le', _format_value(float(bound))))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+# All metrics in the Prometheus text exposition format
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+REQUEST_SECONDS = Histogram('http_request_duration_seconds',
+                            "Time to serve an HTTP request, until its response body is sent",
+                            ('method', 'endpoint', 'status'))
+
+STAGE_SECONDS = Histogram('stage_duration_seconds',
+                          "Time spent in a processing stage (xml_parse, fingerprint, spool, db_write, db_commit, "
+                          "db_query, facets, json_serialization, semantic_search)",
+                          ('stage',))
+
+DB_CONNECTION_WAIT_SECONDS = Histogram('db_connection_wait_seconds',
+                                       "Time waited to get a database connection",
+                                       ('kind',))
+
+SEARCH_ROWS_FETCHED = Histogram('search_rows_fetched',
+                                "Rows read from the database per search", ('endpoint',), ROW_BUCKETS)
+
+SEARCH_ROWS_RETURNED = Histogram('search_rows_returned',
+                                 "Rows returned per search", ('endpoint',), ROW_BUCKETS)
+
+SEARCH_VM_STEPS = Histogram('search_vm_steps',
+                            "Thousands of SQLite virtual machine instructions run per search, "
+                            "a measure of the rows scanned", ('endpoint',), ROW_BUCKETS)
+
+INGEST_FILES = Counter('ingest_files_total', "Uploaded files handled by ingest jobs, by result", ('result',))
+
+INGEST_ROWS = Counter('ingest_rows_total', "Rows written by ingest jobs", ('table', 'operation'))
+
+INGEST_LAST_JOB_RATE = Gauge('ingest_last_job_rate', "Throughput of the last finished ingest job, per second",
+                             ('unit',))
+
+
+# ASGI middleware recording the latency of every HTTP request. The endpoint
+# label is the route's path template, so path parameters do not multiply
+# the number of series.
+class RequestMetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get('route')
+            endpoint = route.path if route is not None else 'unmatched'
+            REQUEST_SECONDS.observe(time.perf_counter() - started, scope['method'], endpoint, str(status))
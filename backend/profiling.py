@@ -0,0 +1,392 @@
+import collections
+import contextvars
+import functools
+import hmac
+import inspect
+import itertools
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from urllib.parse import parse_qs
+
+# Opt-in sampling profiler for diagnosing slow requests in production.
+#
+# A sampler thread periodically reads the stacks of the other threads of the
+# process (sys._current_frames) and keeps those running backend code, in the
+# collapsed-stack format of flamegraph tools: frames from the root to the
+# leaf, separated by ';', each as "function (file:line)". Time spent in
+# SQLite or other C code shows on the line of the Python frame calling it.
+#
+# A request is profiled when an admin asks for it (X-Profile-Token header or
+# profile query parameter set to PROFILE_ADMIN_TOKEN), or when it takes
+# longer than PROFILE_SLOW_THRESHOLD seconds, in which case its profile is
+# taken from a background sampler that runs continuously at a lower rate.
+# Profiles are kept in a ring buffer and served by /debug/profiles.
+#
+# A profile only has the stacks of the request's own work (its ProfileScope):
+# those of its coroutine on the event loop thread, and those of the threads
+# running its synchronous code, which count themselves in through profiled()
+# and carry_profile(). Concurrent requests and background threads (indexer,
+# autocomplete, collaboration graph) are left out.
+
+# Token admins pass to profile a request and to read profiles; profiling on
+# demand is disabled when it is not set
+PROFILE_ADMIN_TOKEN = os.environ.get('PROFILE_ADMIN_TOKEN') or None
+
+# Requests slower than this many seconds are profiled automatically
+# (0 disables the background sampler)
+PROFILE_SLOW_THRESHOLD = float(os.environ.get('PROFILE_SLOW_THRESHOLD', 0))
+
+# Number of profiles kept
+PROFILE_HISTORY = int(os.environ.get('PROFILE_HISTORY', 20))
+
+# Seconds between two samples of a profile asked for by an admin
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.001))
+
+# Seconds between two samples of the background sampler used for slow requests
+PROFILE_SLOW_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SLOW_SAMPLE_INTERVAL', 0.01))
+
+# Seconds of samples the background sampler keeps
+PROFILE_SLOW_WINDOW = float(os.environ.get('PROFILE_SLOW_WINDOW', 120))
+
+# Only stacks with a frame from the backend directory are kept, which leaves
+# out idle server and thread pool threads
+_APP_DIR = os.path.dirname(os.path.abspath(__file__)) + os.sep
+
+# Threads of the running samplers, which are never sampled
+_sampler_threads = set()
+
+# Set while an admin-requested profile of the current request is running
+_profiling = ContextVar('profiling', default=False)
+
+# Scope of the request or job being profiled, if any
+_scope = ContextVar('profile_scope', default=None)
+
+# Scopes of the requests running while the slow request sampler runs
+_active_scopes = set()
+_active_scopes_lock = threading.Lock()
+
+
+# The work of a profiled request or job: the frame of its coroutine, below
+# which the frames of the event loop thread are its own (and not those of
+# another request running on the loop), and the threads currently running
+# its synchronous code
+class ProfileScope:
+    def __init__(self, frame):
+        self.frame = frame
+        self.thread_ids = set()
+
+    # Whether the stack of a thread, as its frames from the leaf, is this scope's
+    def owns(self, thread_id, frames):
+        return thread_id in self.thread_ids or any(frame is self.frame for frame in frames)
+
+
+# Profile the work of the calling coroutine, and of the threads it hands
+# work to, under a scope
+@contextmanager
+def profile_scope(scope):
+    token = _scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _scope.reset(token)
+
+
+# Count the calling thread in the profiled scope of its context, if any,
+# while the block runs
+@contextmanager
+def _scope_thread():
+    scope = _scope.get()
+    thread_id = threading.get_ident()
+    if scope is None or thread_id in scope.thread_ids:
+        yield
+        return
+    scope.thread_ids.add(thread_id)
+    try:
+        yield
+    finally:
+        scope.thread_ids.discard(thread_id)
+
+
+# Decorator of functions run in a thread pool that carries the context of
+# the request (as Starlette's does for synchronous endpoints and streamed
+# generators): the thread is counted in the request's profile while it runs
+# the function, or every step of the generator.
+def profiled(function):
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def generate(*args, **kwargs):
+            iterator = function(*args, **kwargs)
+            try:
+                while True:
+                    with _scope_thread():
+                        try:
+                            item = next(iterator)
+                        except StopIteration:
+                            return
+                    yield item
+            finally:
+                iterator.close()
+        return generate
+
+    @functools.wraps(function)
+    def run(*args, **kwargs):
+        with _scope_thread():
+            return function(*args, **kwargs)
+    return run
+
+
+# Wrap a function for an executor, which does not carry context variables,
+# so that the thread running it is counted in the profile of the caller
+def carry_profile(function):
+    if _scope.get() is None:
+        return function
+    return functools.partial(contextvars.copy_context().run, profiled(function))
+
+
+def _frame_label(frame):
+    filename = frame.f_code.co_filename
+    if filename.startswith(_APP_DIR):
+        filename = filename[len(_APP_DIR):]
+    else:
+        filename = os.path.basename(filename)
+    return f'{frame.f_code.co_name} ({filename}:{frame.f_lineno})'
+
+
+# The frames of a stack, from the leaf to the root
+def stack_frames(frame):
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    return frames
+
+
+# Collapsed stack of the frames of a stack, from the leaf, or None if it does
+# not run backend code or is idle, waiting on an Event or a Condition
+def collapse_stack(frames, root):
+    if frames[0].f_code.co_name == 'wait' and frames[0].f_code.co_filename == threading.__file__:
+        return None
+    if not any(frame.f_code.co_filename.startswith(_APP_DIR) for frame in frames):
+        return None
+    return ';'.join([root] + [_frame_label(frame) for frame in reversed(frames)])
+
+
+# Thread sampling the stacks of the other threads of this process, or of
+# the given threads, or of the work of a scope. Samples are either counted
+# per stack (a profile of the sampling period), or kept with their time
+# (max_age seconds) and the scopes of the running requests they belong to,
+# so the samples of a request can be taken once it has finished.
+class Sampler:
+    def __init__(self, interval, max_age=None, thread_ids=None, scope=None):
+        self.interval = interval
+        self.max_age = max_age
+        self.thread_ids = thread_ids
+        self.scope = scope
+        self.stacks = collections.Counter()
+        self.sample_count = 0
+        self.timed_samples = collections.deque()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return self
+
+    def _run(self):
+        _sampler_threads.add(threading.get_ident())
+        try:
+            self._sample()
+        finally:
+            _sampler_threads.discard(threading.get_ident())
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            if self.max_age is not None:
+                with _active_scopes_lock:
+                    scopes = list(_active_scopes)
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in _sampler_threads or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                    continue
+                frames = stack_frames(frame)
+                if self.scope is not None and not self.scope.owns(thread_id, frames):
+                    continue
+                if self.max_age is not None:
+                    owners = [scope for scope in scopes if scope.owns(thread_id, frames)]
+                    if not owners:
+                        continue
+                stack = collapse_stack(frames, f'thread:{names.get(thread_id, thread_id)}')
+                if stack is not None:
+                    stacks.append(stack if self.max_age is None else (stack, owners))
+
+            with self._lock:
+                self.sample_count += 1
+                if self.max_age is None:
+                    self.stacks.update(stacks)
+                else:
+                    self.timed_samples.append((now, stacks))
+                    while self.timed_samples and self.timed_samples[0][0] < now - self.max_age:
+                        self.timed_samples.popleft()
+
+    # Count the stacks of a scope sampled between two perf_counter() times
+    def stacks_between(self, started, finished, scope):
+        with self._lock:
+            samples = [stacks for at, stacks in self.timed_samples if started <= at <= finished]
+        counts = collections.Counter()
+        for stacks in samples:
+            counts.update(stack for stack, owners in stacks if scope in owners)
+        return counts, len(samples)
+
+
+# Run a function under a sampler of the calling thread. Returns its result
+# and the collapsed stacks sampled. Used in the parsing processes, whose
+# stacks get a process: root frame.
+def profile_call(function, *args, interval=PROFILE_SAMPLE_INTERVAL, root='process:parser'):
+    sampler = Sampler(interval, thread_ids={threading.get_ident()}).start()
+    try:
+        result = function(*args)
+    finally:
+        sampler.stop()
+    return result, collections.Counter({f'{root};{stack}': count for stack, count in sampler.stacks.items()})
+
+
+# Ring buffer of the last PROFILE_HISTORY profiles
+_profiles = collections.deque(maxlen=PROFILE_HISTORY)
+_profiles_lock = threading.Lock()
+_profile_ids = itertools.count(1)
+
+
+def store_profile(name, trigger, duration, stacks, sample_count, interval):
+    profile = {
+        'id': next(_profile_ids),
+        'name': name,
+        'trigger': trigger,
+        'started_at': time.time() - duration,
+        'duration_seconds': round(duration, 6),
+        'samples': sample_count,
+        'sample_interval_seconds': interval,
+        'stacks': stacks,
+    }
+    with _profiles_lock:
+        _profiles.append(profile)
+    return profile
+
+
+# Summaries of the stored profiles, most recent first
+def list_profiles():
+    with _profiles_lock:
+        profiles = list(_profiles)
+    return [{key: value for key, value in profile.items() if key != 'stacks'} for profile in reversed(profiles)]
+
+
+def get_profile(profile_id):
+    with _profiles_lock:
+        for profile in _profiles:
+            if profile['id'] == profile_id:
+                return profile
+    return None
+
+
+# A profile in collapsed-stack format: one "stack count" line per stack
+def collapsed(profile):
+    return ''.join(f'{stack} {count}\n' for stack, count in profile['stacks'].most_common())
+
+
+def is_admin_token(token):
+    return PROFILE_ADMIN_TOKEN is not None and token is not None \
+        and hmac.compare_digest(token.encode(), PROFILE_ADMIN_TOKEN.encode())
+
+
+# Whether the current request is being profiled on an admin's request, for
+# handlers that hand work to the background (ingest jobs)
+def is_profiling():
+    return _profiling.get()
+
+
+# Background sampler for slow requests, started with the application
+_slow_sampler = None
+
+
+def start_slow_sampler():
+    global _slow_sampler
+    if PROFILE_SLOW_THRESHOLD > 0 and _slow_sampler is None:
+        _slow_sampler = Sampler(PROFILE_SLOW_SAMPLE_INTERVAL, max_age=PROFILE_SLOW_WINDOW).start()
+
+
+def stop_slow_sampler():
+    global _slow_sampler
+    if _slow_sampler is not None:
+        _slow_sampler.stop()
+        _slow_sampler = None
+
+
+def _requested_token(scope):
+    for name, value in scope['headers']:
+        if name == b'x-profile-token':
+            return value.decode('latin-1')
+    values = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('profile')
+    return values[0] if values else None
+
+
+# ASGI middleware profiling the requests of admins that ask for it and the
+# requests slower than PROFILE_SLOW_THRESHOLD
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # Reading profiles is not profiled, so it does not evict them
+        if scope['type'] != 'http' or scope['path'].startswith('/debug/'):
+            await self.app(scope, receive, send)
+            return
+
+        requested = is_admin_token(_requested_token(scope))
+        if not requested and _slow_sampler is None:
+            await self.app(scope, receive, send)
+            return
+
+        name = f"{scope['method']} {scope['path']}"
+        started = time.perf_counter()
+        # The frame of this coroutine, which every frame of the request on the
+        # event loop thread runs under
+        request_scope = ProfileScope(sys._getframe())
+        if requested:
+            sampler = Sampler(PROFILE_SAMPLE_INTERVAL, scope=request_scope).start()
+            token = _profiling.set(True)
+            try:
+                with profile_scope(request_scope):
+                    await self.app(scope, receive, send)
+            finally:
+                _profiling.reset(token)
+                sampler.stop()
+                store_profile(name, 'request', time.perf_counter() - started, sampler.stacks,
+                              sampler.sample_count, sampler.interval)
+        else:
+            with _active_scopes_lock:
+                _active_scopes.add(request_scope)
+            try:
+                with profile_scope(request_scope):
+                    await self.app(scope, receive, send)
+            finally:
+                with _active_scopes_lock:
+                    _active_scopes.discard(request_scope)
+                finished = time.perf_counter()
+                slow_sampler = _slow_sampler
+                if finished - started >= PROFILE_SLOW_THRESHOLD and slow_sampler is not None:
+                    stacks, sample_count = slow_sampler.stacks_between(started, finished, request_scope)
+                    store_profile(name, 'slow', finished - started, stacks, sample_count, slow_sampler.interval)
@@ -0,0 +1,9 @@
+# Local semantic search over publication titles
+from .ann import FlatIndex, IVFIndex, recall_report
+from .embedding import HashedTfidfEmbedder
+from .index import SemanticIndex, SEMANTIC_INDEX_DIR
+from .indexer import SemanticIndexer, update_index
+from .store import VectorStore
+
+__all__ = ['FlatIndex', 'IVFIndex', 'recall_report', 'HashedTfidfEmbedder', 'SemanticIndex', 'SEMANTIC_INDEX_DIR', 'SemanticIndexer',
+           'update_index', 'VectorStore']
@@ -0,0 +1,128 @@
+# Command-line tools for the semantic index. Run from the backend directory:
+#
+#     python -m semantic build [--dim 128] [--fit-sample 50000] [--ann ivf|flat] [--n-lists N]
+#                              [--dtype int8|float16|float32] [--no-float32]
+#     python -m semantic build-ann [--ann ivf|flat] [--n-lists N] [--dtype ...] [--no-float32]
+#     python -m semantic recall [--k 10] [--queries 200] [--nprobe 1,4,16]
+#     python -m semantic update [--compact]
+import argparse
+import json
+import time
+
+import numpy as np
+
+from database import reader_connection, record_deletion_mark
+from semantic.ann import FlatIndex, IVFIndex, recall_report
+from semantic.indexer import read_changes, update_index
+from semantic.index import SemanticIndex, SEMANTIC_INDEX_DIR, SEMANTIC_VECTOR_DTYPE
+
+
+# (Re)build the nearest-neighbor index of a semantic index
+def _build_ann(index, args):
+    if args.ann == 'ivf':
+        index.build_ivf(n_lists=args.n_lists)
+    else:
+        index.ann = FlatIndex()
+
+
+# Embed every publication title in the database and save the index
+def build(args):
+    started = time.perf_counter()
+    with reader_connection() as conn:
+        generation, rows, _, deletion_mark = read_changes(conn, {})
+
+    index = SemanticIndex.build(rows, dim=args.dim, fit_sample=args.fit_sample)
+    index.state = {
+        'generation': generation,
+        'high_water_mark': rows[-1][0] if rows else 0,
+        'deletion_mark': deletion_mark,
+    }
+    _build_ann(index, args)
+    index.save(args.index_dir, dtype=args.dtype, keep_float32=args.keep_float32)
+    record_deletion_mark('semantic', deletion_mark)
+    print(f"Indexed {len(index)} publications in {time.perf_counter() - started:.1f}s into {args.index_dir}")
+
+
+# Rebuild only the nearest-neighbor index over the existing vectors
+def build_ann(args):
+    started = time.perf_counter()
+    index = SemanticIndex.load(args.index_dir)
+    _build_ann(index, args)
+    index.save(args.index_dir, dtype=args.dtype, keep_float32=args.keep_float32)
+    print(f"Built {args.ann} index over {len(index)} vectors in {time.perf_counter() - started:.1f}s")
+
+
+# Embed the publications added since the index was last updated
+def update(args):
+    started = time.perf_counter()
+    if update_index(args.index_dir, force_compact=args.compact):
+        print(f"Updated the index in {time.perf_counter() - started:.1f}s")
+    else:
+        print("The index is up to date")
+
+
+# Report recall@k and latency of the IVF index against exact search,
+# using stored vectors as queries. The index is compacted in memory first
+# (the saved files are left alone), so both searches run over the live
+# publications /semantic-search serves, delta included and tombstones
+# dropped.
+def recall(args):
+    index = SemanticIndex.load(args.index_dir)
+    if not isinstance(index.ann, IVFIndex):
+        raise SystemExit("The index has no IVF index; run `python -m semantic build-ann --ann ivf` first")
+    index.compact()
+
+    rng = np.random.default_rng(args.seed)
+    count = len(index.store)
+    queries = index.store.to_float32()[rng.choice(count, min(args.queries, count), replace=False)]
+    for nprobe in args.nprobe:
+        report = recall_report(index.store, index.ann, queries, k=args.k, nprobe=nprobe)
+        print(json.dumps(report))
+
+
+def _ann_arguments(parser):
+    parser.add_argument('--ann', choices=['ivf', 'flat'], default='ivf',
+                        help='Nearest-neighbor index: approximate IVF or exact flat scan')
+    parser.add_argument('--n-lists', type=int, default=None,
+                        help='Number of IVF lists (defaults to 4 * sqrt(number of vectors))')
+    parser.add_argument('--dtype', choices=['int8', 'float16', 'float32'], default=SEMANTIC_VECTOR_DTYPE,
+                        help='Representation of the stored vectors')
+    parser.add_argument('--no-float32', dest='keep_float32', action='store_false',
+                        help='Do not keep float32 vectors for rescoring (smaller store)')
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m semantic', description='Manage the semantic search index')
+    parser.add_argument('--index-dir', default=SEMANTIC_INDEX_DIR, help='Directory of the index files')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = commands.add_parser('build', help='Build the index from the publications in the database')
+    build_parser.add_argument('--dim', type=int, default=128, help='Number of vector dimensions')
+    build_parser.add_argument('--fit-sample', type=int, default=50000,
+                              help='Number of titles used to fit the embedding model')
+    _ann_arguments(build_parser)
+    build_parser.set_defaults(func=build)
+
+    build_ann_parser = commands.add_parser('build-ann', help='Rebuild the nearest-neighbor index of an existing index')
+    _ann_arguments(build_ann_parser)
+    build_ann_parser.set_defaults(func=build_ann)
+
+    recall_parser = commands.add_parser('recall', help='Report IVF recall@k and latency against exact search')
+    recall_parser.add_argument('--k', type=int, default=10, help='Number of results per query')
+    recall_parser.add_argument('--queries', type=int, default=200, help='Number of sample queries')
+    recall_parser.add_argument('--nprobe', type=lambda value: [int(n) for n in value.split(',')],
+                               default=[1, 4, 8, 16, 32], help='Comma-separated nprobe values to compare')
+    recall_parser.add_argument('--seed', type=int, default=0, help='Seed used to sample the queries')
+    recall_parser.set_defaults(func=recall)
+
+    update_parser = commands.add_parser('update', help='Index the publications added or deleted since the last update')
+    update_parser.add_argument('--compact', action='store_true',
+                               help='Merge the delta segment into the main one and drop deleted publications')
+    update_parser.set_defaults(func=update)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
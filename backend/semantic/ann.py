@@ -0,0 +1,152 @@
+import os
+import time
+
+import numpy as np
+
+# Number of inverted lists scanned per query unless the caller asks otherwise
+SEMANTIC_NPROBE = int(os.environ.get('SEMANTIC_NPROBE', 8))
+
+
+# Positions and values of the k highest scores, best first
+def top_k(scores, k):
+    k = min(k, len(scores))
+    if k == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    top = np.argpartition(scores, len(scores) - k)[-k:]
+    top = top[np.argsort(-scores[top])]
+    return top, scores[top]
+
+
+# Exact search: score every vector of the store
+class FlatIndex:
+    def search(self, store, query_vector, k, nprobe=None):
+        return top_k(store.scores(query_vector), k)
+
+
+# Inverted file index: a spherical k-means coarse quantizer splits the
+# vectors into lists, and a query only scores the lists of its nprobe
+# closest centroids. The index does not hold vectors itself; it expects the
+# vector store to be ordered by list (see build), so every list is a
+# contiguous block of rows [offsets[i], offsets[i + 1]).
+class IVFIndex:
+    def __init__(self, centroids, offsets, nprobe=SEMANTIC_NPROBE):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.nprobe = nprobe
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    # Train the quantizer on the vectors and assign every vector to a list.
+    # Returns the index and the permutation that orders the vectors by list.
+    @classmethod
+    def build(cls, vectors, n_lists=None, n_iter=15, train_size=None, seed=0):
+        n_vectors = len(vectors)
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(n_vectors))
+        n_lists = max(1, min(n_lists, n_vectors))
+
+        rng = np.random.default_rng(seed)
+        train_size = min(n_vectors, train_size or 64 * n_lists)
+        train = vectors[np.sort(rng.choice(n_vectors, train_size, replace=False))]
+
+        centroids = train[rng.choice(train_size, n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            assignment = cls.assign(train, centroids)
+            counts = np.bincount(assignment, minlength=n_lists)
+
+            # Sum the vectors of every list by reducing over them sorted by list
+            order = np.argsort(assignment, kind='stable')
+            starts = np.cumsum(counts) - counts
+            empty = counts == 0
+            sums = np.zeros_like(centroids)
+            sums[~empty] = np.add.reduceat(train[order], starts[~empty], axis=0)
+
+            # Re-seed empty lists with random training vectors
+            sums[empty] = train[rng.choice(train_size, int(empty.sum()))]
+
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            centroids = (sums / norms).astype(np.float32)
+
+        return cls.from_assignment(centroids, cls.assign(vectors, centroids))
+
+    # Index over vectors already assigned to lists, with the permutation that
+    # orders them by list
+    @classmethod
+    def from_assignment(cls, centroids, assignment):
+        permutation = np.argsort(assignment, kind='stable')
+        offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=len(centroids)), out=offsets[1:])
+        return cls(centroids, offsets), permutation
+
+    # Closest centroid of every vector, in blocks to bound memory
+    @staticmethod
+    def assign(vectors, centroids, block_rows=65536):
+        assignment = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), block_rows):
+            assignment[start:start + block_rows] = np.argmax(vectors[start:start + block_rows] @ centroids.T, axis=1)
+        return assignment
+
+    def search(self, store, query_vector, k, nprobe=None):
+        nprobe = min(nprobe or self.nprobe, self.n_lists)
+        lists, _ = top_k(self.centroids @ query_vector, nprobe)
+
+        positions = []
+        scores = []
+        for list_id in lists:
+            start, stop = self.offsets[list_id], self.offsets[list_id + 1]
+            if start < stop:
+                positions.append(np.arange(start, stop))
+                scores.append(store.scores(query_vector, start, stop))
+        if not positions:
+            return top_k(np.zeros(0, dtype=np.float32), k)
+
+        positions = np.concatenate(positions)
+        best, best_scores = top_k(np.concatenate(scores), k)
+        return positions[best], best_scores
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, offsets=self.offsets)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['centroids'], data['offsets'])
+
+
+# Compare an approximate index against exact search on sample queries:
+# mean recall@k and per-query latency of both
+def recall_report(store, ann, queries, k=10, nprobe=None):
+    flat = FlatIndex()
+    recalls = []
+    exact_times = []
+    ann_times = []
+    for query_vector in queries:
+        started = time.perf_counter()
+        expected, expected_scores = flat.search(store, query_vector, k)
+        exact_times.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        _, found_scores = ann.search(store, query_vector, k, nprobe)
+        ann_times.append(time.perf_counter() - started)
+
+        # A result counts as found when it scores at least as high as the
+        # k-th exact result, so ties between equal vectors are not misses
+        if len(expected):
+            threshold = expected_scores[-1] - 1e-6
+            recalls.append(min(int((found_scores >= threshold).sum()), len(expected)) / len(expected))
+
+    def latency(times):
+        times_ms = np.asarray(times) * 1000
+        return {'p50_ms': float(np.percentile(times_ms, 50)), 'p99_ms': float(np.percentile(times_ms, 99))}
+
+    return {
+        'k': k,
+        'nprobe': nprobe or getattr(ann, 'nprobe', None),
+        'queries': len(queries),
+        'recall': float(np.mean(recalls)) if recalls else 0.0,
+        'exact': latency(exact_times),
+        'ann': latency(ann_times),
+    }
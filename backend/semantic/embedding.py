@@ -0,0 +1,177 @@
+import os
+import re
+import zlib
+
+import numpy as np
+
+from text_utils import normalize_text
+
+_WORD_RE = re.compile(r'\w+')
+
+# Maximum number of distinct words whose hashed features are memoized
+_WORD_CACHE_SIZE = 200000
+
+
+# Multiply a CSR sparse matrix by a dense matrix, a block of rows at a time
+# so the intermediate products stay small
+def _sparse_dot(indptr, indices, values, dense, block_rows=2048):
+    n_rows = len(indptr) - 1
+    out = np.zeros((n_rows, dense.shape[1]), dtype=np.float32)
+    for start in range(0, n_rows, block_rows):
+        stop = min(n_rows, start + block_rows)
+        lo, hi = indptr[start], indptr[stop]
+        if lo == hi:
+            continue
+        products = values[lo:hi, None] * dense[indices[lo:hi]]
+        # np.add.reduceat does not sum empty segments to zero, so only the
+        # non-empty rows are reduced
+        row_starts = indptr[start:stop] - lo
+        non_empty = indptr[start + 1:stop + 1] > indptr[start:stop]
+        out[start:stop][non_empty] = np.add.reduceat(products, row_starts[non_empty], axis=0)
+    return out
+
+
+# Transpose a CSR matrix (i.e. convert it to CSC)
+def _sparse_transpose(indptr, indices, values, n_cols):
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    order = np.argsort(indices, kind='stable')
+    t_indptr = np.zeros(n_cols + 1, dtype=np.int64)
+    np.cumsum(np.bincount(indices, minlength=n_cols), out=t_indptr[1:])
+    return t_indptr, rows[order], values[order]
+
+
+# Orthonormal basis of the columns of a tall matrix. Cholesky QR only
+# factors the small Gram matrix, which is much faster than a full QR here.
+def _orthonormalize(matrix):
+    gram = matrix.T.astype(np.float64) @ matrix.astype(np.float64)
+    gram[np.diag_indices_from(gram)] += 1e-10 * max(np.trace(gram), 1e-30)
+    lower = np.linalg.cholesky(gram)
+    return (matrix @ np.linalg.inv(lower).T.astype(np.float32)).astype(np.float32)
+
+
+# Fully local text embedding: word and character trigram features hashed
+# into a fixed number of buckets, TF-IDF weighted, then projected onto a
+# truncated SVD basis (latent semantic analysis). Hashing uses CRC32, so
+# vectors are identical across processes and runs.
+class HashedTfidfEmbedder:
+    def __init__(self, n_features=2 ** 17, dim=128, idf=None, components=None):
+        self.n_features = n_features
+        self.dim = dim
+        self.idf = idf
+        self.components = components
+        self._word_cache = {}
+
+    @property
+    def is_fitted(self):
+        return self.components is not None
+
+    # Signed hashed features of one word: the word itself and its character
+    # trigrams. Word frequencies are Zipfian, so results are memoized.
+    def _word_features(self, word):
+        features = self._word_cache.get(word)
+        if features is None:
+            if len(self._word_cache) >= _WORD_CACHE_SIZE:
+                self._word_cache.clear()
+            mask = self.n_features - 1
+            padded = f' {word} '
+            features = []
+            for feature in ['w:' + word] + [padded[i:i + 3] for i in range(len(padded) - 2)]:
+                h = zlib.crc32(feature.encode('utf-8'))
+                features.append((h & mask, 1 if h & 0x80000000 else -1))
+            self._word_cache[word] = features
+        return features
+
+    # Hashed, signed and sublinearly scaled term frequencies of one text
+    def _hashed_counts(self, text):
+        counts = {}
+        for word in _WORD_RE.findall(normalize_text(text)):
+            for index, sign in self._word_features(word):
+                counts[index] = counts.get(index, 0) + sign
+
+        indices = np.fromiter((i for i, c in counts.items() if c), dtype=np.int64)
+        raw = np.fromiter((c for c in counts.values() if c), dtype=np.float32)
+        return indices, np.sign(raw) * (1 + np.log(np.abs(raw)))
+
+    # CSR matrix of the hashed features of the texts, without IDF weights
+    def _hashed_matrix(self, texts):
+        indptr = [0]
+        all_indices = []
+        all_values = []
+        for text in texts:
+            indices, values = self._hashed_counts(text)
+            all_indices.append(indices)
+            all_values.append(values)
+            indptr.append(indptr[-1] + len(indices))
+        indptr = np.asarray(indptr, dtype=np.int64)
+        if indptr[-1] == 0:
+            return indptr, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        return indptr, np.concatenate(all_indices), np.concatenate(all_values)
+
+    # Apply the IDF weights and L2-normalize every row, in place
+    def _weight(self, indptr, indices, values):
+        values *= self.idf[indices]
+        rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+        norms = np.sqrt(np.bincount(rows, weights=values ** 2, minlength=len(indptr) - 1)).astype(np.float32)
+        norms[norms == 0] = 1
+        values /= norms[rows]
+        return values
+
+    # Learn the IDF weights and the SVD basis from a sample of texts using a
+    # randomized range finder with power iterations
+    def fit(self, texts, oversample=16, n_iter=1, seed=0):
+        indptr, indices, values = self._hashed_matrix(texts)
+        n_docs = len(indptr) - 1
+
+        document_frequency = np.bincount(indices, minlength=self.n_features)
+        self.idf = (np.log((1 + n_docs) / (1 + document_frequency)) + 1).astype(np.float32)
+        values = self._weight(indptr, indices, values)
+
+        t_indptr, t_indices, t_values = _sparse_transpose(indptr, indices, values, self.n_features)
+        rank = max(1, min(self.dim + oversample, n_docs))
+
+        rng = np.random.default_rng(seed)
+        omega = rng.standard_normal((self.n_features, rank), dtype=np.float32)
+        basis = _orthonormalize(_sparse_dot(indptr, indices, values, omega))
+        for _ in range(n_iter):
+            basis = _orthonormalize(_sparse_dot(t_indptr, t_indices, t_values, basis))
+            basis = _orthonormalize(_sparse_dot(indptr, indices, values, basis))
+
+        # The right singular vectors of B = basis.T @ X come from the
+        # eigendecomposition of the small Gram matrix B @ B.T
+        projected = _sparse_dot(t_indptr, t_indices, t_values, basis)
+        eigenvalues, eigenvectors = np.linalg.eigh(projected.T.astype(np.float64) @ projected.astype(np.float64))
+        order = np.argsort(eigenvalues)[::-1]
+        order = order[eigenvalues[order] > 1e-12][:self.dim]
+        self.dim = len(order)
+        scale = eigenvectors[:, order] / np.sqrt(eigenvalues[order])
+        self.components = np.ascontiguousarray(projected @ scale.astype(np.float32), dtype=np.float32)
+        return self
+
+    # Embed texts as L2-normalized float32 vectors, one row per text
+    def transform(self, texts, batch_size=4096):
+        texts = list(texts)
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            indptr, indices, values = self._hashed_matrix(texts[start:start + batch_size])
+            values = self._weight(indptr, indices, values)
+            out[start:start + batch_size] = _sparse_dot(indptr, indices, values, self.components)
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        out /= norms
+        return out
+
+    # The model is saved as plain .npy arrays so that loading can memory-map
+    # them instead of reading them. Files are replaced atomically, as other
+    # processes (or this model itself) may have the previous ones mapped.
+    def save(self, directory):
+        for name, array in (('idf.npy', self.idf), ('components.npy', self.components)):
+            path = os.path.join(directory, name)
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, directory):
+        idf = np.load(os.path.join(directory, 'idf.npy'), mmap_mode='r')
+        components = np.load(os.path.join(directory, 'components.npy'), mmap_mode='r')
+        return cls(n_features=len(idf), dim=components.shape[1], idf=idf, components=components)
@@ -0,0 +1,263 @@
+import json
+import os
+
+import numpy as np
+
+from semantic.ann import FlatIndex, IVFIndex, top_k
+from semantic.embedding import HashedTfidfEmbedder
+from semantic.store import VectorStore
+
+# Directory holding the semantic index files
+SEMANTIC_INDEX_DIR = os.environ.get('SEMANTIC_INDEX_DIR', 'semantic_index')
+
+# Representation of the vectors on disk: int8, float16 or float32
+SEMANTIC_VECTOR_DTYPE = os.environ.get('SEMANTIC_VECTOR_DTYPE', 'int8')
+
+# When the store keeps float32 vectors, this many times k candidates are
+# taken from the quantized scores and rescored exactly (0 disables rescoring)
+SEMANTIC_RESCORE_FACTOR = int(os.environ.get('SEMANTIC_RESCORE_FACTOR', 4))
+
+
+# Publication title vectors with the embedding model that produced them.
+#
+# The index is made of a main segment (a VectorStore searched through the
+# nearest-neighbor index, exact FlatIndex or approximate IVFIndex), small
+# delta segments of vectors appended since the last compaction (always
+# scanned exactly) and tombstones, the ids of deleted publications that are
+# filtered out of results until compaction drops them. `state` records how
+# far the index has caught up with the database.
+#
+# Every append adds a delta segment, merged with the last ones while they
+# are no larger, so there are a logarithmic number of segments and every
+# vector is copied a logarithmic number of times until compaction. Each
+# segment is saved to its own file, named in the state, so saving an
+# append writes only the segment it made.
+class SemanticIndex:
+    def __init__(self, embedder, store, ann=None, deltas=None, tombstones=None, state=None, delta_files=None):
+        self.embedder = embedder
+        self.store = store
+        self.ann = ann or FlatIndex()
+        self.deltas = deltas or []
+        # File of each delta segment, None until saved
+        self.delta_files = delta_files or [None] * len(self.deltas)
+        self.tombstones = tombstones if tombstones is not None else np.zeros(0, dtype=np.int64)
+        self.state = state or {}
+        self._length = None
+
+    # Number of live vectors. Tombstones can name publications the index
+    # never had, deleted before it was updated, so only the vectors they
+    # match are left out. Counted on first use, as loading maps the vectors
+    # without reading them.
+    def __len__(self):
+        if self._length is None:
+            segments = [self.store] + self.deltas
+            deleted = sum(np.count_nonzero(np.isin(segment.publication_ids, self.tombstones)) for segment in segments)
+            self._length = sum(len(segment) for segment in segments) - deleted
+        return self._length
+
+    @property
+    def delta_size(self):
+        return sum(len(delta) for delta in self.deltas)
+
+    # Embed the titles of (publication_id, title) rows. The embedding model
+    # is fitted on a random sample of at most fit_sample titles.
+    @classmethod
+    def build(cls, rows, dim=128, fit_sample=50000, seed=0):
+        rows = list(rows)
+        publication_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        titles = [row[1] for row in rows]
+
+        rng = np.random.default_rng(seed)
+        if len(titles) > fit_sample:
+            sample = [titles[i] for i in rng.choice(len(titles), fit_sample, replace=False)]
+        else:
+            sample = titles
+
+        embedder = HashedTfidfEmbedder(dim=dim).fit(sample, seed=seed)
+        return cls(embedder, VectorStore(embedder.transform(titles), publication_ids))
+
+    # Replace the nearest-neighbor index with an IVF index. The vectors are
+    # reordered so that every inverted list is a contiguous block.
+    def build_ivf(self, n_lists=None, seed=0):
+        vectors = self.store.to_float32()
+        ann, permutation = IVFIndex.build(vectors, n_lists=n_lists, seed=seed)
+        self.store = VectorStore(np.ascontiguousarray(vectors[permutation]),
+                                 np.asarray(self.store.publication_ids)[permutation])
+        self.ann = ann
+
+    # Embed the titles of new (publication_id, title) rows into a delta
+    # segment, and tombstone deleted publication ids
+    def append(self, rows, deleted_ids=()):
+        if rows:
+            publication_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+            vectors = self.embedder.transform([row[1] for row in rows])
+            while self.deltas and len(self.deltas[-1]) <= len(publication_ids):
+                delta = self.deltas.pop()
+                self.delta_files.pop()
+                publication_ids = np.concatenate([delta.publication_ids, publication_ids])
+                vectors = np.concatenate([delta.to_float32(), vectors])
+            self.deltas.append(VectorStore(vectors, publication_ids))
+            self.delta_files.append(None)
+
+        if len(deleted_ids):
+            self.tombstones = np.union1d(self.tombstones, np.asarray(deleted_ids, dtype=np.int64))
+        self._length = None
+
+    # Merge the delta segments into the main segment and drop tombstoned
+    # vectors. New vectors are assigned to the existing IVF lists, so the
+    # embedding model and the quantizer are not retrained.
+    def compact(self):
+        vectors = np.concatenate([self.store.to_float32()] + [delta.to_float32() for delta in self.deltas])
+        publication_ids = np.concatenate([np.asarray(self.store.publication_ids)] +
+                                         [delta.publication_ids for delta in self.deltas])
+
+        keep = ~np.isin(publication_ids, self.tombstones)
+        vectors = vectors[keep]
+        publication_ids = publication_ids[keep]
+
+        if isinstance(self.ann, IVFIndex):
+            self.ann, permutation = IVFIndex.from_assignment(
+                self.ann.centroids, IVFIndex.assign(vectors, self.ann.centroids))
+            vectors = vectors[permutation]
+            publication_ids = publication_ids[permutation]
+
+        self.store = VectorStore(np.ascontiguousarray(vectors), publication_ids)
+        self.deltas = []
+        self.delta_files = []
+        self.tombstones = np.zeros(0, dtype=np.int64)
+        self._length = len(self.store)
+
+    # Best k matches for the query as (publication_id, cosine similarity).
+    # nprobe trades recall for latency on IVF indexes. Candidates are scored
+    # on the quantized vectors, then rescored with float32 when available.
+    def search(self, query, k=10, nprobe=None, rescore=True):
+        query_vector = self.embedder.transform([query])[0]
+        if len(self) <= 0 or not query_vector.any():
+            return []
+
+        # Ask for extra candidates so that tombstoned hits can be dropped, and
+        # widen the search until k live hits are found or the index has
+        # returned every vector it reaches
+        wanted = k + min(len(self.tombstones), k)
+        rescore = rescore and self.store.can_rescore and SEMANTIC_RESCORE_FACTOR > 0
+        while True:
+            candidates = wanted * SEMANTIC_RESCORE_FACTOR if rescore else wanted
+            positions, scores = self.ann.search(self.store, query_vector, candidates, nprobe)
+            exhausted = len(positions) < candidates
+            if rescore and len(positions):
+                positions = np.sort(positions)
+                best, scores = top_k(self.store.rescore(query_vector, positions), wanted)
+                positions = positions[best]
+            publication_ids, scores = self._live(self.store.publication_ids[positions], scores)
+            if len(publication_ids) >= k or exhausted:
+                break
+            wanted *= 2
+
+        # The delta segments are scored whole, so their tombstoned vectors
+        # are dropped before taking their best k
+        for delta in self.deltas:
+            delta_ids, delta_scores = self._live(delta.publication_ids, delta.scores(query_vector))
+            delta_positions, delta_scores = top_k(delta_scores, k)
+            publication_ids = np.concatenate([publication_ids, delta_ids[delta_positions]])
+            scores = np.concatenate([scores, delta_scores])
+
+        best, scores = top_k(scores, k)
+        return [(int(publication_id), float(score)) for publication_id, score in zip(publication_ids[best], scores)]
+
+    # The publication ids and scores of hits that are not tombstoned
+    def _live(self, publication_ids, scores):
+        publication_ids = np.asarray(publication_ids)
+        if not len(self.tombstones):
+            return publication_ids, scores
+        live = ~np.isin(publication_ids, self.tombstones)
+        return publication_ids[live], scores[live]
+
+    def save(self, directory=SEMANTIC_INDEX_DIR, dtype=SEMANTIC_VECTOR_DTYPE, keep_float32=True):
+        os.makedirs(directory, exist_ok=True)
+        self.embedder.save(directory)
+        self.save_main(directory, dtype=dtype, keep_float32=keep_float32)
+        self.save_delta(directory)
+        self.state.update(dtype=dtype, keep_float32=keep_float32)
+        self.save_state(directory)
+
+    # Write the main segment and its nearest-neighbor index
+    def save_main(self, directory=SEMANTIC_INDEX_DIR, dtype=SEMANTIC_VECTOR_DTYPE, keep_float32=True):
+        self.store.write(os.path.join(directory, 'vectors.bin'), dtype=dtype, keep_float32=keep_float32)
+        ivf_path = os.path.join(directory, 'ivf.npz')
+        if isinstance(self.ann, IVFIndex):
+            self.ann.save(ivf_path)
+        elif os.path.exists(ivf_path):
+            os.remove(ivf_path)
+
+    # Write the delta segments not saved yet and the tombstones. The state
+    # names the segment files; those it no longer names are removed once it
+    # is saved.
+    def save_delta(self, directory=SEMANTIC_INDEX_DIR):
+        for i, delta in enumerate(self.deltas):
+            if self.delta_files[i] is None:
+                sequence = self.state.get('delta_sequence', 0) + 1
+                self.state['delta_sequence'] = sequence
+                delta.write(os.path.join(directory, f'delta-{sequence}.bin'), dtype='float32')
+                self.delta_files[i] = f'delta-{sequence}.bin'
+        self.state['deltas'] = list(self.delta_files)
+
+        tombstones_path = os.path.join(directory, 'tombstones.npy')
+        with open(tombstones_path + '.tmp', 'wb') as f:
+            np.save(f, self.tombstones)
+        os.replace(tombstones_path + '.tmp', tombstones_path)
+
+    # Write the state last: processes reload the index when its version changes
+    def save_state(self, directory=SEMANTIC_INDEX_DIR):
+        self.state['version'] = self.state.get('version', 0) + 1
+        state_path = os.path.join(directory, 'state.json')
+        with open(state_path + '.tmp', 'w') as f:
+            json.dump(self.state, f)
+        os.replace(state_path + '.tmp', state_path)
+
+        for name in os.listdir(directory):
+            if name.startswith('delta') and name.endswith('.bin') and name not in self.state.get('deltas', ()):
+                os.remove(os.path.join(directory, name))
+
+    # Version of the index saved in a directory, None when there is no index
+    @staticmethod
+    def saved_version(directory=SEMANTIC_INDEX_DIR):
+        try:
+            with open(os.path.join(directory, 'state.json')) as f:
+                return json.load(f).get('version')
+        except FileNotFoundError:
+            return None
+
+    # Open a saved index. Vectors and model are memory-mapped, not read, so
+    # this takes milliseconds and every process shares the same pages.
+    @classmethod
+    def load(cls, directory=SEMANTIC_INDEX_DIR):
+        ivf_path = os.path.join(directory, 'ivf.npz')
+        tombstones_path = os.path.join(directory, 'tombstones.npy')
+        state_path = os.path.join(directory, 'state.json')
+
+        state = {}
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+
+        # Indexes saved before delta segments had a single delta.bin
+        delta_files = state.get('deltas')
+        if delta_files is None:
+            delta_files = ['delta.bin'] if os.path.exists(os.path.join(directory, 'delta.bin')) else []
+
+        return cls(
+            HashedTfidfEmbedder.load(directory),
+            VectorStore.open(os.path.join(directory, 'vectors.bin')),
+            IVFIndex.load(ivf_path) if os.path.exists(ivf_path) else None,
+            [VectorStore.open(os.path.join(directory, name)) for name in delta_files],
+            np.load(tombstones_path) if os.path.exists(tombstones_path) else None,
+            state,
+            list(delta_files),
+        )
+
+    # Load the index if it has been built, otherwise return None
+    @classmethod
+    def load_if_present(cls, directory=SEMANTIC_INDEX_DIR):
+        if not os.path.exists(os.path.join(directory, 'vectors.bin')):
+            return None
+        return cls.load(directory)
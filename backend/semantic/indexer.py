@@ -0,0 +1,155 @@
+import logging
+import os
+import threading
+
+from database import get_deletion_mark, get_generation, reader_connection, record_deletion_mark
+from semantic.index import SemanticIndex, SEMANTIC_INDEX_DIR
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single backend process is assumed
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two checks for new or deleted publications
+SEMANTIC_INDEX_INTERVAL = float(os.environ.get('SEMANTIC_INDEX_INTERVAL', 5))
+
+# Compact once the delta segment plus tombstones exceed this fraction of
+# the main segment
+SEMANTIC_COMPACT_RATIO = float(os.environ.get('SEMANTIC_COMPACT_RATIO', 0.1))
+
+
+# Read, in one snapshot, the rows the index has not seen yet: publications
+# above its high-water mark and deletions logged after its deletion mark.
+# Returns (generation, rows, deletions, deletion_mark), the deletion mark
+# being that of the last deletion logged.
+def read_changes(conn, state):
+    cursor = conn.cursor()
+    cursor.execute("BEGIN")
+    try:
+        generation = get_generation(cursor)
+        cursor.execute("SELECT id, title FROM publications WHERE id > ? ORDER BY id",
+                       (state.get('high_water_mark', 0),))
+        rows = cursor.fetchall()
+        cursor.execute("SELECT seq, publication_id FROM publication_deletions WHERE seq > ? ORDER BY seq",
+                       (state.get('deletion_mark', 0),))
+        deletions = cursor.fetchall()
+        deletion_mark = get_deletion_mark(cursor)
+    finally:
+        conn.rollback()
+    return generation, rows, deletions, deletion_mark
+
+
+# Bring the index in a directory up to date with the database: embed the
+# new publications into the delta segment, tombstone deleted ones and
+# compact when the delta grows too large. Returns True if anything changed.
+def update_index(directory=SEMANTIC_INDEX_DIR, compact_ratio=SEMANTIC_COMPACT_RATIO, force_compact=False):
+    index = SemanticIndex.load(directory)
+    state = index.state
+
+    with reader_connection() as conn:
+        if not force_compact and state.get('generation') == get_generation(conn.cursor()):
+            return False
+        generation, rows, deletions, deletion_mark = read_changes(conn, state)
+
+    # Deletions of publications the index has not embedded yet need no tombstone
+    high_water_mark = state.get('high_water_mark', 0)
+    deleted_ids = [publication_id for _, publication_id in deletions if publication_id <= high_water_mark]
+    index.append(rows, deleted_ids)
+
+    state['generation'] = generation
+    if rows:
+        state['high_water_mark'] = rows[-1][0]
+    state['deletion_mark'] = deletion_mark
+
+    if force_compact or index.delta_size + len(index.tombstones) > compact_ratio * len(index.store):
+        index.compact()
+        index.save_main(directory, dtype=state.get('dtype', 'int8'), keep_float32=state.get('keep_float32', True))
+        logger.info("Compacted semantic index to %d vectors", len(index.store))
+
+    index.save_delta(directory)
+    index.save_state(directory)
+    # The deletions read are tombstoned in the saved files, so the log can
+    # drop them
+    record_deletion_mark('semantic', deletion_mark)
+    logger.info("Semantic index updated: %d publications added, %d deleted", len(rows), len(deleted_ids))
+    return True
+
+
+# Background thread that keeps the semantic index of this process current.
+#
+# Every backend process runs one, but only the process holding the lock file
+# of the index directory updates the files; all of them reload the index
+# when the saved version changes.
+class SemanticIndexer:
+    def __init__(self, directory=SEMANTIC_INDEX_DIR, interval=SEMANTIC_INDEX_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.index = SemanticIndex.load_if_present(directory)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock_file = None
+        self._mark_recorded = False
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='semantic-indexer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    # Check for changes now instead of at the next interval
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Semantic index update failed")
+
+    def run_once(self):
+        if self.index is None and SemanticIndex.saved_version(self.directory) is None:
+            return
+        if self._is_leader():
+            if not update_index(self.directory) and not self._mark_recorded:
+                # Record how far the index has read the deletion log even
+                # when there is nothing to update, so the log keeps the
+                # deletions it has not read yet
+                record_deletion_mark('semantic', SemanticIndex.load(self.directory).state.get('deletion_mark', 0))
+            self._mark_recorded = True
+        self.reload()
+
+    # Reload the index if another version has been saved
+    def reload(self):
+        version = SemanticIndex.saved_version(self.directory)
+        if version is not None and (self.index is None or self.index.state.get('version') != version):
+            self.index = SemanticIndex.load(self.directory)
+
+    # Take (once) the lock that makes this process the one updating the files
+    def _is_leader(self):
+        if fcntl is None:
+            return True
+        if self._lock_file is None:
+            lock_file = open(os.path.join(self.directory, 'indexer.lock'), 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+        return True
@@ -0,0 +1,160 @@
+import os
+import struct
+
+import numpy as np
+
+# File layout of a vector store, all little-endian:
+#
+#   header     64 bytes, see _HEADER
+#   ids        int64[count], publication id of every row
+#   scales     float32[count], per-row scale (int8 stores only)
+#   vectors    dtype[count, dim], quantized vectors
+#   float32    float32[count, dim], unquantized vectors (optional)
+#
+# Every section starts on a 64-byte boundary so it can be memory-mapped
+# directly with np.memmap.
+_MAGIC = b'LATTVEC\x00'
+_VERSION = 1
+_HEADER = struct.Struct('<8sIIII5Q')
+_ALIGNMENT = 64
+
+_DTYPE_CODES = {'float32': 0, 'float16': 1, 'int8': 2}
+_CODE_DTYPES = {code: name for name, code in _DTYPE_CODES.items()}
+
+# Rows converted to float32 at a time when scoring quantized vectors
+_SCORE_BLOCK_ROWS = 65536
+
+
+def _align(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+# Per-row symmetric int8 quantization: row ~= codes * scale
+def _quantize_int8(vectors):
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+# Vectors of the semantic index, either in memory (float32, while building)
+# or memory-mapped from a store file. Memory-mapped stores are shared through
+# the page cache by every process that opens the same file.
+class VectorStore:
+    def __init__(self, vectors, publication_ids, scales=None, float32=None):
+        self.vectors = vectors
+        self.publication_ids = publication_ids
+        self.scales = scales
+        self.float32 = float32
+
+    def __len__(self):
+        return len(self.publication_ids)
+
+    @property
+    def dtype(self):
+        return self.vectors.dtype.name
+
+    @property
+    def can_rescore(self):
+        return self.float32 is not None
+
+    # Dot products of the query with rows [start, stop), computed directly on
+    # the stored representation a block of rows at a time
+    def scores(self, query_vector, start=0, stop=None):
+        stop = len(self) if stop is None else stop
+        if self.vectors.dtype == np.float32:
+            return self.vectors[start:stop] @ query_vector
+
+        out = np.empty(stop - start, dtype=np.float32)
+        for block_start in range(start, stop, _SCORE_BLOCK_ROWS):
+            block_stop = min(stop, block_start + _SCORE_BLOCK_ROWS)
+            block = self.vectors[block_start:block_stop].astype(np.float32)
+            out[block_start - start:block_stop - start] = block @ query_vector
+        if self.scales is not None:
+            out *= self.scales[start:stop]
+        return out
+
+    # Exact float32 scores of the given rows
+    def rescore(self, query_vector, positions):
+        return self.float32[positions] @ query_vector
+
+    # All vectors as float32, reading the unquantized copy when there is one
+    def to_float32(self):
+        if self.float32 is not None:
+            return np.asarray(self.float32)
+        vectors = np.asarray(self.vectors, dtype=np.float32)
+        if self.scales is not None:
+            vectors = vectors * self.scales[:, None]
+        return vectors
+
+    # Write the vectors in the store format. The file is written next to its
+    # destination and then renamed over it, so processes that still map the
+    # previous file keep reading consistent data.
+    def write(self, path, dtype='int8', keep_float32=True, block_rows=_SCORE_BLOCK_ROWS):
+        vectors = self.to_float32()
+        keep_float32 = keep_float32 and dtype != 'float32'
+        count, dim = vectors.shape
+
+        ids_offset = _align(_HEADER.size)
+        scales_offset = _align(ids_offset + 8 * count) if dtype == 'int8' else 0
+        vectors_offset = _align((scales_offset + 4 * count) if scales_offset else (ids_offset + 8 * count))
+        itemsize = np.dtype(dtype).itemsize
+        float32_offset = _align(vectors_offset + itemsize * count * dim) if keep_float32 else 0
+
+        flags = 1 if keep_float32 else 0
+        header = _HEADER.pack(_MAGIC, _VERSION, _DTYPE_CODES[dtype], dim, flags, count,
+                              ids_offset, scales_offset, vectors_offset, float32_offset)
+
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as f:
+            f.write(header)
+
+            f.seek(ids_offset)
+            f.write(np.ascontiguousarray(self.publication_ids, dtype='<i8').tobytes())
+
+            # Quantize a block at a time to bound memory use
+            scales = []
+            f.seek(vectors_offset)
+            for start in range(0, count, block_rows):
+                block = vectors[start:start + block_rows]
+                if dtype == 'int8':
+                    block, block_scales = _quantize_int8(block)
+                    scales.append(block_scales)
+                f.write(np.ascontiguousarray(block, dtype=dtype).tobytes())
+
+            if scales_offset:
+                f.seek(scales_offset)
+                for block_scales in scales:
+                    f.write(block_scales.astype('<f4').tobytes())
+
+            if float32_offset:
+                f.seek(float32_offset)
+                for start in range(0, count, block_rows):
+                    f.write(np.ascontiguousarray(vectors[start:start + block_rows], dtype='<f4').tobytes())
+
+        os.replace(temporary_path, path)
+
+    # Memory-map a store file. Nothing is read besides the header, so this
+    # returns immediately whatever the size of the store.
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError(f"{path} is not a version {_VERSION} vector store")
+        (magic, version, dtype_code, dim, flags, count,
+         ids_offset, scales_offset, vectors_offset, float32_offset) = _HEADER.unpack(header)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError(f"{path} is not a version {_VERSION} vector store")
+
+        def section(dtype, offset, shape):
+            if count == 0:
+                return np.zeros(shape, dtype=dtype)
+            return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+        return cls(
+            section(_CODE_DTYPES[dtype_code], vectors_offset, (count, dim)),
+            section('<i8', ids_offset, (count,)),
+            section('<f4', scales_offset, (count,)) if scales_offset else None,
+            section('<f4', float32_offset, (count, dim)) if flags & 1 else None,
+        )
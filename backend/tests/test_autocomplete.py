@@ -0,0 +1,155 @@
+# Tests of the autocomplete suggestions kept current across ingests. Run
+# from the backend directory:
+#
+#     python -m unittest discover tests
+import asyncio
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import database
+from autocomplete import Autocompleter, _Vocabulary
+from ingest import ingest_files, shutdown_parse_pool
+from test_cv_updates import cv_xml
+
+
+def tearDownModule():
+    shutdown_parse_pool()
+
+
+class AutocompleteTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='lattes-test-')
+        self.files = 0
+        database.close_connections()
+        database.DB_PATH = os.path.join(self.directory, 'lattes.db')
+        database.init_db()
+
+    def tearDown(self):
+        database.close_connections()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def ingest(self, lattes_id, name, titles, updated_at='01012024'):
+        self.files += 1
+        path = os.path.join(self.directory, f'{self.files:03d}.xml')
+        with open(path, 'wb') as f:
+            f.write(cv_xml(lattes_id, updated_at, name, titles))
+        asyncio.run(ingest_files([path]))
+
+    def test_suggestions(self):
+        self.ingest('1', 'João da Conceição', ['Redes neurais profundas', 'Redes de sensores'])
+        self.ingest('2', 'Maria Reis', ['Recuperação de informação'])
+        completer = Autocompleter()
+        completer.refresh()
+
+        suggestions = completer.suggest('conce', 5)
+        self.assertEqual(suggestions['researchers'], [{'name': 'João da Conceição', 'publications': 2}])
+        suggestions = completer.suggest('sobre re', 5)
+        self.assertEqual([term['text'] for term in suggestions['terms']][:2], ['sobre redes', 'sobre recuperação'])
+        self.assertEqual(suggestions['terms'][0]['publications'], 2)
+
+    def test_incremental_refresh_matches_rebuild(self):
+        # A budget too small for every term: those left out must keep their
+        # counts across incremental refreshes
+        budget = 600
+        self.ingest('1', 'Ana Souza', ['Alfa beta gama', 'Delta epsilon zeta', 'Alfa teta iota'])
+        incremental = Autocompleter(max_bytes=budget)
+        incremental.refresh()
+        self.assertLess(len(incremental.index.terms), len(incremental.terms))
+
+        self.ingest('2', 'Rui Lima', ['Delta kappa lambda', 'Zeta omicron sigma'])
+        self.ingest('3', 'Eva Dias', ['Zeta tau delta', 'Kappa upsilon'])
+        incremental.refresh()
+
+        rebuilt = Autocompleter(max_bytes=budget)
+        rebuilt.refresh()
+        self.assertEqual(incremental.names, rebuilt.names)
+        self.assertEqual(incremental.terms, rebuilt.terms)
+        self.assertEqual(incremental.terms['zeta'], ('zeta', 3))
+        self.assertEqual(incremental.index.terms.keys, rebuilt.index.terms.keys)
+        self.assertEqual(incremental.index.terms.counts, rebuilt.index.terms.counts)
+
+    def test_deletions_are_subtracted(self):
+        self.ingest('1', 'Ana Souza', ['Alfa beta gama', 'Delta epsilon', 'Alfa teta'])
+        self.ingest('2', 'Rui Lima', ['Delta kappa'])
+        completer = Autocompleter()
+        completer.refresh()
+
+        # A newer CV drops two publications and adds one
+        self.ingest('1', 'Ana Souza', ['Alfa beta gama', 'Lambda sigma'], updated_at='01022024')
+        self.ingest('2', 'Rui Lima', [], updated_at='01022024')
+        with self.assertLogs('autocomplete', 'INFO') as logs:
+            completer.refresh()
+        self.assertIn('updated: 1 publications added, 3 removed', logs.output[0])
+        self.assertEqual(completer.names, {'ana souza': ('Ana Souza', 2)})
+        self.assertNotIn('delta', completer.terms)
+        self.assertEqual(completer.terms['alfa'], ('alfa', 1))
+        self.assertEqual(completer.suggest('rui', 5)['researchers'], [])
+        self.assertEqual(completer.suggest('del', 5)['terms'], [])
+        self.assertEqual(completer.suggest('la', 5)['terms'][0]['publications'], 1)
+
+        rebuilt = Autocompleter()
+        rebuilt.refresh()
+        self.assertEqual(completer.terms, rebuilt.terms)
+        self.assertEqual(completer.index.terms.keys, rebuilt.index.terms.keys)
+        self.assertEqual(completer.index.names.keys, rebuilt.index.names.keys)
+
+    # The log keeps the deletions the suggestions have not read, even once
+    # the other consumers have
+    def test_deletion_log_kept_until_read(self):
+        self.ingest('1', 'Ana Souza', ['Alfa beta', 'Delta epsilon'])
+        completer = Autocompleter()
+        completer.refresh()
+        self.ingest('1', 'Ana Souza', ['Alfa beta'], updated_at='01022024')
+        database.record_deletion_mark('semantic', 10)
+        database.init_db()
+
+        with self.assertLogs('autocomplete', 'INFO') as logs:
+            completer.refresh()
+        self.assertIn('updated: 0 publications added, 1 removed', logs.output[0])
+        self.assertNotIn('delta', completer.terms)
+        # Read by every consumer, the deletion is pruned
+        with sqlite3.connect(database.DB_PATH) as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM publication_deletions").fetchall(), [(0,)])
+
+
+class VocabularyTest(unittest.TestCase):
+    # Merging changes gives the arrays and precomputed prefixes of building
+    # from scratch, with a scan limit small enough to precompute many
+    @mock.patch('autocomplete._SCAN_LIMIT', 3)
+    def test_merged_matches_built(self):
+        rng = random.Random(0)
+        counts = {}
+        for _ in range(300):
+            counts[''.join(rng.choice('abc') for _ in range(rng.randint(1, 5)))] = rng.randint(1, 9)
+        vocabulary = _Vocabulary((key, key.upper(), count) for key, count in counts.items())
+
+        for _ in range(20):
+            changes = {}
+            for key in rng.sample(sorted(counts), 10):
+                changes[key] = (key.upper(), rng.choice((0, max(1, counts[key] + rng.randint(-3, 3)))))
+            for _ in range(5):
+                key = ''.join(rng.choice('abcd') for _ in range(rng.randint(1, 5)))
+                changes.setdefault(key, (key.upper(), rng.randint(1, 9)))
+            for key, (_, count) in changes.items():
+                if count:
+                    counts[key] = count
+                else:
+                    counts.pop(key, None)
+
+            vocabulary = vocabulary.merged(changes)
+            built = _Vocabulary((key, key.upper(), count) for key, count in counts.items())
+            self.assertEqual(vocabulary.keys, built.keys)
+            self.assertEqual(vocabulary.displays, built.displays)
+            self.assertEqual(vocabulary.counts, built.counts)
+            self.assertEqual(vocabulary._top, built._top)
+            for prefix in ('', 'a', 'ab', 'ca', 'dd'):
+                self.assertEqual(vocabulary.lookup(prefix), built.lookup(prefix))
+
+
+if __name__ == '__main__':
+    unittest.main()
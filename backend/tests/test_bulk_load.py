@@ -0,0 +1,119 @@
+# Tests of the sources read by the bulk loader. Run from the backend
+# directory:
+#
+#     python -m unittest discover tests
+import contextlib
+import gzip
+import io
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+import unittest
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+
+import database
+from bulk_load import bulk_load
+from ingest import shutdown_parse_pool
+from test_cv_updates import cv_xml
+
+
+def tearDownModule():
+    shutdown_parse_pool()
+
+
+def zip_bytes(members):
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return content.getvalue()
+
+
+class BulkLoadSourcesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='lattes-test-')
+        self.inputs = os.path.join(self.directory, 'inputs')
+        os.mkdir(self.inputs)
+        database.close_connections()
+        database.DB_PATH = os.path.join(self.directory, 'lattes.db')
+
+    def tearDown(self):
+        database.close_connections()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write(self, name, data):
+        with open(os.path.join(self.inputs, name), 'wb') as f:
+            f.write(data)
+
+    def load(self):
+        errors = io.StringIO()
+        with contextlib.redirect_stderr(errors):
+            bulk_load([self.inputs], checkpoint=None)
+        with sqlite3.connect(database.DB_PATH) as conn:
+            titles = {title for title, in conn.execute("SELECT title FROM publications")}
+        return titles, errors.getvalue()
+
+    def test_archives_and_compressed_files(self):
+        self.write('plain.xml', cv_xml('1', '01012024', 'Ana Souza', ['Plain']))
+        self.write('compressed.xml.gz', gzip.compress(cv_xml('2', '01012024', 'Rui Lima', ['Compressed'])))
+        self.write('dump.zip', zip_bytes({
+            'cvs/3.xml': cv_xml('3', '01012024', 'Eva Dias', ['Zip member']),
+            'cvs/4.zip': zip_bytes({'4.xml': cv_xml('4', '01012024', 'Ivo Reis', ['Nested zip member'])}),
+            'README.txt': b'not a CV',
+        }))
+        with tarfile.open(os.path.join(self.inputs, 'dump.tar.gz'), 'w:gz') as archive:
+            for name, data in (('5.xml.gz', gzip.compress(cv_xml('5', '01012024', 'Lia Melo', ['Tar member']))),
+                               ('6.zip', zip_bytes({'6.xml': cv_xml('6', '01012024', 'Ney Cruz', ['Tar zip']),
+                                                    '7.xml': b'<CURRICULO-VITAE'}))):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+
+        titles, errors = self.load()
+        self.assertEqual(titles, {'Plain', 'Compressed', 'Zip member', 'Nested zip member', 'Tar member', 'Tar zip'})
+        self.assertIn('dump.tar.gz!6.zip!7.xml', errors)
+
+        # Loading again skips every file
+        titles_again, errors = self.load()
+        self.assertEqual(titles_again, titles)
+        self.assertIn('7 files (6 unchanged, 1 failed)', errors)
+
+    def test_upper_case_suffixes(self):
+        self.write('CV.XML', cv_xml('1', '01012024', 'Ana Souza', ['Upper plain']))
+        self.write('CV2.XML.GZ', gzip.compress(cv_xml('2', '01012024', 'Rui Lima', ['Upper compressed'])))
+        self.write('DUMP.ZIP', zip_bytes({
+            'cvs/3.XML': cv_xml('3', '01012024', 'Eva Dias', ['Upper zip member']),
+            'cvs/4.ZIP': zip_bytes({'4.XML': cv_xml('4', '01012024', 'Ivo Reis', ['Upper nested zip member'])}),
+        }))
+        with tarfile.open(os.path.join(self.inputs, 'DUMP.TGZ'), 'w:gz') as archive:
+            for name, data in (('5.XML', cv_xml('5', '01012024', 'Lia Melo', ['Upper tar member'])),
+                               ('6.ZIP', zip_bytes({'6.XML': cv_xml('6', '01012024', 'Ney Cruz', ['Upper tar zip'])}))):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+
+        titles, errors = self.load()
+        self.assertEqual(titles, {'Upper plain', 'Upper compressed', 'Upper zip member', 'Upper nested zip member',
+                                  'Upper tar member', 'Upper tar zip'})
+        self.assertIn('6 files', errors)
+
+    # The parsing processes never open the database, so they need not
+    # inherit its path from a fork
+    def test_spawned_parsing_processes(self):
+        self.write('1.xml', cv_xml('1', '01012024', 'Ana Souza', ['First version']))
+        self.write('2.xml', cv_xml('1', '01022024', 'Ana Souza', ['Second version']))
+        self.write('3.xml', cv_xml('1', '01012024', 'Ana Souza', ['First version']))
+        with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context('spawn')) as pool, \
+                mock.patch('bulk_load.get_parse_pool', return_value=pool):
+            titles, errors = self.load()
+        self.assertEqual(titles, {'Second version'})
+        self.assertIn('3 files (1 unchanged, 0 failed)', errors)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+# Tests of the search result cache. Run from the backend directory:
+#
+#     python -m unittest discover tests
+import unittest
+
+from cache import ResultCache, estimate_size
+
+
+class ResultCacheTest(unittest.TestCase):
+    def test_generation_bump_invalidates(self):
+        cache = ResultCache(max_bytes=1024 * 1024, ttl=60)
+        rows = [{"title": "Redes neurais", "researcher": "Ana Souza"}]
+        cache.put(("search", "redes"), 1, rows)
+        self.assertIs(cache.get(("search", "redes"), 1), rows)
+
+        self.assertIsNone(cache.get(("search", "redes"), 2))
+        self.assertEqual(cache.invalidations, 1)
+        # The stale entry is gone, even for its own generation
+        self.assertIsNone(cache.get(("search", "redes"), 1))
+        self.assertEqual(cache.stats()["entries"], 0)
+        self.assertEqual(cache.size_bytes, 0)
+
+    def test_expired_entries_are_dropped(self):
+        cache = ResultCache(ttl=0)
+        cache.put("key", 1, [])
+        self.assertIsNone(cache.get("key", 1))
+        self.assertEqual(cache.expirations, 1)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        row = {"title": "x" * 100}
+        size = estimate_size([row])
+        cache = ResultCache(max_bytes=4 * size, ttl=60)
+        for key in "abcd":
+            cache.put(key, 1, [row])
+        cache.get("a", 1)
+        cache.put("e", 1, [row])
+        self.assertIsNone(cache.get("b", 1))
+        self.assertIsNotNone(cache.get("a", 1))
+        self.assertEqual(cache.evictions, 1)
+
+    def test_size_counts_nested_values(self):
+        work = {"title": "T", "researchers": ["Ana Souza" * 10, "Rui Lima" * 10]}
+        bare = {"title": "T", "researchers": []}
+        self.assertGreater(estimate_size([work]) - estimate_size([bare]), 170)
+
+        facets = {"years": [{"year": 2020, "count": 1}] * 10, "top_researchers": [{"researcher": "x" * 500}]}
+        self.assertGreater(estimate_size(facets), 10 * 200 + 500)
+        # Results are cached with their next cursor
+        self.assertGreater(estimate_size(([work], "cursor")), estimate_size([work]))
+
+
+if __name__ == '__main__':
+    unittest.main()
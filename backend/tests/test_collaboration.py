@@ -0,0 +1,102 @@
+# Tests of the coauthorship graph and of keeping it current across
+# ingests. Run from the backend directory:
+#
+#     python -m unittest discover tests
+import asyncio
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import database
+from collaboration import Collaborations
+from ingest import ingest_files, shutdown_parse_pool
+from test_cv_updates import cv_xml
+
+
+def tearDownModule():
+    shutdown_parse_pool()
+
+
+class CollaborationTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='lattes-test-')
+        self.files = 0
+        database.close_connections()
+        database.DB_PATH = os.path.join(self.directory, 'lattes.db')
+        database.init_db()
+
+    def tearDown(self):
+        database.close_connections()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def ingest(self, lattes_id, updated_at, name, titles):
+        self.files += 1
+        path = os.path.join(self.directory, f'{self.files:03d}.xml')
+        with open(path, 'wb') as f:
+            f.write(cv_xml(lattes_id, updated_at, name, titles))
+        asyncio.run(ingest_files([path]))
+
+    def ids(self):
+        with sqlite3.connect(database.DB_PATH) as conn:
+            return dict(conn.execute("SELECT full_name, id FROM researchers"))
+
+    # Collaborators of every researcher in a graph
+    def edges(self, graph):
+        return {researcher_id: graph.collaborators(researcher_id, 100) for researcher_id in range(graph.size)
+                if graph.collaborators(researcher_id, 100)}
+
+    def ingest_network(self):
+        self.ingest('1', '01012024', 'Ana Souza', ['Redes neurais para imagens', 'Aprendizado de máquina em saúde'])
+        self.ingest('2', '01012024', 'Rui Lima', ['Redes neurais para imagens.', 'Grafos de coautoria em escala'])
+        self.ingest('3', '01012024', 'Eva Dias', ['Grafos de coautoria em escala'])
+        self.ingest('4', '01012024', 'Ivo Reis', ['Aprendizado de maquina em saude'])
+
+    def test_collaborators_and_path(self):
+        self.ingest_network()
+        ids = self.ids()
+        collaborations = Collaborations()
+        collaborations.refresh()
+        graph = collaborations.graph
+
+        self.assertEqual(graph.collaborators(ids['Ana Souza'], 10), [(ids['Rui Lima'], 1), (ids['Ivo Reis'], 1)])
+        self.assertEqual(graph.collaborators(ids['Eva Dias'], 10), [(ids['Rui Lima'], 1)])
+        self.assertEqual(graph.collaborators(ids['Ana Souza'], 1), [(ids['Rui Lima'], 1)])
+        self.assertEqual(graph.path(ids['Ivo Reis'], ids['Eva Dias']),
+                         [ids['Ivo Reis'], ids['Ana Souza'], ids['Rui Lima'], ids['Eva Dias']])
+        self.assertEqual(graph.path(ids['Eva Dias'], ids['Eva Dias']), [ids['Eva Dias']])
+
+        self.ingest('5', '01012024', 'Lia Melo', ['Um trabalho sem coautores'])
+        collaborations.refresh()
+        self.assertIsNone(collaborations.graph.path(ids['Ana Souza'], self.ids()['Lia Melo']))
+
+    def test_deleted_publications_remove_collaborations(self):
+        self.ingest_network()
+        ids = self.ids()
+        collaborations = Collaborations(rebuild_ratio=1.0)
+        collaborations.refresh()
+
+        # Ana's publication identified the shared work, which moves to Rui's
+        self.ingest('1', '01022024', 'Ana Souza', ['Aprendizado de máquina em saúde'])
+        self.ingest('6', '01012024', 'Lia Melo', ['Grafos de coautoria em escala'])
+        # The deletion log keeps what the graph has not read, even once the
+        # works repair at startup has
+        database.init_db()
+        with self.assertLogs('collaboration', 'INFO') as logs:
+            collaborations.refresh()
+        self.assertIn('Collaboration graph updated', logs.output[0])
+        self.assertGreater(collaborations.state['deleted'], 0)
+        graph = collaborations.graph
+        self.assertEqual(graph.collaborators(ids['Ana Souza'], 10), [(ids['Ivo Reis'], 1)])
+        self.assertNotIn(ids['Ana Souza'], [researcher_id for researcher_id, _ in
+                                            graph.collaborators(ids['Rui Lima'], 10)])
+        self.assertIsNone(graph.path(ids['Ana Souza'], ids['Eva Dias']))
+
+        rebuilt = Collaborations()
+        rebuilt.refresh()
+        self.assertEqual(self.edges(graph), self.edges(rebuilt.graph))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# Tests of the decompression of gzip-encoded request bodies. Run from the
+# backend directory:
+#
+#     python -m unittest discover tests
+import asyncio
+import gzip
+import unittest
+from unittest import mock
+
+from compression import GzipRequestMiddleware
+
+
+# Send a request with a body in pieces of the given size through the
+# middleware, to an app reading the whole body. Returns the scope and the
+# body messages the app got, and the messages sent back.
+def call(body, headers=((b'content-encoding', b'gzip'),), piece=1000, respond_first=False):
+    pieces = [body[start:start + piece] for start in range(0, len(body), piece)] or [b'']
+    messages = [{'type': 'http.request', 'body': data, 'more_body': i < len(pieces) - 1}
+                for i, data in enumerate(pieces)]
+    received = []
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    async def app(scope, receive, send):
+        received.append(scope)
+        if respond_first:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        while True:
+            message = await receive()
+            received.append(message)
+            if not message.get('more_body'):
+                break
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'ok'})
+
+    scope = {'type': 'http', 'method': 'POST', 'path': '/process-xmls',
+             'headers': [(b'content-length', str(len(body)).encode()), *headers]}
+    asyncio.run(GzipRequestMiddleware(app)(scope, receive, send))
+    return received[0], received[1:], sent
+
+
+def body_of(messages):
+    return b''.join(message['body'] for message in messages)
+
+
+class GzipRequestTest(unittest.TestCase):
+    def test_body_is_decompressed_as_received(self):
+        data = b'<CURRICULO-VITAE/>\n' * 20000
+        with mock.patch('compression._CHUNK', 4096):
+            scope, messages, sent = call(gzip.compress(data), piece=100)
+        self.assertEqual(body_of(messages), data)
+        # Passed on a bounded chunk at a time
+        self.assertGreater(len(messages), len(data) // 4096)
+        self.assertTrue(all(len(message['body']) <= 4096 for message in messages))
+        self.assertFalse(messages[-1]['more_body'])
+        # The body is no longer encoded, and its length unknown
+        self.assertEqual(scope['headers'], [])
+        self.assertEqual(sent[0]['status'], 200)
+
+    def test_concatenated_members(self):
+        first, second = b'first member\n' * 100, b'second member\n' * 100
+        for piece in (7, 100000):
+            with self.subTest(piece=piece):
+                _, messages, _ = call(gzip.compress(first) + gzip.compress(second), piece=piece)
+                self.assertEqual(body_of(messages), first + second)
+
+    def test_encoding_is_matched_in_any_case(self):
+        data = b'data'
+        _, messages, _ = call(gzip.compress(data), headers=[(b'content-encoding', b' GZip ')])
+        self.assertEqual(body_of(messages), data)
+
+    def test_other_bodies_pass_through(self):
+        data = gzip.compress(b'data')
+        scope, messages, _ = call(data, headers=[(b'content-type', b'application/gzip')])
+        self.assertEqual(body_of(messages), data)
+        self.assertIn((b'content-length', str(len(data)).encode()), scope['headers'])
+
+    def test_truncated_and_invalid_bodies(self):
+        compressed = gzip.compress(b'<CURRICULO-VITAE/>\n' * 1000)
+        for body, error in ((compressed[:len(compressed) // 2], b'Truncated gzip request body'),
+                            (compressed[:-4], b'Truncated gzip request body'),
+                            (b'not gzip at all', b'Invalid gzip request body')):
+            with self.subTest(error=error, length=len(body)):
+                _, _, sent = call(body, piece=50)
+                self.assertEqual(sent[0]['status'], 400)
+                self.assertTrue(sent[1]['body'].startswith(error), sent[1]['body'])
+
+    def test_error_after_the_response_started(self):
+        with self.assertRaisesRegex(Exception, 'Truncated gzip request body'):
+            call(gzip.compress(b'data')[:-4], respond_first=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
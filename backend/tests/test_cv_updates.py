@@ -0,0 +1,217 @@
+# Regression tests of re-ingesting CVs: new versions replace the
+# publications of their own CV only, in version order. Run from the backend
+# directory:
+#
+#     python -m unittest discover tests
+import asyncio
+import concurrent.futures
+import contextlib
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+from xml.sax.saxutils import quoteattr
+
+import database
+import ingest
+from bulk_load import bulk_load
+from ingest import BatchWriter, fingerprint_file, ingest_files, shutdown_parse_pool
+from lattes_parser import parse_lattes_xml
+
+
+# Lattes XML of a CV with one article per title. name=None leaves out
+# NOME-COMPLETO.
+def cv_xml(lattes_id, updated_at, name, titles):
+    name_attribute = f' NOME-COMPLETO={quoteattr(name)}' if name is not None else ''
+    articles = ''.join(f'<ARTIGO-PUBLICADO><DADOS-BASICOS-DO-ARTIGO TITULO-DO-ARTIGO={quoteattr(title)} '
+                       f'ANO-DO-ARTIGO="2020"/></ARTIGO-PUBLICADO>' for title in titles)
+    return (f'<CURRICULO-VITAE NUMERO-IDENTIFICADOR="{lattes_id}" DATA-ATUALIZACAO="{updated_at}">'
+            f'<DADOS-GERAIS{name_attribute}/><PRODUCAO-BIBLIOGRAFICA><ARTIGOS-PUBLICADOS>{articles}'
+            '</ARTIGOS-PUBLICADOS></PRODUCAO-BIBLIOGRAFICA></CURRICULO-VITAE>').encode()
+
+
+def tearDownModule():
+    shutdown_parse_pool()
+
+
+class CVUpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='lattes-test-')
+        self.files = 0
+        database.close_connections()
+        database.DB_PATH = os.path.join(self.directory, 'lattes.db')
+        database.init_db()
+
+    def tearDown(self):
+        database.close_connections()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write_file(self, lattes_id, updated_at, name, titles):
+        self.files += 1
+        path = os.path.join(self.directory, f'{self.files:03d}.xml')
+        with open(path, 'wb') as f:
+            f.write(cv_xml(lattes_id, updated_at, name, titles))
+        return path
+
+    # Ingest CV versions, given as (lattes_id, updated_at, name, titles), in
+    # one batch. Returns the paths skipped and the writer.
+    def ingest(self, *versions):
+        paths = [self.write_file(*version) for version in versions]
+        skipped = []
+        _, writer = asyncio.run(ingest_files(paths, on_skip=skipped.append))
+        return [paths.index(path) for path in skipped], writer
+
+    # Titles stored per researcher name
+    def titles(self):
+        with sqlite3.connect(database.DB_PATH) as conn:
+            rows = conn.execute("SELECT r.full_name, p.title FROM publications p "
+                                "JOIN researchers r ON r.id = p.researcher_id").fetchall()
+        titles = {}
+        for name, title in rows:
+            titles.setdefault(name, set()).add(title)
+        return titles
+
+    def test_new_version_replaces_publications(self):
+        self.ingest(('1', '01012024', 'Ana Souza', ['A1', 'A2']))
+        _, writer = self.ingest(('1', '01022024', 'Ana Souza', ['A2', 'A3']))
+        self.assertEqual(self.titles(), {'Ana Souza': {'A2', 'A3'}})
+        self.assertEqual((writer.publications_added, writer.publications_removed), (1, 1))
+
+    def test_homonyms_keep_their_publications(self):
+        self.ingest(('1', '01012024', 'Maria Silva', ['Alpha one', 'Shared']),
+                    ('2', '01012024', 'Maria Silva', ['Delta four', 'Shared']))
+        self.ingest(('1', '01022024', 'Maria Silva', ['Alpha two']))
+        self.assertEqual(self.titles(), {'Maria Silva': {'Alpha two', 'Delta four', 'Shared'}})
+        self.ingest(('2', '01022024', 'Maria Silva', []))
+        self.assertEqual(self.titles(), {'Maria Silva': {'Alpha two'}})
+
+    def test_older_version_in_later_upload_is_skipped(self):
+        self.ingest(('1', '02012024', 'Ana Souza', ['B2', 'B3']))
+        skipped, writer = self.ingest(('1', '01012024', 'Ana Souza', ['B1', 'B2']))
+        self.assertEqual(skipped, [0])
+        self.assertEqual(self.titles(), {'Ana Souza': {'B2', 'B3'}})
+
+    def test_older_version_in_same_upload_is_skipped(self):
+        skipped, _ = self.ingest(('1', '02012024', 'Ana Souza', ['B2', 'B3']),
+                                 ('1', '01012024', 'Ana Souza', ['B1', 'B2']))
+        self.assertEqual(skipped, [1])
+        self.assertEqual(self.titles(), {'Ana Souza': {'B2', 'B3'}})
+
+        # Dates compare as dates, not as ddmmyyyy strings
+        skipped, _ = self.ingest(('1', '01022024', 'Ana Souza', ['B4']),
+                                 ('1', '31012024', 'Ana Souza', ['B1']))
+        self.assertEqual(skipped, [1])
+        self.assertEqual(self.titles(), {'Ana Souza': {'B4'}})
+
+    def test_bulk_load_skips_older_versions(self):
+        self.write_file('1', '02012024', 'Ana Souza', ['B2', 'B3'])
+        self.write_file('1', '01012024', 'Ana Souza', ['B1', 'B2'])
+        # Parsing processes started for another test's database would read
+        # its ledger
+        shutdown_parse_pool()
+        with contextlib.redirect_stderr(io.StringIO()):
+            bulk_load([self.directory], checkpoint=None)
+        self.assertEqual(self.titles(), {'Ana Souza': {'B2', 'B3'}})
+
+    def test_older_version_reaching_writer_is_ignored(self):
+        # Two uploads fingerprinted before either is written
+        newer = self.write_file('1', '02012024', 'Ana Souza', ['B2', 'B3'])
+        older = self.write_file('1', '01012024', 'Ana Souza', ['B1', 'B2'])
+        for path in (newer, older):
+            writer = BatchWriter()
+            try:
+                with open(path, 'rb') as f:
+                    writer.write(*parse_lattes_xml(f), fingerprint_file(path))
+                writer.commit()
+            finally:
+                writer.close()
+        self.assertEqual(self.titles(), {'Ana Souza': {'B2', 'B3'}})
+
+    def test_empty_version_removes_publications(self):
+        self.ingest(('2', '01012024', 'Rui Lima', []))
+        with sqlite3.connect(database.DB_PATH) as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM researchers").fetchone()[0], 0)
+
+        self.ingest(('1', '01012024', 'Ana Souza', ['C1', 'C2']))
+        _, writer = self.ingest(('1', '01022024', 'Ana Souza', []))
+        self.assertEqual(self.titles(), {})
+        self.assertEqual(writer.publications_removed, 2)
+        self.ingest(('1', '01032024', 'Ana Souza', ['C3']))
+        self.assertEqual(self.titles(), {'Ana Souza': {'C3'}})
+
+    def test_version_without_name_keeps_researcher(self):
+        self.ingest(('1', '01012024', 'Ana Souza', ['C1', 'C2']))
+        self.ingest(('1', '01022024', None, ['C2']))
+        self.assertEqual(self.titles(), {'Ana Souza': {'C2'}})
+        self.ingest(('1', '01032024', 'Ana Souza', ['C2', 'C3']))
+        self.assertEqual(self.titles(), {'Ana Souza': {'C2', 'C3'}})
+
+    def test_unchanged_upload_is_skipped(self):
+        version = ('1', '01012024', 'Ana Souza', ['D1', 'D2'])
+        self.ingest(version)
+        skipped, writer = self.ingest(version, version)
+        self.assertEqual(skipped, [0, 1])
+        self.assertEqual((writer.publications_added, writer.publications_removed), (0, 0))
+        self.assertEqual(self.titles(), {'Ana Souza': {'D1', 'D2'}})
+
+    def test_deletion_log_is_pruned_once_read(self):
+        self.ingest(('1', '01012024', 'Ana Souza', ['E1', 'E2', 'E3']))
+        self.ingest(('1', '01022024', 'Ana Souza', ['E3']))
+
+        # A semantic index that has read the first deletion only keeps the
+        # second in the log across a restart
+        database.record_deletion_mark('semantic', 1)
+        database.close_connections()
+        database.init_db()
+        with sqlite3.connect(database.DB_PATH) as conn:
+            self.assertEqual(conn.execute("SELECT seq FROM publication_deletions").fetchall(), [(2,)])
+            self.assertEqual(database.get_deletion_mark(conn.cursor()), 2)
+
+        database.record_deletion_mark('semantic', 2)
+        with sqlite3.connect(database.DB_PATH) as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM publication_deletions").fetchone()[0], 0)
+            # The mark keeps counting once the log is empty
+            self.assertEqual(database.get_deletion_mark(conn.cursor()), 2)
+        self.ingest(('1', '01032024', 'Ana Souza', []))
+        with sqlite3.connect(database.DB_PATH) as conn:
+            self.assertEqual(conn.execute("SELECT seq FROM publication_deletions").fetchall(), [(3,)])
+    def test_skips_across_fingerprint_chunks(self):
+        # One file fingerprinted at a time: files are compared with those
+        # of earlier chunks of the upload
+        with mock.patch('ingest.INGEST_MAX_PENDING', 1):
+            skipped, _ = self.ingest(('1', '02012024', 'Ana Souza', ['F2']),
+                                     ('2', '01012024', 'Rui Lima', ['F3']),
+                                     ('1', '01012024', 'Ana Souza', ['F1']),
+                                     ('2', '01012024', 'Rui Lima', ['F3']))
+        self.assertEqual(skipped, [2, 3])
+        self.assertEqual(self.titles(), {'Ana Souza': {'F2'}, 'Rui Lima': {'F3'}})
+
+    # Only files with a researcher name and publications count as processed
+    def test_processed_count(self):
+        paths = [self.write_file('1', '01012024', 'Ana Souza', ['F1']),
+                 self.write_file('2', '01012024', 'Rui Lima', []),
+                 self.write_file('3', '01012024', None, ['F3'])]
+        processed_count, _ = asyncio.run(ingest_files(paths))
+        self.assertEqual(processed_count, 1)
+
+    # Uploads on different event loops take turns on the writer too
+    def test_write_turn_across_event_loops(self):
+        path = self.write_file('1', '01012024', 'Ana Souza', ['F1'])
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            ingest._write_turn.acquire()
+            try:
+                waiting = executor.submit(asyncio.run, ingest_files([path]))
+                with self.assertRaises(concurrent.futures.TimeoutError):
+                    waiting.result(timeout=0.5)
+                self.assertEqual(self.titles(), {})
+            finally:
+                ingest._write_turn.release()
+            processed_count, _ = waiting.result(timeout=10)
+        self.assertEqual(processed_count, 1)
+        self.assertEqual(self.titles(), {'Ana Souza': {'F1'}})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# Tests of the progress and errors reported by GET /jobs/{id} for uploads
+# ingested in the background. Run from the backend directory:
+#
+#     python -m unittest discover tests
+import asyncio
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from fastapi import HTTPException, UploadFile
+
+import database
+import main
+from ingest import shutdown_parse_pool
+from test_cv_updates import cv_xml
+
+
+def tearDownModule():
+    shutdown_parse_pool()
+
+
+def upload(name, data):
+    return UploadFile(io.BytesIO(data), filename=name)
+
+
+# Upload files through POST /process-xmls and wait for their job to finish.
+# Returns the response of the upload, the status of the job and whether the
+# indexes were woken up to take in its data.
+def run_upload(files):
+    async def run():
+        response = await main.process_xmls([upload(name, data) for name, data in files])
+        await main.get_job(response["job_id"]).task
+        return response, await main.get_ingest_job(response["job_id"])
+
+    with mock.patch('main._data_changed') as data_changed:
+        response, job = asyncio.run(run())
+    return response, job, data_changed.called
+
+
+class IngestJobTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='lattes-test-')
+        database.close_connections()
+        database.DB_PATH = os.path.join(self.directory, 'lattes.db')
+        database.init_db()
+
+    def tearDown(self):
+        database.close_connections()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_progress_and_errors(self):
+        first = cv_xml('0000000000000001', '01012020', 'Ana Souza', ['Graph search', 'Sparse indexes'])
+        second = cv_xml('0000000000000002', '01012020', 'Bruno Lima', ['Query planning'])
+        response, job, data_changed = run_upload([('ana.xml', first), ('notes.txt', b'not a CV'),
+                                                  ('bruno.xml', second), ('broken.xml', b'<CURRICULO-VITAE')])
+        self.assertTrue(data_changed)
+        self.assertEqual(response["ignored_files"], ['notes.txt'])
+        self.assertEqual(job["job_id"], response["job_id"])
+        self.assertEqual(job["status"], 'completed')
+        self.assertEqual(job["files_total"], 3)
+        self.assertEqual(job["files_parsed"], 3)
+        self.assertEqual(job["files_processed"], 2)
+        self.assertEqual(job["files_skipped"], 0)
+        self.assertEqual(job["publications_parsed"], 3)
+        self.assertEqual(job["researchers_added"], 2)
+        self.assertEqual(job["publications_added"], 3)
+        self.assertIsNotNone(job["elapsed_seconds"])
+        self.assertEqual([error["file"] for error in job["errors"]], ['broken.xml'])
+        self.assertTrue(job["errors"][0]["error"])
+
+        # Files already ingested are skipped, not ingested again
+        _, job, _ = run_upload([('ana.xml', first)])
+        self.assertEqual(job["status"], 'completed')
+        self.assertEqual((job["files_parsed"], job["files_skipped"], job["publications_added"]), (0, 1, 0))
+
+    def test_failed_job(self):
+        with mock.patch('jobs.ingest_files', side_effect=RuntimeError("disk full")), \
+                self.assertLogs('jobs', 'ERROR'):
+            _, job, data_changed = run_upload([('ana.xml', cv_xml('0000000000000001', '01012020', 'Ana Souza',
+                                                                  ['Graph search']))])
+        self.assertFalse(data_changed)
+        self.assertEqual(job["status"], 'failed')
+        self.assertEqual(job["publications_added"], 0)
+        self.assertEqual(job["errors"], [{"file": None, "error": "disk full"}])
+        with database.reader_connection() as conn:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM publications').fetchone()[0], 0)
+
+    def test_unknown_job(self):
+        with self.assertRaises(HTTPException) as raised:
+            asyncio.run(main.get_ingest_job('unknown'))
+        self.assertEqual(raised.exception.status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
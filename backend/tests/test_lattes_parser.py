@@ -0,0 +1,103 @@
+# Tests of the streaming Lattes XML parser. Run from the backend directory:
+#
+#     python -m unittest discover tests
+import glob
+import gzip
+import io
+import os
+import unittest
+import xml.etree.ElementTree as ET
+
+from lattes_parser import Publication, parse_lattes_xml, read_cv_version
+
+# Lattes CVs exported for the legacy ETL pipeline
+SAMPLE_DIR = os.path.join(os.path.dirname(__file__), '..', '..', '[OLD_VERSION]', 'apache_hop', 'metadata',
+                          'dataset', 'xml')
+
+
+# The tree-based parser the streaming one replaced, which read the name and
+# the titles of the four publication kinds
+def tree_parse(xml_content):
+    root = ET.fromstring(xml_content)
+    dados_gerais = root.find('.//DADOS-GERAIS')
+    if dados_gerais is None:
+        return None, []
+    publications = []
+    producao_bibliografica = root.find('.//PRODUCAO-BIBLIOGRAFICA')
+    if producao_bibliografica is not None:
+        for element, basic_data, title in (
+                ('ARTIGO-PUBLICADO', 'DADOS-BASICOS-DO-ARTIGO', 'TITULO-DO-ARTIGO'),
+                ('LIVRO-PUBLICADO-OU-ORGANIZADO', 'DADOS-BASICOS-DO-LIVRO', 'TITULO-DO-LIVRO'),
+                ('CAPITULO-DE-LIVRO-PUBLICADO', 'DADOS-BASICOS-DO-CAPITULO', 'TITULO-DO-CAPITULO-DO-LIVRO'),
+                ('TRABALHO-EM-EVENTOS', 'DADOS-BASICOS-DO-TRABALHO', 'TITULO-DO-TRABALHO')):
+            for publication in producao_bibliografica.findall(f'.//{element}'):
+                dados_basicos = publication.find(f'.//{basic_data}')
+                if dados_basicos is not None and dados_basicos.get(title):
+                    publications.append(dados_basicos.get(title))
+    return dados_gerais.get('NOME-COMPLETO'), publications
+
+
+CV = b'''<?xml version="1.0" encoding="ISO-8859-1"?>
+<CURRICULO-VITAE NUMERO-IDENTIFICADOR="0123456789012345" DATA-ATUALIZACAO="09062025">
+<DADOS-GERAIS NOME-COMPLETO="Jo\xe3o da Concei\xe7\xe3o"><RESUMO-CV TEXTO-RESUMO-CV-RH="..."/></DADOS-GERAIS>
+<PRODUCAO-BIBLIOGRAFICA>
+<TRABALHOS-EM-EVENTOS><TRABALHO-EM-EVENTOS>
+<DADOS-BASICOS-DO-TRABALHO TITULO-DO-TRABALHO="Um trabalho" ANO-DO-TRABALHO="2019" DOI=""/>
+<DETALHAMENTO-DO-TRABALHO NOME-DO-EVENTO=" Simp\xf3sio "/>
+</TRABALHO-EM-EVENTOS></TRABALHOS-EM-EVENTOS>
+<ARTIGOS-PUBLICADOS>
+<ARTIGO-PUBLICADO>
+<DADOS-BASICOS-DO-ARTIGO TITULO-DO-ARTIGO="Redes neurais" ANO-DO-ARTIGO="2020" DOI="https://doi.org/10.1000/ABC"/>
+<DETALHAMENTO-DO-ARTIGO TITULO-DO-PERIODICO-OU-REVISTA="Revista"/>
+</ARTIGO-PUBLICADO>
+<ARTIGO-PUBLICADO><DADOS-BASICOS-DO-ARTIGO TITULO-DO-ARTIGO="" ANO-DO-ARTIGO="2020"/></ARTIGO-PUBLICADO>
+<ARTIGO-PUBLICADO><DADOS-BASICOS-DO-ARTIGO TITULO-DO-ARTIGO="Sem ano" ANO-DO-ARTIGO="20"/></ARTIGO-PUBLICADO>
+</ARTIGOS-PUBLICADOS>
+<LIVROS-E-CAPITULOS><CAPITULOS-DE-LIVROS-PUBLICADOS><CAPITULO-DE-LIVRO-PUBLICADO>
+<DADOS-BASICOS-DO-CAPITULO TITULO-DO-CAPITULO-DO-LIVRO="Um cap\xedtulo" ANO="2018" DOI="doi:10.1/X"/>
+<DETALHAMENTO-DO-CAPITULO TITULO-DO-LIVRO="Um livro"/>
+</CAPITULO-DE-LIVRO-PUBLICADO></CAPITULOS-DE-LIVROS-PUBLICADOS></LIVROS-E-CAPITULOS>
+</PRODUCAO-BIBLIOGRAFICA>
+</CURRICULO-VITAE>'''
+
+
+class LattesParserTest(unittest.TestCase):
+    def test_publications_and_metadata(self):
+        full_name, publications = parse_lattes_xml(CV)
+        self.assertEqual(full_name, 'João da Conceição')
+        # Grouped by kind, articles first, in document order
+        self.assertEqual(publications, [
+            Publication('Redes neurais', 'article', 2020, '10.1000/abc', 'Revista'),
+            Publication('Sem ano', 'article', None, None, None),
+            Publication('Um capítulo', 'chapter', 2018, '10.1/x', 'Um livro'),
+            Publication('Um trabalho', 'conference', 2019, None, 'Simpósio'),
+        ])
+
+    def test_sources(self):
+        expected = parse_lattes_xml(CV)
+        self.assertEqual(parse_lattes_xml(io.BytesIO(CV)), expected)
+        self.assertEqual(parse_lattes_xml(gzip.GzipFile(fileobj=io.BytesIO(gzip.compress(CV)))), expected)
+
+    def test_cv_without_general_data(self):
+        self.assertEqual(parse_lattes_xml(b'<CURRICULO-VITAE><PRODUCAO-BIBLIOGRAFICA/></CURRICULO-VITAE>'),
+                         (None, []))
+
+    def test_cv_version(self):
+        self.assertEqual(read_cv_version(CV), ('0123456789012345', '09062025'))
+        self.assertEqual(read_cv_version(b'<CURRICULO-VITAE/>'), (None, None))
+
+    def test_matches_tree_parser_on_sample_cvs(self):
+        paths = sorted(glob.glob(os.path.join(glob.escape(SAMPLE_DIR), '*.xml')))
+        if not paths:
+            self.skipTest("sample CVs not found")
+        for path in paths:
+            with self.subTest(os.path.basename(path)):
+                with open(path, 'rb') as f:
+                    content = f.read()
+                full_name, publications = parse_lattes_xml(content)
+                self.assertEqual((full_name, [publication.title for publication in publications]),
+                                 tree_parse(content))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# Tests of the metrics exposed by GET /metrics. Run from the backend
+# directory:
+#
+#     python -m unittest discover tests
+import asyncio
+import types
+import unittest
+
+import main
+import metrics
+from metrics import Counter, Gauge, Histogram, RequestMetricsMiddleware
+
+
+class MetricsTest(unittest.TestCase):
+    # A metric registered for the test only, left out of /metrics after it
+    def metric(self, metric):
+        self.addCleanup(metrics._registry.remove, metric)
+        return metric
+
+    def test_counter_and_gauge(self):
+        counter = self.metric(Counter('test_files_total', "Files", ('result',)))
+        counter.inc('processed', amount=3)
+        counter.inc('failed')
+        counter.inc('processed')
+        gauge = self.metric(Gauge('test_rate', "Rate"))
+        gauge.set(2.5)
+        gauge.set(4.0)
+
+        self.assertEqual(counter.render(), [
+            '# HELP test_files_total Files',
+            '# TYPE test_files_total counter',
+            'test_files_total{result="failed"} 1',
+            'test_files_total{result="processed"} 4',
+        ])
+        self.assertEqual(gauge.render(), ['# HELP test_rate Rate', '# TYPE test_rate gauge', 'test_rate 4'])
+
+    def test_histogram_buckets(self):
+        histogram = self.metric(Histogram('test_rows', "Rows", ('endpoint',), buckets=(10, 1, 100)))
+        # A value equal to a bound counts in its bucket
+        for value in (0, 1, 1, 5, 10, 11, 1000):
+            histogram.observe(value, '/search')
+
+        self.assertEqual(histogram.render(), [
+            '# HELP test_rows Rows',
+            '# TYPE test_rows histogram',
+            'test_rows_bucket{endpoint="/search",le="1"} 3',
+            'test_rows_bucket{endpoint="/search",le="10"} 5',
+            'test_rows_bucket{endpoint="/search",le="100"} 6',
+            'test_rows_bucket{endpoint="/search",le="+Inf"} 7',
+            'test_rows_sum{endpoint="/search"} 1028',
+            'test_rows_count{endpoint="/search"} 7',
+        ])
+
+    def test_label_values_are_escaped(self):
+        counter = self.metric(Counter('test_escaped_total', "Escaped", ('file',)))
+        counter.inc('a "quoted"\\path\nname')
+        self.assertEqual(counter.render()[-1], 'test_escaped_total{file="a \\"quoted\\"\\\\path\\nname"} 1')
+
+    def test_request_latency(self):
+        async def app(scope, receive, send):
+            await send({'type': 'http.response.start', 'status': 404, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        async def send(message):
+            pass
+
+        scope = {'type': 'http', 'method': 'GET', 'route': types.SimpleNamespace(path='/test/{id}')}
+        asyncio.run(RequestMetricsMiddleware(app)(scope, None, send))
+        self.assertIn('http_request_duration_seconds_count{method="GET",endpoint="/test/{id}",status="404"} 1',
+                      metrics.REQUEST_SECONDS.render())
+
+    def test_exposition(self):
+        response = asyncio.run(main.get_metrics())
+        self.assertEqual(response.media_type, 'text/plain; version=0.0.4')
+        body = response.body.decode()
+        self.assertTrue(body.endswith('\n'))
+        self.assertIn('# TYPE http_request_duration_seconds histogram\n', body)
+        self.assertIn('# TYPE ingest_files_total counter\n', body)
+        # Every sample follows the HELP and TYPE lines of its metric
+        metric = None
+        for line in body.splitlines():
+            if line.startswith('# TYPE '):
+                metric = line.split()[2]
+            elif not line.startswith('#'):
+                self.assertTrue(line.startswith(metric), line)
+
+
+if __name__ == '__main__':
+    unittest.main()
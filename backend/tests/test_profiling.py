@@ -0,0 +1,127 @@
+# Tests of the sampling profiler and of the endpoints serving profiles. Run
+# from the backend directory:
+#
+#     python -m unittest discover tests
+import asyncio
+import time
+import unittest
+from unittest import mock
+
+from fastapi import HTTPException
+
+import main
+import profiling
+from profiling import ProfilingMiddleware, carry_profile, profile_call
+
+
+# Keep a thread busy in backend code for a while
+def busy_work(seconds):
+    finished = time.perf_counter() + seconds
+    while time.perf_counter() < finished:
+        pass
+    return 'done'
+
+
+# ASGI app handing its work to a thread pool, as synchronous endpoints are
+async def app(scope, receive, send):
+    await asyncio.get_running_loop().run_in_executor(None, carry_profile(busy_work), 0.1)
+    await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def send(message):
+    pass
+
+
+def request(headers=(), query_string=b''):
+    scope = {'type': 'http', 'method': 'GET', 'path': '/search', 'headers': list(headers),
+             'query_string': query_string}
+    asyncio.run(ProfilingMiddleware(app)(scope, None, send))
+
+
+def profile_ids():
+    return [profile['id'] for profile in profiling.list_profiles()]
+
+
+class ProfilingTest(unittest.TestCase):
+    def setUp(self):
+        for name in ('profiling.PROFILE_ADMIN_TOKEN', 'main.PROFILE_ADMIN_TOKEN'):
+            patcher = mock.patch(name, 'secret')
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_profile_call(self):
+        result, stacks = profile_call(busy_work, 0.05)
+        self.assertEqual(result, 'done')
+        self.assertTrue(stacks)
+        self.assertTrue(all(stack.startswith('process:parser;') for stack in stacks))
+        self.assertTrue(any('busy_work (tests/test_profiling.py:' in stack for stack in stacks))
+
+    def test_requests_profiled_on_demand(self):
+        before = profile_ids()
+        request([(b'x-profile-token', b'wrong')])
+        request()
+        self.assertEqual(profile_ids(), before)
+
+        request([(b'x-profile-token', b'secret')])
+        request(query_string=b'profile=secret')
+        profiles = profiling.list_profiles()[:2]
+        self.assertEqual([profile['trigger'] for profile in profiles], ['request', 'request'])
+        self.assertEqual(profiles[0]['name'], 'GET /search')
+        self.assertGreater(profiles[0]['samples'], 0)
+        self.assertNotIn('stacks', profiles[0])
+
+        # The thread running the request's synchronous code is in its profile
+        stacks = profiling.get_profile(profiles[0]['id'])['stacks']
+        self.assertTrue(any('busy_work (tests/test_profiling.py:' in stack for stack in stacks))
+
+    def test_slow_requests_are_profiled(self):
+        with mock.patch('profiling.PROFILE_SLOW_THRESHOLD', 0.05), \
+                mock.patch('profiling.PROFILE_SLOW_SAMPLE_INTERVAL', 0.002):
+            profiling.start_slow_sampler()
+            try:
+                request()
+            finally:
+                profiling.stop_slow_sampler()
+        profile = profiling.list_profiles()[0]
+        self.assertEqual(profile['trigger'], 'slow')
+        self.assertGreaterEqual(profile['duration_seconds'], 0.05)
+        stacks = profiling.get_profile(profile['id'])['stacks']
+        self.assertTrue(any('busy_work (tests/test_profiling.py:' in stack for stack in stacks))
+
+    def test_profiles_are_served_to_admins_only(self):
+        request([(b'x-profile-token', b'secret')])
+        profile_id = profile_ids()[0]
+
+        for token, header in ((None, None), ('wrong', None), (None, 'wrong')):
+            with self.subTest(token=token, header=header):
+                with self.assertRaises(HTTPException) as raised:
+                    asyncio.run(main.debug_profiles(token=token, x_profile_token=header))
+                self.assertEqual(raised.exception.status_code, 403)
+                with self.assertRaises(HTTPException):
+                    asyncio.run(main.debug_profile(profile_id, token=token, x_profile_token=header))
+
+        self.assertEqual(asyncio.run(main.debug_profiles(token=None, x_profile_token='secret'))[0]['id'], profile_id)
+        response = asyncio.run(main.debug_profile(profile_id, token='secret', x_profile_token=None))
+        self.assertEqual(response.media_type, 'text/plain')
+        # Collapsed stacks, most sampled first
+        counts = [int(line.rsplit(' ', 1)[1]) for line in response.body.decode().splitlines()]
+        self.assertTrue(counts)
+        self.assertEqual(counts, sorted(counts, reverse=True))
+        with self.assertRaises(HTTPException) as raised:
+            asyncio.run(main.debug_profile(10 ** 9, token='secret', x_profile_token=None))
+        self.assertEqual(raised.exception.status_code, 404)
+
+    def test_profiling_disabled_without_token(self):
+        with mock.patch('profiling.PROFILE_ADMIN_TOKEN', None), mock.patch('main.PROFILE_ADMIN_TOKEN', None):
+            before = profile_ids()
+            request([(b'x-profile-token', b'secret')])
+            self.assertEqual(profile_ids(), before)
+            with self.assertRaises(HTTPException) as raised:
+                asyncio.run(main.debug_profiles(token='secret', x_profile_token=None))
+            self.assertEqual(raised.exception.status_code, 403)
+            self.assertIn('disabled', raised.exception.detail)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,265 @@
+# Tests of the search endpoints, called as functions. Run from the backend
+# directory:
+#
+#     python -m unittest discover tests
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from xml.sax.saxutils import quoteattr
+
+from fastapi import HTTPException
+
+import database
+import main
+from ingest import ingest_files, shutdown_parse_pool
+
+# Publications of the researchers of the test database: (title, kind, year,
+# DOI, venue), kind being the Lattes element of the publication
+CVS = {
+    'João da Conceição': [
+        ('Educação a distância no ensino superior', 'ARTIGO-PUBLICADO', 2019, '10.1/EAD', 'Revista de Educação'),
+        ('Redes neurais para visão computacional', 'ARTIGO-PUBLICADO', 2021, None, 'Revista de Computação'),
+        ('Avaliação da educação básica', 'TRABALHO-EM-EVENTOS', 2021, None, 'Congresso de Educação'),
+    ],
+    'Maria Conceicao Reis': [
+        ('Formação de professores e educação inclusiva', 'LIVRO-PUBLICADO-OU-ORGANIZADO', 2020, None, 'Editora'),
+        ('Redes de sensores sem fio', 'CAPITULO-DE-LIVRO-PUBLICADO', None, None, None),
+    ],
+    'Rui Lima': [
+        ('Grafos e redes complexas', 'ARTIGO-PUBLICADO', 2021, '10.1/GRAFOS', 'Revista de Computação'),
+    ],
+}
+
+# Lattes element -> (section, basic data, title, year, detail, venue)
+_ELEMENTS = {
+    'ARTIGO-PUBLICADO': ('ARTIGOS-PUBLICADOS', 'DADOS-BASICOS-DO-ARTIGO', 'TITULO-DO-ARTIGO', 'ANO-DO-ARTIGO',
+                         'DETALHAMENTO-DO-ARTIGO', 'TITULO-DO-PERIODICO-OU-REVISTA'),
+    'LIVRO-PUBLICADO-OU-ORGANIZADO': ('LIVROS-PUBLICADOS-OU-ORGANIZADOS', 'DADOS-BASICOS-DO-LIVRO', 'TITULO-DO-LIVRO',
+                                      'ANO', 'DETALHAMENTO-DO-LIVRO', 'NOME-DA-EDITORA'),
+    'CAPITULO-DE-LIVRO-PUBLICADO': ('CAPITULOS-DE-LIVROS-PUBLICADOS', 'DADOS-BASICOS-DO-CAPITULO',
+                                    'TITULO-DO-CAPITULO-DO-LIVRO', 'ANO', 'DETALHAMENTO-DO-CAPITULO',
+                                    'TITULO-DO-LIVRO'),
+    'TRABALHO-EM-EVENTOS': ('TRABALHOS-EM-EVENTOS', 'DADOS-BASICOS-DO-TRABALHO', 'TITULO-DO-TRABALHO',
+                            'ANO-DO-TRABALHO', 'DETALHAMENTO-DO-TRABALHO', 'NOME-DO-EVENTO'),
+}
+
+
+def cv_with_metadata(lattes_id, name, publications):
+    sections = {}
+    for title, element, year, doi, venue in publications:
+        section, basic_data, title_attribute, year_attribute, detail, venue_attribute = _ELEMENTS[element]
+        sections.setdefault(section, []).append(
+            f'<{element}><{basic_data} {title_attribute}={quoteattr(title)} '
+            f'{year_attribute}="{year or ""}" DOI="{doi or ""}"/>'
+            f'<{detail} {venue_attribute}={quoteattr(venue or "")}/></{element}>')
+    body = ''.join(f'<{section}>{"".join(elements)}</{section}>' for section, elements in sections.items())
+    return (f'<CURRICULO-VITAE NUMERO-IDENTIFICADOR="{lattes_id}" DATA-ATUALIZACAO="01012024">'
+            f'<DADOS-GERAIS NOME-COMPLETO={quoteattr(name)}/>'
+            f'<PRODUCAO-BIBLIOGRAFICA>{body}</PRODUCAO-BIBLIOGRAFICA></CURRICULO-VITAE>').encode()
+
+
+def tearDownModule():
+    shutdown_parse_pool()
+
+
+class SearchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp(prefix='lattes-test-')
+        database.close_connections()
+        database.DB_PATH = os.path.join(cls.directory, 'lattes.db')
+        database.init_db()
+        paths = []
+        for index, (name, publications) in enumerate(CVS.items()):
+            path = os.path.join(cls.directory, f'{index}.xml')
+            with open(path, 'wb') as f:
+                f.write(cv_with_metadata(str(index), name, publications))
+            paths.append(path)
+        asyncio.run(ingest_files(paths))
+
+    @classmethod
+    def tearDownClass(cls):
+        database.close_connections()
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    def setUp(self):
+        # Other tests' databases start at the same generation
+        main.search_cache.clear()
+
+    # Call a search endpoint with its defaults. Returns the decoded body and
+    # the next page's cursor.
+    def call(self, endpoint, filters=main._NO_FILTERS, **params):
+        defaults = dict(limit=None, cursor=None, stream=False, facets=False, by_work=False)
+        if endpoint is main.search_publications:
+            defaults.update(query=None, mode='fts')
+        response = endpoint(**dict(defaults, filters=filters, **params))
+        return json.loads(response.body), response.headers.get('X-Next-Cursor')
+
+    def titles(self, endpoint, **params):
+        results, _ = self.call(endpoint, **params)
+        return [result['title'] for result in results]
+
+    def test_full_text_search(self):
+        # Accents and case are ignored, words match as prefixes, in any order
+        self.assertEqual(set(self.titles(main.search_publications, query='EDUCACAO')), {
+            'Educação a distância no ensino superior',
+            'Avaliação da educação básica',
+            'Formação de professores e educação inclusiva',
+        })
+        self.assertEqual(set(self.titles(main.search_publications, query='comp REDES')),
+                         {'Grafos e redes complexas', 'Redes neurais para visão computacional'})
+        self.assertEqual(self.titles(main.search_publications, query='inexistente'), [])
+
+        # Substring mode keeps matching inside words, with accents
+        self.assertEqual(self.titles(main.search_publications, query='ducação b', mode='substring'),
+                         ['Avaliação da educação básica'])
+
+    def test_full_text_ranking(self):
+        # BM25: the shorter title, where the word weighs more, ranks first
+        self.assertEqual(self.titles(main.search_publications, query='redes'), [
+            'Grafos e redes complexas',
+            'Redes neurais para visão computacional',
+            'Redes de sensores sem fio',
+        ])
+
+    def researchers(self, name):
+        results, _ = self.call(main.search_publications_by_author, name=name)
+        return sorted({result['researcher'] for result in results})
+
+    def test_author_search(self):
+        # Accents and case are ignored on both sides, anywhere in the name
+        both = ['João da Conceição', 'Maria Conceicao Reis']
+        self.assertEqual(self.researchers('conceicao'), both)
+        self.assertEqual(self.researchers('CONCEIÇÃO'), both)
+        self.assertEqual(self.researchers('ão da conc'), ['João da Conceição'])
+        self.assertEqual(self.researchers('ui'), ['Rui Lima'])
+        self.assertEqual(self.researchers('Lima Rui'), [])
+
+        # All publications of the matching researchers, by name and title
+        results, _ = self.call(main.search_publications_by_author, name='cao reis')
+        self.assertEqual([result['title'] for result in results],
+                         ['Formação de professores e educação inclusiva', 'Redes de sensores sem fio'])
+
+    # Every page of a search, following the next page cursors
+    def pages(self, endpoint, limit, **params):
+        pages = []
+        cursor = None
+        while True:
+            results, cursor = self.call(endpoint, limit=limit, cursor=cursor, **params)
+            pages.append(results)
+            if cursor is None:
+                return pages
+
+    def test_cursor_pages_concatenate_to_full_result(self):
+        for endpoint, params in ((main.search_publications, {'filters': main._NO_FILTERS._replace(year_to=2030)}),
+                                 (main.search_publications, {'query': 'redes'}),
+                                 (main.search_publications, {'query': 'ção', 'mode': 'substring'}),
+                                 (main.search_publications_by_author, {'name': 'conceicao'}),
+                                 (main.search_publications, {'query': 'educação', 'by_work': True}),
+                                 (main.search_publications, {'filters': main._NO_FILTERS._replace(year_from=2020)})):
+            full, cursor = self.call(endpoint, **params)
+            self.assertIsNone(cursor)
+            self.assertGreater(len(full), 1)
+            for limit in (1, 2, len(full)):
+                with self.subTest(endpoint=endpoint.__name__, params=params, limit=limit):
+                    pages = self.pages(endpoint, limit, **params)
+                    self.assertTrue(all(len(page) == limit for page in pages[:-1]))
+                    self.assertEqual([result for page in pages for result in page], full)
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(HTTPException) as raised:
+            self.call(main.search_publications, limit=1, cursor='not a cursor')
+        self.assertEqual(raised.exception.status_code, 400)
+
+
+
+# Facets counted by GROUP BY over the publications matching the WHERE clause
+def grouped_facets(where='1', params=()):
+    with sqlite3.connect(database.DB_PATH) as conn:
+        def group(column):
+            return dict(conn.execute(f"""
+            SELECT {column}, COUNT(*) FROM publications p
+            JOIN researchers r ON r.id = p.researcher_id
+            LEFT JOIN venues v ON v.id = p.venue_id
+            WHERE {where} GROUP BY 1
+            """, params))
+        return {'years': group('p.year'), 'kinds': group('p.kind'), 'top_researchers': group('r.full_name')}
+
+
+# Facets of a response as the dicts of grouped_facets
+def facet_counts(facets):
+    return {'years': {item['year']: item['count'] for item in facets['years']},
+            'kinds': {item['kind']: item['count'] for item in facets['kinds']},
+            'top_researchers': {item['researcher']: item['count'] for item in facets['top_researchers']}}
+
+
+class FacetsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='lattes-test-')
+        database.close_connections()
+        database.DB_PATH = os.path.join(self.directory, 'lattes.db')
+        database.init_db()
+        main.search_cache.clear()
+
+    def tearDown(self):
+        database.close_connections()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def ingest(self, cvs, updated_at='01012024'):
+        paths = []
+        for index, (name, publications) in enumerate(cvs.items()):
+            path = os.path.join(self.directory, f'{updated_at}-{index}.xml')
+            with open(path, 'wb') as f:
+                f.write(cv_with_metadata(str(index), name, publications).replace(b'01012024', updated_at.encode()))
+            paths.append(path)
+        asyncio.run(ingest_files(paths))
+
+    def assert_facets_match_group_by(self):
+        article = ('article',)
+        cases = [
+            # The count tables answer these
+            (main._NO_FILTERS, '1', ()),
+            (main._NO_FILTERS._replace(year_from=2020, year_to=2021), 'p.year BETWEEN 2020 AND 2021', ()),
+            (main._NO_FILTERS._replace(kind=article), "p.kind = 'article'", ()),
+            # Counted over the matching publications
+            (main._NO_FILTERS._replace(venue='Revista de Computação'), 'v.name = ?', ('Revista de Computação',)),
+            (main._NO_FILTERS._replace(doi='10.1/ead'), "p.doi = '10.1/ead'", ()),
+        ]
+        for filters, where, params in cases:
+            with self.subTest(filters=filters):
+                self.assertEqual(facet_counts(json.loads(main.get_facets(filters).body)),
+                                 grouped_facets(where, params))
+
+        # Facets of searches, next to their results
+        body = json.loads(main.search_publications(query='educação', mode='fts', limit=1, cursor=None,
+                                                   stream=False, facets=True, by_work=False,
+                                                   filters=main._NO_FILTERS).body)
+        self.assertEqual(len(body['results']), 1)
+        self.assertEqual(facet_counts(body['facets']), grouped_facets(
+            "p.id IN (SELECT rowid FROM publications_fts WHERE publications_fts MATCH 'educacao*')"))
+        for filters, where in ((main._NO_FILTERS, '1'), (main._NO_FILTERS._replace(year_from=2021), 'p.year >= 2021')):
+            body = json.loads(main.search_publications_by_author(name='CONCEIÇÃO', limit=None, cursor=None,
+                                                                 stream=False, facets=True, by_work=False,
+                                                                 filters=filters).body)
+            self.assertEqual(facet_counts(body['facets']),
+                             grouped_facets(f"r.full_name LIKE '%Concei%' AND {where}"))
+
+    def test_facets_match_group_by(self):
+        self.ingest(CVS)
+        self.assert_facets_match_group_by()
+
+        # The count tables follow updated CVs, down to removed years and kinds
+        cvs = dict(CVS)
+        cvs['João da Conceição'] = CVS['João da Conceição'][1:2] + [
+            ('Um livro novo', 'LIVRO-PUBLICADO-OU-ORGANIZADO', 2024, None, 'Editora')]
+        self.ingest(cvs, '01022024')
+        self.assert_facets_match_group_by()
+        self.assertNotIn(2019, facet_counts(json.loads(main.get_facets(main._NO_FILTERS).body))['years'])
+
+
+if __name__ == '__main__':
+    unittest.main()
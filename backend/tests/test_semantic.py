@@ -0,0 +1,372 @@
+# Tests of the semantic index. Run from the backend directory:
+#
+#     python -m unittest discover tests
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import numpy as np
+
+import database
+from ingest import ingest_files, shutdown_parse_pool
+from semantic import FlatIndex, IVFIndex, SemanticIndex, VectorStore, recall_report, update_index
+from semantic.__main__ import build, recall
+from test_cv_updates import cv_xml
+
+TOPICS = [
+    ['redes neurais', 'aprendizado profundo', 'visão computacional', 'classificação de imagens'],
+    ['ensino superior', 'formação de professores', 'educação a distância', 'avaliação da aprendizagem'],
+    ['grafos de coautoria', 'redes complexas', 'análise de redes sociais', 'centralidade em grafos'],
+    ['qualidade da água', 'bacias hidrográficas', 'recursos hídricos', 'poluição de rios'],
+]
+PLACES = ['no Brasil', 'em Minas Gerais', 'na Amazônia', 'em escolas públicas', 'em hospitais']
+
+# (publication_id, title) rows: every topic phrase in every place
+ROWS = [(index + 1, f'{phrase.capitalize()} {place}')
+        for index, (phrase, place) in enumerate((phrase, place) for topic in TOPICS
+                                                for phrase in topic for place in PLACES)]
+
+
+# Random unit vectors around n_clusters centers, as embedded titles on a
+# few topics are
+def clustered_vectors(n_vectors, dim, n_clusters, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim))
+    vectors = centers[rng.integers(n_clusters, size=n_vectors)] + 0.5 * rng.standard_normal((n_vectors, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def tearDownModule():
+    shutdown_parse_pool()
+
+
+class SemanticIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='lattes-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    # Topic of a publication id of ROWS
+    def topic(self, publication_id):
+        return (publication_id - 1) // (len(TOPICS[0]) * len(PLACES))
+
+    def test_search_finds_titles_on_the_query_topic(self):
+        index = SemanticIndex.build(ROWS, dim=16)
+        self.assertEqual(len(index), len(ROWS))
+
+        results = index.search('Redes neurais na Amazônia', k=5)
+        self.assertEqual(results[0][0], {title: publication_id for publication_id, title in ROWS}[
+            'Redes neurais na Amazônia'])
+        self.assertAlmostEqual(results[0][1], 1.0, places=4)
+        self.assertEqual([score for _, score in results], sorted((score for _, score in results), reverse=True))
+
+        # Accents and case do not matter, and related titles follow
+        results = index.search('EDUCACAO A DISTANCIA', k=5)
+        self.assertTrue(all(self.topic(publication_id) == 1 for publication_id, _ in results))
+        self.assertEqual(index.search('xyzzy', k=5), [])
+
+    def test_flat_index_is_exact(self):
+        index = SemanticIndex.build(ROWS, dim=16)
+        vectors = index.store.to_float32()
+        query_vector = vectors[7]
+        positions, scores = FlatIndex().search(index.store, query_vector, 10)
+        expected = np.argsort(-(vectors @ query_vector), kind='stable')[:10]
+        np.testing.assert_allclose(scores, (vectors @ query_vector)[expected], rtol=1e-5)
+        self.assertEqual(positions[0], 7)
+
+    def test_saved_index_gives_the_same_results(self):
+        index = SemanticIndex.build(ROWS, dim=16)
+        index.save(self.directory, dtype='float32')
+        loaded = SemanticIndex.load(self.directory)
+        for query in ('redes complexas', 'poluição de rios em Minas Gerais'):
+            expected = index.search(query, k=5)
+            found = loaded.search(query, k=5)
+            self.assertEqual([publication_id for publication_id, _ in found],
+                             [publication_id for publication_id, _ in expected])
+            np.testing.assert_allclose([score for _, score in found], [score for _, score in expected], rtol=1e-5)
+
+    def test_tombstones_are_filtered_out(self):
+        for ann in ('flat', 'ivf'):
+            with self.subTest(ann=ann):
+                index = SemanticIndex.build(ROWS, dim=16)
+                if ann == 'ivf':
+                    index.build_ivf(n_lists=8)
+                expected = index.search('redes neurais', k=len(ROWS), nprobe=8)
+
+                # Tombstones crowding the top still leave k live hits
+                deleted = [publication_id for publication_id, _ in expected[:12]]
+                index.append([], deleted)
+                self.assertEqual(len(index), len(ROWS) - 12)
+                self.assertEqual(index.search('redes neurais', k=5, nprobe=8), expected[12:17])
+
+                # Compaction drops the tombstoned vectors
+                index.compact()
+                self.assertEqual(len(index.tombstones), 0)
+                self.assertEqual(len(index.store), len(ROWS) - 12)
+                self.assertEqual([publication_id for publication_id, _ in index.search('redes neurais', k=5, nprobe=8)],
+                                 [publication_id for publication_id, _ in expected[12:17]])
+
+    def test_appended_rows_are_searched_until_compaction(self):
+        index = SemanticIndex.build(ROWS, dim=16)
+        index.build_ivf(n_lists=8)
+        new_id = len(ROWS) + 1
+        index.append([(new_id, 'Redes neurais para a qualidade da água')], [1])
+        self.assertEqual(index.delta_size, 1)
+        results = index.search('redes neurais qualidade da água', k=5, nprobe=8)
+        self.assertEqual(results[0][0], new_id)
+        self.assertNotIn(1, [publication_id for publication_id, _ in index.search('redes neurais', k=len(ROWS))])
+
+        index.save(self.directory)
+        loaded = SemanticIndex.load(self.directory)
+        self.assertEqual(loaded.delta_size, 1)
+        np.testing.assert_array_equal(loaded.tombstones, [1])
+
+        index.compact()
+        self.assertEqual(index.deltas, [])
+        self.assertIn(new_id, index.store.publication_ids)
+        self.assertEqual(index.search('redes neurais qualidade da água', k=1, nprobe=8)[0][0], new_id)
+
+    def test_delta_segments(self):
+        index = SemanticIndex.build(ROWS[:40], dim=16)
+        index.save(self.directory)
+        expected = SemanticIndex.build(ROWS[:40], dim=16)
+        expected.append(ROWS[40:])
+
+        # Every append is a segment, merged with the last ones no larger,
+        # and saving writes only the segment made
+        for start in range(40, len(ROWS), 4):
+            index = SemanticIndex.load(self.directory)
+            index.append(ROWS[start:start + 4])
+            index.save_delta(self.directory)
+            index.save_state(self.directory)
+            sizes = [len(delta) for delta in index.deltas]
+            self.assertEqual(sizes, sorted(sizes, reverse=True))
+            self.assertEqual(sum(file is not None for file in index.delta_files), len(sizes))
+            self.assertEqual(sorted(name for name in os.listdir(self.directory) if name.startswith('delta')),
+                             sorted(index.delta_files))
+        self.assertLess(len(index.deltas), 5)
+
+        loaded = SemanticIndex.load(self.directory)
+        self.assertEqual(loaded.delta_size, len(ROWS) - 40)
+        self.assertEqual(loaded.search('redes neurais qualidade da água', k=5),
+                         expected.search('redes neurais qualidade da água', k=5))
+
+    def test_len_counts_only_tombstoned_vectors(self):
+        index = SemanticIndex.build(ROWS[:60], dim=16)
+        index.append(ROWS[60:62], [1, ROWS[60][0], len(ROWS) + 1])
+        # The last tombstone names a publication never indexed
+        self.assertEqual(len(index), 60)
+        index.compact()
+        self.assertEqual(len(index), 60)
+
+
+class IndexUpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='lattes-test-')
+        self.index_dir = os.path.join(self.directory, 'semantic_index')
+        self.files = 0
+        database.close_connections()
+        database.DB_PATH = os.path.join(self.directory, 'lattes.db')
+        database.init_db()
+
+    def tearDown(self):
+        database.close_connections()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def ingest(self, lattes_id, updated_at, titles):
+        self.files += 1
+        path = os.path.join(self.directory, f'{self.files:03d}.xml')
+        with open(path, 'wb') as f:
+            f.write(cv_xml(lattes_id, updated_at, f'Pesquisador {lattes_id}', titles))
+        asyncio.run(ingest_files([path]))
+
+    def query(self, sql):
+        with sqlite3.connect(database.DB_PATH) as conn:
+            return conn.execute(sql).fetchall()
+
+    def ids(self):
+        return dict(self.query("SELECT title, id FROM publications"))
+
+    def test_update_follows_the_database(self):
+        titles = [title for _, title in ROWS]
+        self.ingest('1', '01012024', titles[:40])
+        self.ingest('2', '01012024', titles[40:])
+        with contextlib.redirect_stdout(io.StringIO()):
+            build(argparse.Namespace(index_dir=self.index_dir, dim=16, fit_sample=50000, ann='ivf', n_lists=4,
+                                     dtype='int8', keep_float32=True))
+        self.assertFalse(update_index(self.index_dir))
+
+        # The second CV loses half its titles and gains one
+        old_ids = self.ids()
+        self.ingest('2', '01022024', titles[40:60] + ['Redes neurais para a qualidade da água'])
+        self.assertTrue(update_index(self.index_dir, compact_ratio=10))
+        index = SemanticIndex.load(self.index_dir)
+        self.assertGreater(len(index.tombstones), 0)
+        self.assertGreater(index.delta_size, 0)
+        self.assertEqual(len(index), len(self.ids()))
+
+        ids = self.ids()
+        self.assertEqual(index.search('redes neurais qualidade da água', k=1, nprobe=4)[0][0],
+                         ids['Redes neurais para a qualidade da água'])
+        found = {publication_id for publication_id, _ in index.search('qualidade da água', k=len(ROWS), nprobe=4)}
+        self.assertTrue(found <= set(ids.values()))
+        self.assertFalse(found & {old_ids[title] for title in titles[60:]})
+        self.assertFalse(update_index(self.index_dir))
+
+        # The index recorded that it read every deletion. The works repair
+        # reads them at startup, and then the log is pruned.
+        self.assertEqual(self.query("SELECT seq FROM deletion_marks WHERE consumer = 'semantic'"),
+                         self.query("SELECT seq FROM sqlite_sequence WHERE name = 'publication_deletions'"))
+        database.init_db()
+        self.assertEqual(self.query("SELECT COUNT(*) FROM publication_deletions"), [(0,)])
+
+        self.assertTrue(update_index(self.index_dir, force_compact=True))
+        index = SemanticIndex.load(self.index_dir)
+        self.assertEqual(len(index.tombstones), 0)
+        self.assertEqual(index.deltas, [])
+        self.assertEqual(sorted(index.store.publication_ids), sorted(ids.values()))
+
+
+class VectorStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='lattes-test-')
+        self.path = os.path.join(self.directory, 'vectors.bin')
+        self.vectors = clustered_vectors(300, 24, 5)
+        self.store = VectorStore(self.vectors, np.arange(1000, 1300))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_round_trip(self):
+        query_vector = self.vectors[0]
+        for dtype, tolerance in (('float32', 0), ('float16', 1e-3), ('int8', 1e-2)):
+            for keep_float32 in (True, False):
+                with self.subTest(dtype=dtype, keep_float32=keep_float32):
+                    self.store.write(self.path, dtype=dtype, keep_float32=keep_float32, block_rows=64)
+                    loaded = VectorStore.open(self.path)
+                    self.assertEqual(loaded.dtype, dtype)
+                    self.assertEqual(len(loaded), len(self.store))
+                    np.testing.assert_array_equal(loaded.publication_ids, self.store.publication_ids)
+                    self.assertIsInstance(loaded.vectors, np.memmap)
+                    self.assertEqual(loaded.vectors.offset % 64, 0)
+
+                    np.testing.assert_allclose(loaded.scores(query_vector), self.vectors @ query_vector,
+                                               atol=tolerance, rtol=0)
+                    np.testing.assert_allclose(loaded.scores(query_vector, 10, 20),
+                                               loaded.scores(query_vector)[10:20], rtol=1e-6)
+                    # Only quantized stores keep an unquantized copy
+                    self.assertEqual(loaded.can_rescore, keep_float32 and dtype != 'float32')
+                    if loaded.can_rescore:
+                        np.testing.assert_array_equal(loaded.to_float32(), self.vectors)
+                        np.testing.assert_allclose(loaded.rescore(query_vector, [3, 5]),
+                                                   self.vectors[[3, 5]] @ query_vector, rtol=1e-6)
+                    else:
+                        np.testing.assert_allclose(loaded.to_float32(), self.vectors, atol=tolerance, rtol=0)
+
+    def test_empty_store(self):
+        VectorStore(np.zeros((0, 24), dtype=np.float32), np.zeros(0, dtype=np.int64)).write(self.path)
+        loaded = VectorStore.open(self.path)
+        self.assertEqual(len(loaded), 0)
+        self.assertEqual(loaded.scores(self.vectors[0]).shape, (0,))
+
+    def test_header_is_validated(self):
+        self.store.write(self.path)
+        with open(self.path, 'rb') as f:
+            content = f.read()
+        for name, corrupted in (('magic', b'NOTAVEC\x00' + content[8:]),
+                                ('version', content[:8] + (2).to_bytes(4, 'little') + content[12:]),
+                                ('truncated', content[:20]),
+                                ('empty', b'')):
+            with self.subTest(name):
+                with open(self.path, 'wb') as f:
+                    f.write(corrupted)
+                with self.assertRaisesRegex(ValueError, 'is not a version 1 vector store'):
+                    VectorStore.open(self.path)
+
+    def test_rewrite_keeps_open_stores_readable(self):
+        self.store.write(self.path, dtype='float32')
+        loaded = VectorStore.open(self.path)
+        VectorStore(self.vectors[::-1].copy(), self.store.publication_ids[::-1].copy()).write(self.path)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+        np.testing.assert_array_equal(loaded.vectors, self.vectors)
+        np.testing.assert_array_equal(VectorStore.open(self.path).publication_ids, np.arange(1299, 999, -1))
+
+
+class IVFIndexTest(unittest.TestCase):
+    def setUp(self):
+        vectors = clustered_vectors(4000, 32, 20)
+        self.ann, permutation = IVFIndex.build(vectors, n_lists=64)
+        self.store = VectorStore(vectors[permutation], np.arange(len(vectors))[permutation])
+        self.queries = clustered_vectors(100, 32, 20, seed=1)
+
+    def test_lists_partition_the_store(self):
+        self.assertEqual(self.ann.offsets[0], 0)
+        self.assertEqual(self.ann.offsets[-1], len(self.store))
+        self.assertTrue(np.all(np.diff(self.ann.offsets) >= 0))
+        # Every vector is in the list of its closest centroid
+        assignment = IVFIndex.assign(self.store.vectors, self.ann.centroids)
+        self.assertTrue(np.all(np.diff(assignment) >= 0))
+        np.testing.assert_array_equal(np.searchsorted(self.ann.offsets, np.arange(len(self.store)), side='right') - 1,
+                                      assignment)
+
+    def test_recall_against_exact_search(self):
+        # Scanning every list is exact
+        self.assertEqual(recall_report(self.store, self.ann, self.queries, k=10, nprobe=64)['recall'], 1.0)
+        recalls = [recall_report(self.store, self.ann, self.queries, k=10, nprobe=nprobe)['recall']
+                   for nprobe in (1, 4, 16)]
+        self.assertEqual(recalls, sorted(recalls))
+        self.assertGreaterEqual(recalls[-1], 0.95)
+
+    def test_search_returns_stored_positions(self):
+        positions, scores = self.ann.search(self.store, self.queries[0], 10, nprobe=64)
+        expected, expected_scores = FlatIndex().search(self.store, self.queries[0], 10)
+        np.testing.assert_allclose(scores, expected_scores, rtol=1e-5)
+        np.testing.assert_allclose(self.store.vectors[positions] @ self.queries[0], scores, rtol=1e-5)
+
+    def test_semantic_index_with_ivf(self):
+        index = SemanticIndex.build(ROWS, dim=16)
+        expected = index.search('redes complexas no Brasil', k=5)
+        index.build_ivf(n_lists=8)
+        self.assertIsInstance(index.ann, IVFIndex)
+        self.assertEqual(sorted(index.store.publication_ids), [publication_id for publication_id, _ in ROWS])
+        self.assertEqual(index.search('redes complexas no Brasil', k=5, nprobe=8), expected)
+
+    def test_recall_command_covers_the_live_index(self):
+        directory = tempfile.mkdtemp(prefix='lattes-test-')
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        index = SemanticIndex.build(ROWS[:60], dim=16)
+        index.build_ivf(n_lists=4)
+        # More appended rows than tombstones: the index is larger than its
+        # main segment
+        index.append(ROWS[60:], [1, 2])
+        index.save(directory)
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            recall(argparse.Namespace(index_dir=directory, k=5, queries=len(ROWS), nprobe=[1, 4], seed=0))
+        reports = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([report['queries'] for report in reports], [len(ROWS) - 2] * 2)
+        self.assertEqual(reports[-1]['recall'], 1.0)
+        # The saved index is not compacted
+        self.assertEqual(SemanticIndex.load(directory).delta_size, len(ROWS) - 60)
+
+    def test_saved_ivf_index(self):
+        directory = tempfile.mkdtemp(prefix='lattes-test-')
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, 'ivf.npz')
+        self.ann.save(path)
+        loaded = IVFIndex.load(path)
+        np.testing.assert_array_equal(loaded.centroids, self.ann.centroids)
+        np.testing.assert_array_equal(loaded.offsets, self.ann.offsets)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+# Tests of grouping publications into works. Run from the backend directory:
+#
+#     python -m unittest discover tests
+import asyncio
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import numpy as np
+
+import database
+from ingest import ingest_files, shutdown_parse_pool
+from test_search import cv_with_metadata
+from works import _shingles, signatures, similarity, title_key
+
+TITLE = 'Redes neurais convolucionais para classificação de imagens médicas'
+
+
+def tearDownModule():
+    shutdown_parse_pool()
+
+
+class MinHashTest(unittest.TestCase):
+    def test_title_key(self):
+        self.assertEqual(title_key('  Redes Neurais: classificação de IMAGENS médicas. '),
+                         'redes neurais classificacao de imagens medicas')
+        self.assertEqual(title_key('-- / --'), '')
+
+    def test_signatures_estimate_jaccard_similarity(self):
+        keys = [title_key(title) for title in (
+            TITLE,
+            TITLE + ': um estudo de caso',
+            'Redes neurais convolucionais na classificação de imagens médicas',
+            'Qualidade da água em bacias hidrográficas de Minas Gerais',
+        )]
+        batch = signatures(keys)
+        self.assertEqual(batch.shape, (4, 72))
+        # Titles are hashed the same alone as in a batch
+        for key, signature in zip(keys, batch):
+            np.testing.assert_array_equal(signatures([key])[0], signature)
+
+        for other in range(1, 4):
+            with self.subTest(other=other):
+                exact = similarity(_shingles(keys[0]), _shingles(keys[other]))
+                estimate = np.mean(batch[0] == batch[other])
+                self.assertLess(abs(estimate - exact), 0.2)
+        self.assertEqual(signatures([]).shape, (0, 72))
+
+
+class WorksTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='lattes-test-')
+        self.files = 0
+        database.close_connections()
+        database.DB_PATH = os.path.join(self.directory, 'lattes.db')
+        database.init_db()
+
+    def tearDown(self):
+        database.close_connections()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    # Ingest a CV of (title, year) articles
+    def ingest(self, lattes_id, updated_at, publications):
+        self.files += 1
+        path = os.path.join(self.directory, f'{self.files:03d}.xml')
+        xml = cv_with_metadata(lattes_id, f'Pesquisador {lattes_id}',
+                               [(title, 'ARTIGO-PUBLICADO', year, None, None) for title, year in publications])
+        with open(path, 'wb') as f:
+            f.write(xml.replace(b'01012024', updated_at.encode()))
+        asyncio.run(ingest_files([path]))
+
+    def query(self, sql, params=()):
+        with sqlite3.connect(database.DB_PATH) as conn:
+            return conn.execute(sql, params).fetchall()
+
+    # Works as sets of (Lattes id, title) pairs, the id read back from the
+    # researcher's name
+    def works(self):
+        works = {}
+        for work_id, full_name, title in self.query("""
+                SELECT p.work_id, r.full_name, p.title FROM publications p
+                JOIN researchers r ON r.id = p.researcher_id"""):
+            works.setdefault(work_id, set()).add((full_name.split()[-1], title))
+        return sorted(works.values(), key=sorted)
+
+    def publication_id(self, lattes_id):
+        [(publication_id,)] = self.query("SELECT p.id FROM publications p JOIN researchers r ON r.id = p.researcher_id "
+                                         "WHERE r.full_name = ?", (f'Pesquisador {lattes_id}',))
+        return publication_id
+
+    def test_near_duplicates_are_grouped(self):
+        self.ingest('1', '01012024', [(TITLE, 2020), ('Editorial', 2020), ('Introdução', 2020)])
+        self.ingest('2', '01012024', [(TITLE.upper() + '.', 2021), ('Editorial', 2020)])
+        self.ingest('3', '01012024', [('Redes neurais convolucionais para classificacao de imagens medicas', 2020),
+                                      # Too far apart in years or in title
+                                      (TITLE, 2023),
+                                      ('Redes neurais recorrentes para séries temporais', 2020)])
+        self.assertEqual(self.works(), [
+            {('1', 'Editorial')},
+            {('1', 'Introdução')},
+            {('1', TITLE), ('2', TITLE.upper() + '.'),
+             ('3', 'Redes neurais convolucionais para classificacao de imagens medicas')},
+            {('2', 'Editorial')},
+            {('3', TITLE)},
+            {('3', 'Redes neurais recorrentes para séries temporais')},
+        ])
+
+    def test_works_move_off_deleted_publications(self):
+        self.ingest('1', '01012024', [(TITLE, 2020)])
+        self.ingest('2', '01012024', [(TITLE, 2020)])
+        first_id = self.publication_id('1')
+        second_id = self.publication_id('2')
+        self.assertEqual(self.query("SELECT DISTINCT work_id FROM publications"), [(first_id,)])
+        bands = self.query("SELECT COUNT(*) FROM work_bands WHERE work_id = ?", (first_id,))
+
+        # The first publication goes away: the work and its bands move to
+        # the second, and later copies still find it
+        self.ingest('1', '01022024', [])
+        self.assertEqual(self.query("SELECT DISTINCT work_id FROM publications"), [(second_id,)])
+        self.assertEqual(self.query("SELECT COUNT(*) FROM work_bands WHERE work_id = ?", (first_id,)), [(0,)])
+        self.assertEqual(self.query("SELECT COUNT(*) FROM work_bands WHERE work_id = ?", (second_id,)), bands)
+        self.ingest('3', '01012024', [(TITLE.lower(), 2020)])
+        self.assertEqual(self.query("SELECT DISTINCT work_id FROM publications"), [(second_id,)])
+
+        # With no publication left, its bands are dropped
+        self.ingest('2', '01022024', [])
+        self.ingest('3', '01022024', [])
+        self.assertEqual(self.query("SELECT COUNT(*) FROM work_bands"), [(0,)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,9 @@
+import unicodedata
+
+
+# Fold text for accent- and case-insensitive comparisons:
+# "  Conceição " -> "conceicao"
+def normalize_text(text):
+    decomposed = unicodedata.normalize('NFKD', text)
+    stripped = ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return ' '.join(stripped.casefold().split())
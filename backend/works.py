@@ -0,0 +1,267 @@
+import hashlib
+import os
+import re
+
+import numpy as np
+
+from text_utils import normalize_text
+
+# Grouping of publications into works.
+#
+# The same paper is listed in the CV of each of its authors, with small
+# differences in its title (case, accents, punctuation, a truncated
+# subtitle). Every publication written is assigned to the work whose title
+# is most similar to its own, by Jaccard similarity of the sets of 4-byte
+# shingles of the normalized titles, or starts a new work. A work is
+# identified by the id of its first publication, whose title and metadata
+# stand for the work. When that publication is deleted, the work moves to
+# its next publication (see move_works).
+#
+# Similar works are found without comparing titles pairwise, by locality
+# sensitive hashing: the MinHash signature of a title (72 hashes) is cut in
+# 12 bands of 6 hashes, and titles sharing any band are candidates. Bands
+# are stored per work in work_bands. Candidates are then compared exactly.
+#
+# Titles with a Jaccard similarity of 0.8 share a band 97% of the time (0.9:
+# 99.99%). Unrelated titles share many shingles ("cao ", " de "), at 0.05 on
+# average, and bands of fewer hashes make them candidates too often.
+
+# Minimum Jaccard similarity of the titles of two publications of a work
+WORK_SIMILARITY = float(os.environ.get('WORK_SIMILARITY', 0.8))
+
+_BANDS = 12
+_ROWS = 6
+_SHINGLE = 4
+
+# Titles with fewer words ("Editorial", "Introdução") are too generic to
+# tell works apart and always get a work of their own
+_MIN_WORDS = 3
+
+# Years of two publications of a work may differ by this much, as CVs list
+# the online and the printed year
+_YEAR_TOLERANCE = 1
+
+# Shingles hashed at a time when computing signatures. The (shingles x
+# hashes) matrix is kept small enough to stay in the CPU cache.
+_SIGNATURE_SHINGLES = 4096
+
+# Maximum ids per SELECT ... IN (...) statement
+_LOOKUP_CHUNK = 500
+
+_WORD = re.compile(r'\w+')
+
+
+# Signatures must be the same in every process and run, so the hash
+# constants are derived from fixed strings rather than drawn at random
+def _constants(name, count):
+    return np.array([int.from_bytes(hashlib.sha256(f'{name}{i}'.encode()).digest()[:8], 'little') | 1
+                     for i in range(count)], dtype=np.uint64)
+
+
+_MULTIPLIERS = _constants('minhash-multiplier', _BANDS * _ROWS)
+_BAND_MULTIPLIERS = _constants('band-multiplier', _ROWS + 1)
+
+
+# Title reduced to its words, without case, accents or punctuation. Words
+# repeat across titles, so each is folded once per `folded` dict.
+def title_key(title, folded=None):
+    if folded is None:
+        folded = {}
+    words = []
+    for token in title.split():
+        key = folded.get(token)
+        if key is None:
+            key = folded[token] = ' '.join(_WORD.findall(normalize_text(token)))
+        if key:
+            words.append(key)
+    return ' '.join(words)
+
+
+def _shingles(key):
+    data = key.encode('utf-8')
+    return {data[i:i + _SHINGLE] for i in range(max(1, len(data) - _SHINGLE + 1))}
+
+
+def similarity(shingles, other):
+    return len(shingles & other) / len(shingles | other)
+
+
+# MinHash signatures of title keys, as a (titles x 72) array. The shingles
+# of all titles are read from their concatenated UTF-8 bytes at once.
+def signatures(keys):
+    data = [key.encode('utf-8').ljust(_SHINGLE) for key in keys]
+    lengths = np.fromiter(map(len, data), dtype=np.int64, count=len(data))
+    counts = lengths - (_SHINGLE - 1)
+    result = np.empty((len(data), _BANDS * _ROWS), dtype=np.uint64)
+    if not data:
+        return result
+
+    buffer = np.frombuffer(b''.join(data), dtype=np.uint8).astype(np.uint64)
+    packed = buffer[:len(buffer) - _SHINGLE + 1].copy()
+    for offset in range(1, _SHINGLE):
+        packed = (packed << np.uint64(8)) | buffer[offset:len(buffer) - _SHINGLE + 1 + offset]
+
+    # Every shingle that does not cross into the next title, by title
+    ends = np.cumsum(counts)
+    firsts = ends - counts
+    shingles = packed[np.repeat(np.cumsum(lengths) - lengths - firsts, counts) + np.arange(ends[-1])]
+
+    hashes = np.empty((max(_SIGNATURE_SHINGLES, int(counts.max())), len(_MULTIPLIERS)), dtype=np.uint64)
+    start = 0
+    while start < len(data):
+        end = max(start + 1, int(np.searchsorted(ends, firsts[start] + _SIGNATURE_SHINGLES, 'right')))
+        chunk = shingles[firsts[start]:ends[end - 1]]
+        # Multiply-shift hashing, the high 32 bits of the 64-bit products
+        chunk_hashes = hashes[:len(chunk)]
+        np.multiply(chunk[:, None], _MULTIPLIERS, out=chunk_hashes)
+        np.right_shift(chunk_hashes, np.uint64(32), out=chunk_hashes)
+        np.minimum.reduceat(chunk_hashes, firsts[start:end] - firsts[start], axis=0, out=result[start:end])
+        start = end
+    return result
+
+
+# LSH band keys of signatures, as a (titles x 12) array. Keys are hashes of
+# 31 bits, which SQLite stores in 4 bytes. A band matches an unrelated
+# stored band with probability (bands stored) / 2**31, which only adds a
+# candidate to compare.
+def band_keys(signatures):
+    bands = signatures.reshape(len(signatures), _BANDS, _ROWS)
+    with np.errstate(over='ignore'):
+        keys = (bands * _BAND_MULTIPLIERS[:_ROWS]).sum(axis=2, dtype=np.uint64)
+        keys += np.arange(_BANDS, dtype=np.uint64) * _BAND_MULTIPLIERS[_ROWS]
+    return (keys >> np.uint64(33)).astype(np.int64)
+
+
+# A work being assigned publications: the title and metadata of its first
+# publication, and the title of the publication of each of its researchers
+class _Work:
+    __slots__ = ('key', 'kind', 'year', 'doi', 'titles', '_shingles')
+
+    def __init__(self, key, kind, year, doi):
+        self.key = key
+        self.kind = kind
+        self.year = year
+        self.doi = doi
+        self.titles = {}
+        self._shingles = None
+
+    @property
+    def shingles(self):
+        if self._shingles is None:
+            self._shingles = _shingles(self.key)
+        return self._shingles
+
+    # Whether a publication can be one of the work's: its kind, year and DOI
+    # agree, and its researcher has no other publication in the work
+    def accepts(self, title, researcher_id, kind, year, doi):
+        if kind and self.kind and kind != self.kind:
+            return False
+        if year and self.year and abs(year - self.year) > _YEAR_TOLERANCE:
+            return False
+        if doi and self.doi and doi != self.doi:
+            return False
+        return self.titles.get(researcher_id, title) == title
+
+
+# Assign works to stored publications without one, given as (id, title,
+# researcher_id, kind, year, doi) rows. A publication similar enough to no
+# work starts its own, identified by its id, and its bands are stored.
+# Returns the work id of every row.
+def assign_works(cursor, rows):
+    folded = {}
+    keys = [title_key(row[1], folded) for row in rows]
+    banded = np.array([key.count(' ') + 1 >= _MIN_WORDS for key in keys], dtype=bool)
+    bands = np.zeros((len(rows), _BANDS), dtype=np.int64)
+    bands[banded] = band_keys(signatures([key for key, has_bands in zip(keys, banded) if has_bands]))
+
+    # Works in the buckets of the publications
+    buckets = {}
+    values, counts = np.unique(bands[banded], return_counts=True)
+    unique_bands = values.tolist()
+    for start in range(0, len(unique_bands), _LOOKUP_CHUNK):
+        chunk = unique_bands[start:start + _LOOKUP_CHUNK]
+        placeholders = ','.join('?' * len(chunk))
+        cursor.execute(f"SELECT band_key, work_id FROM work_bands WHERE band_key IN ({placeholders})", chunk)
+        for band, work_id in cursor.fetchall():
+            buckets.setdefault(band, []).append(work_id)
+
+    # ... and their publications. Works whose publications were all deleted
+    # are left out.
+    works = {}
+    work_ids = list({work_id for bucket in buckets.values() for work_id in bucket})
+    for start in range(0, len(work_ids), _LOOKUP_CHUNK):
+        chunk = work_ids[start:start + _LOOKUP_CHUNK]
+        placeholders = ','.join('?' * len(chunk))
+        cursor.execute("SELECT work_id, title, researcher_id, kind, year, doi FROM publications "
+                       f"WHERE work_id IN ({placeholders}) ORDER BY id", chunk)
+        for work_id, title, researcher_id, kind, year, doi in cursor.fetchall():
+            work = works.get(work_id)
+            if work is None:
+                work = works[work_id] = _Work(title_key(title, folded), kind, year, doi)
+            work.titles.setdefault(researcher_id, title)
+
+    # Only the bands of stored works, or of several publications of the
+    # batch, can lead a publication to a work
+    candidate_bands = np.isin(bands, np.array(list(buckets), dtype=np.int64)) | np.isin(bands, values[counts > 1])
+    candidate_bands &= banded[:, None]
+    has_candidates = candidate_bands.any(axis=1).tolist()
+
+    assigned = []
+    for i, (publication_id, title, researcher_id, kind, year, doi) in enumerate(rows):
+        row_bands = bands[i][candidate_bands[i]].tolist() if has_candidates[i] else ()
+        best_id, best_similarity = None, WORK_SIMILARITY
+        shingles = None
+        for work_id in sorted({work_id for band in row_bands for work_id in buckets.get(band, ())}):
+            work = works.get(work_id)
+            if work is None or not work.accepts(title, researcher_id, kind, year, doi):
+                continue
+            if shingles is None:
+                shingles = _shingles(keys[i])
+            work_similarity = similarity(shingles, work.shingles)
+            if work_similarity >= best_similarity and (best_id is None or work_similarity > best_similarity):
+                best_id, best_similarity = work_id, work_similarity
+
+        if best_id is None:
+            best_id = publication_id
+            works[best_id] = _Work(keys[i], kind, year, doi)
+            for band in row_bands:
+                buckets.setdefault(band, []).append(best_id)
+        works[best_id].titles.setdefault(researcher_id, title)
+        assigned.append(best_id)
+
+    # Bands of the new works, in key order to keep the inserts into the
+    # index local
+    ids = np.array([row[0] for row in rows], dtype=np.int64)
+    new_rows = np.flatnonzero((np.array(assigned, dtype=np.int64) == ids) & banded)
+    new_bands = np.column_stack((bands[new_rows].ravel(), np.repeat(ids[new_rows], _BANDS)))
+    new_bands = new_bands[np.argsort(new_bands[:, 0], kind='stable')]
+    cursor.executemany("INSERT OR IGNORE INTO work_bands (band_key, work_id) VALUES (?, ?)", new_bands.tolist())
+    return assigned
+
+
+# Move the works of deleted publications, given as (id, title) rows of
+# those that identified a work, to their first remaining publication: the
+# work takes its id and the bands of its title. The bands of works with no
+# publication left are dropped.
+def move_works(cursor, deleted):
+    moves = []
+    for publication_id, title in deleted:
+        cursor.execute("SELECT id, title FROM publications WHERE work_id = ? ORDER BY id LIMIT 1", (publication_id,))
+        row = cursor.fetchone()
+        if row is not None:
+            cursor.execute("UPDATE publications SET work_id = ? WHERE work_id = ?", (row[0], publication_id))
+            moves.append(row)
+
+    cursor.executemany("DELETE FROM work_bands WHERE band_key = ? AND work_id = ?", _band_rows(deleted))
+    cursor.executemany("INSERT OR IGNORE INTO work_bands (band_key, work_id) VALUES (?, ?)", _band_rows(moves))
+
+
+# (band_key, work_id) rows of the bands of works, given as (id, title) rows
+def _band_rows(works):
+    folded = {}
+    keys = [title_key(title, folded) for _, title in works]
+    banded = [(work_id, key) for (work_id, _), key in zip(works, keys) if key.count(' ') + 1 >= _MIN_WORDS]
+    if not banded:
+        return []
+    bands = band_keys(signatures([key for _, key in banded]))
+    return [(band, work_id) for (work_id, _), row_bands in zip(banded, bands.tolist()) for band in row_bands]
@@ -1,11 +1,88 @@
 import streamlit as st
 import requests
+import gzip
+import io
 import json
 import os
+import shutil
+import time
 
 # Set the backend URL
 BACKEND_URL = "http://localhost:8000"
 
+# Seconds between two progress checks of an ingest job
+JOB_POLL_INTERVAL = 0.5
+
+# Seconds a page of search results is reused before asking the backend again
+SEARCH_CACHE_TTL = 300
+
+# Suggestions shown under the search input
+SUGGESTION_COUNT = 5
+
+# Results per page offered in the search tab
+PAGE_SIZES = [20, 50, 100, 500, 1000]
+
+# gzip level of XML files compressed before upload; Lattes XML compresses
+# 10 to 20 times at the fast levels already
+UPLOAD_COMPRESS_LEVEL = 5
+
+# Compress an uploaded XML file for sending it to the backend as .xml.gz
+def compress_upload(uploaded_file):
+    compressed = io.BytesIO()
+    uploaded_file.seek(0)
+    with gzip.GzipFile(fileobj=compressed, mode="wb", compresslevel=UPLOAD_COMPRESS_LEVEL) as out:
+        shutil.copyfileobj(uploaded_file, out)
+    compressed.seek(0)
+    return compressed
+
+# HTTP session shared by every user and rerun of the app, so connections to
+# the backend are pooled and reused instead of opened for every request
+@st.cache_resource
+def get_session():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+# One page of search results and the cursor of the next page (None on the
+# last page), cached per query and page for SEARCH_CACHE_TTL seconds.
+# Errors raise, so they are not cached.
+@st.cache_data(ttl=SEARCH_CACHE_TTL, show_spinner=False)
+def fetch_page(endpoint, params, limit, cursor):
+    params = dict(params, limit=limit)
+    if cursor:
+        params["cursor"] = cursor
+    response = get_session().get(f"{BACKEND_URL}{endpoint}", params=params)
+    response.raise_for_status()
+    return response.json(), response.headers.get("X-Next-Cursor")
+
+# Researchers and title terms completing the search input. Suggestions are
+# optional, so when the backend cannot give them there are none.
+@st.cache_data(ttl=SEARCH_CACHE_TTL, show_spinner=False)
+def fetch_suggestions(query):
+    try:
+        response = get_session().get(f"{BACKEND_URL}/autocomplete",
+                                     params={"q": query, "limit": SUGGESTION_COUNT}, timeout=2)
+        response.raise_for_status()
+    except requests.exceptions.RequestException:
+        return {"researchers": [], "terms": []}
+    return response.json()
+
+# Suggestion buttons of the search tab: fill the search input
+def use_suggestion(text):
+    st.session_state.search_query = text
+
+# Page buttons of the search tab, run before the app reruns
+def change_page(step):
+    st.session_state.search["page"] += step
+
+# Results are cached for SEARCH_CACHE_TTL seconds; refreshing asks the
+# backend again, e.g. after uploading new files
+def refresh_search():
+    fetch_page.clear()
+    st.session_state.search.update(cursors=[None], page=0)
+
 st.set_page_config(page_title="Lattes XML Processor", layout="wide")
 
 st.title("Lattes XML Processor")
@@ -26,27 +103,62 @@ with tab1:
     st.header("Upload Lattes XML Files")
     
     # File uploader for multiple XML files
-    uploaded_files = st.file_uploader("Choose Lattes XML files", accept_multiple_files=True, type=['xml'])
+    # Files may also be uploaded gzip-compressed (.xml.gz) or as ZIP archives
+    # of XML files
+    uploaded_files = st.file_uploader("Choose Lattes XML files", accept_multiple_files=True,
+                                      type=['xml', 'gz', 'zip'])
     
     if st.button("Process Files") and uploaded_files:
-        with st.spinner("Processing XML files..."):
-            # Prepare files for upload
-            files = []
-            for uploaded_file in uploaded_files:
-                files.append(("files", (uploaded_file.name, uploaded_file.getvalue(), "text/xml")))
+        # Prepare files for upload; XML files are gzip-compressed first, as
+        # upload bandwidth is usually the bottleneck, while compressed files
+        # and archives are streamed as they are
+        files = []
+        for uploaded_file in uploaded_files:
+            if uploaded_file.name.lower().endswith(".xml"):
+                files.append(("files", (uploaded_file.name + ".gz", compress_upload(uploaded_file), "application/gzip")))
+            else:
+                uploaded_file.seek(0)
+                files.append(("files", (uploaded_file.name, uploaded_file, "application/octet-stream")))
+        
+        try:
+            # Send files to backend, which answers with the id of the ingest job
+            with st.spinner("Uploading XML files..."):
+                response = get_session().post(f"{BACKEND_URL}/process-xmls", files=files)
             
-            try:
-                # Send files to backend
-                response = requests.post(f"{BACKEND_URL}/process-xmls", files=files)
+            if response.status_code == 202:
+                job_id = response.json()["job_id"]
+                for name in response.json().get("ignored_files", []):
+                    st.warning(f"{name}: ignored, not an XML, .xml.gz or .zip file")
+                
+                # Poll the job until it finishes, showing its progress
+                progress_bar = st.progress(0.0)
+                status_text = st.empty()
+                while True:
+                    job = get_session().get(f"{BACKEND_URL}/jobs/{job_id}").json()
+                    total = job["files_total"] or 1
+                    done = job["files_parsed"] + job["files_skipped"]
+                    progress_bar.progress(min(done / total, 1.0))
+                    status_text.text(
+                        f"{done} of {job['files_total']} files done ({job['files_skipped']} unchanged), "
+                        f"{job['publications_parsed']} publications read "
+                        f"({job['files_per_second'] or 0} files/s)"
+                    )
+                    if job["status"] not in ("queued", "running"):
+                        break
+                    time.sleep(JOB_POLL_INTERVAL)
                 
-                if response.status_code == 200:
-                    result = response.json()
-                    st.success(f"Successfully processed {result['message']}")
-                    st.json(result)
+                if job["status"] == "completed":
+                    st.success(f"Successfully processed {job['files_processed']} XML files, "
+                               f"skipped {job['files_skipped']} unchanged files")
                 else:
-                    st.error(f"Error: {response.status_code} - {response.text}")
-            except requests.exceptions.ConnectionError:
-                st.error("Could not connect to the backend server. Make sure it's running at " + BACKEND_URL)
+                    st.error(f"Processing {job['status']}")
+                for error in job["errors"]:
+                    st.warning(f"{error['file']}: {error['error']}")
+                st.json(job)
+            else:
+                st.error(f"Error: {response.status_code} - {response.text}")
+        except requests.exceptions.ConnectionError:
+            st.error("Could not connect to the backend server. Make sure it's running at " + BACKEND_URL)
     
     if not uploaded_files:
         st.info("Please upload one or more Lattes XML files to process.")
@@ -60,42 +172,83 @@ with tab2:
         ["Search by Publication Title", "Search by Author Name"]
     )
     
-    # Search input
-    search_query = st.text_input("Enter search term")
+    # Search input, with suggestions completing it once something is typed
+    search_query = st.text_input("Enter search term", key="search_query")
+    if search_query.strip():
+        suggestions = fetch_suggestions(search_query)
+        if search_mode == "Search by Publication Title":
+            texts = [suggestion["text"] for suggestion in suggestions["terms"]]
+        else:
+            texts = [suggestion["name"] for suggestion in suggestions["researchers"]]
+        texts = [text for text in texts if text != search_query]
+        if texts:
+            for column, text in zip(st.columns(SUGGESTION_COUNT), texts):
+                column.button(text, key=f"suggestion-{text}", on_click=use_suggestion, args=(text,))
+    page_size = st.selectbox("Results per page", PAGE_SIZES)
+    by_work = st.checkbox("Show each paper once, with all its researchers")
     
+    # The search being browsed is kept across reruns, with the cursor of
+    # every page reached so far, so pages can be browsed back and forth
     if st.button("Search") and search_query:
-        with st.spinner("Searching..."):
-            try:
-                # Determine which endpoint to use based on search mode
-                if search_mode == "Search by Publication Title":
-                    endpoint = "/search"
-                    params = {"query": search_query}
-                else:  # Search by Author Name
-                    endpoint = "/search-by-author"
-                    params = {"name": search_query}
-                
-                # Send search query to backend
-                response = requests.get(f"{BACKEND_URL}{endpoint}", params=params)
+        # Determine which endpoint to use based on search mode
+        if search_mode == "Search by Publication Title":
+            endpoint, params = "/search", {"query": search_query}
+        else:  # Search by Author Name
+            endpoint, params = "/search-by-author", {"name": search_query}
+        if by_work:
+            params["by_work"] = "true"
+        st.session_state.search = {
+            "endpoint": endpoint,
+            "params": params,
+            "mode": search_mode,
+            "query": search_query,
+            "limit": page_size,
+            "cursors": [None],
+            "page": 0,
+        }
+    
+    search = st.session_state.get("search")
+    if search and search["limit"] != page_size:
+        # Pages of another size start over from the first one
+        search.update(limit=page_size, cursors=[None], page=0)
+    
+    if search:
+        try:
+            with st.spinner("Searching..."):
+                results, next_cursor = fetch_page(search["endpoint"], search["params"], search["limit"],
+                                                  search["cursors"][search["page"]])
+            if next_cursor and len(search["cursors"]) == search["page"] + 1:
+                search["cursors"].append(next_cursor)
+            
+            search_type = "publication title" if search["mode"] == "Search by Publication Title" else "author name"
+            if results:
+                first = search["page"] * search["limit"] + 1
+                more = " (more on the next pages)" if next_cursor else ""
+                st.subheader(f"Results {first} to {first + len(results) - 1} for {search_type} "
+                             f"'{search['query']}'{more}")
                 
-                if response.status_code == 200:
-                    results = response.json()
-                    
-                    if results:
-                        search_type = "publication title" if search_mode == "Search by Publication Title" else "author name"
-                        st.subheader(f"Found {len(results)} results for {search_type} '{search_query}'")
-                        
-                        # Display results in a nice format
-                        for i, result in enumerate(results, 1):
-                            with st.expander(f"{i}. {result['title']}"):
-                                st.markdown(f"**Researcher:** {result['researcher']}")
-                                st.markdown(f"**Title:** {result['title']}")
-                    else:
-                        search_type = "publication titles" if search_mode == "Search by Publication Title" else "author names"
-                        st.info(f"No {search_type} found matching '{search_query}'")
-                else:
-                    st.error(f"Error: {response.status_code} - {response.text}")
-            except requests.exceptions.ConnectionError:
-                st.error("Could not connect to the backend server. Make sure it's running at " + BACKEND_URL)
+                # A dataframe only renders the rows in view, so large pages
+                # do not freeze the browser
+                st.dataframe(
+                    [{"#": first + i, "Title": result["title"],
+                      "Researcher": ", ".join(result["researchers"]) if "researchers" in result
+                      else result["researcher"],
+                      "Year": result["year"], "Type": result["kind"], "Venue": result["venue"]}
+                     for i, result in enumerate(results)],
+                    hide_index=True,
+                    use_container_width=True,
+                )
+            else:
+                st.info(f"No {search_type}s found matching '{search['query']}'")
+            
+            previous_column, refresh_column, next_column = st.columns(3)
+            previous_column.button("Previous page", disabled=search["page"] == 0, on_click=change_page, args=(-1,))
+            refresh_column.button("Refresh results", on_click=refresh_search)
+            next_column.button("Next page", disabled=not next_cursor, on_click=change_page, args=(1,))
+        except requests.exceptions.HTTPError as e:
+            st.error(f"Error: {e.response.status_code} - {e.response.text}")
+        except requests.exceptions.ConnectionError:
+            st.error("Could not connect to the backend server. Make sure it's running at " + BACKEND_URL)
     
     if not search_query:
         st.info("Enter a search term to find publications.")